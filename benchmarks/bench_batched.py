@@ -0,0 +1,108 @@
+# Sequential vs. batched inference (whisper_batched) of faster-whisper on a real recording
+# usage: python benchmarks/bench_batched.py <audio file> [--model precise] [--language Auto] [--batch-size auto]
+#            [--repeat 1] [--reference <transcript.txt>] [--output <results file>]
+#
+# Runs run_transcription (without speaker detection, stage cache and checkpoints) once per mode and
+# repeat, and reports the decoding time, the real-time factor and the throughput of both modes. The
+# accuracy is compared on the word level: how much of the text of the batched run agrees with the
+# sequential run (which conditions every segment on the text before it), and with --reference also
+# how much of each run agrees with a correct transcript. Needs a whisper model and speech, synthetic
+# audio (as in bench_pipeline.py) says nothing about the accuracy. The results are appended as one
+# JSON line to the results file, together with the CPU and thread count they were measured with.
+
+import os
+import re
+import sys
+import json
+import time
+import difflib
+import platform
+import argparse
+import statistics
+from tempfile import TemporaryDirectory
+
+bench_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(bench_dir, '..')))
+import transcriber
+
+def words(text: str) -> list:
+    """ Lower case words without punctuation """
+    return re.findall(r"\w+(?:'\w+)?", text.lower())
+
+def agreement(reference: list, hypothesis: list) -> float:
+    """ Share of the words that both texts have in common, in the same order (1.0 = identical) """
+    if not reference and not hypothesis:
+        return 1.0
+    matcher = difflib.SequenceMatcher(None, reference, hypothesis, autojunk=False)
+    matched = sum(block.size for block in matcher.get_matching_blocks())
+    return 2 * matched / (len(reference) + len(hypothesis))
+
+def run_once(audio_file: str, output_dir: str, model: str, language: str, batched: bool) -> tuple:
+    """ (metrics of the run, transcribed text) """
+    transcriber.config['whisper_batched'] = batched
+    metrics_file = os.path.join(output_dir, 'metrics.json')
+    texts = []
+    transcriber.run_transcription(audio_file, os.path.join(output_dir, 'transcript.txt'), language, model, 'none',
+                                  log_callback=lambda message: None, resume=False, metrics_file=metrics_file,
+                                  segment_callback=lambda segment: texts.append(segment.text))
+    with open(metrics_file, 'r', encoding='utf-8') as file:
+        return json.load(file), ''.join(texts)
+
+def main():
+    parser = argparse.ArgumentParser(description='Sequential vs. batched inference of faster-whisper')
+    parser.add_argument('audio_file', help='a recording with speech')
+    parser.add_argument('--model', default='precise', help='name of the whisper model')
+    parser.add_argument('--language', default='Auto')
+    parser.add_argument('--batch-size', default='auto', help="whisper_batch_size ('auto' or a number)")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--reference', help='text file with a correct transcript of the recording')
+    parser.add_argument('--output', default=os.path.join(bench_dir, 'results', 'batched.jsonl'))
+    args = parser.parse_args()
+
+    transcriber.config.update({'stage_cache': False, 'checkpoints': False, 'progress_log': False, 'metrics': False,
+                               'parallel_transcription_workers': 0, 'whisper_batch_size': args.batch_size})
+    transcriber.resolve_whisper_model(args.model) # fails early if the model is not installed
+    reference = None
+    if args.reference:
+        with open(args.reference, 'r', encoding='utf-8') as file:
+            reference = words(file.read())
+
+    results = {}
+    texts = {}
+    with TemporaryDirectory(prefix='noScribe-bench-') as tmpdir:
+        # warm-up: the first run also loads the model and runs the language detection
+        run_once(args.audio_file, tmpdir, args.model, args.language, False)
+        for mode in ('sequential', 'batched'):
+            runs = []
+            for _ in range(args.repeat):
+                metrics, texts[mode] = run_once(args.audio_file, tmpdir, args.model, args.language, mode == 'batched')
+                runs.append(metrics)
+            duration = runs[0]['audio_duration']
+            decoding = max(statistics.median(run['stages']['decoding']['wall'] for run in runs), 0.001)
+            results[mode] = {'decoding_wall': round(decoding, 3), 'rtf': round(decoding / duration, 4),
+                             'throughput': round(duration / decoding, 2), 'words': len(words(texts[mode]))}
+            if reference is not None:
+                results[mode]['agreement_with_reference'] = round(agreement(reference, words(texts[mode])), 4)
+
+    result = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(), 'machine': platform.machine(),
+              'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'cpu_limit': transcriber.resources.cpu_limit(),
+              'threads': transcriber.number_threads, 'model': args.model, 'batch_size': args.batch_size,
+              'audio_file': os.path.basename(args.audio_file), 'audio_duration': duration, 'repeat': args.repeat,
+              'agreement_batched_sequential': round(agreement(words(texts['sequential']), words(texts['batched'])), 4),
+              **results}
+    print(f'{duration / 60:.1f} min of audio, model {args.model}, {transcriber.number_threads} threads:')
+    for mode in ('sequential', 'batched'):
+        line = (f'  {mode:10s} decoding {results[mode]["decoding_wall"]:8.1f}s  RTF {results[mode]["rtf"]:.3f}  '
+                f'{results[mode]["throughput"]:6.1f}x realtime  {results[mode]["words"]} words')
+        if reference is not None:
+            line += f'  agreement with reference {results[mode]["agreement_with_reference"]:.1%}'
+        print(line)
+    print(f'  speedup of batched: {results["sequential"]["decoding_wall"] / results["batched"]["decoding_wall"]:.2f}x, '
+          f'word agreement with sequential: {result["agreement_batched_sequential"]:.1%}')
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(result) + '\n')
+    transcriber.stop_diarization_workers()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Cost of the audio preparation in the Telegram bot: re-encoding the download to mp3 (the former
+# yt-dlp FFmpegExtractAudio postprocessor) and decoding that mp3, compared with decoding the native
+# audio stream of the download directly into 16 kHz PCM
+# usage: python benchmarks/bench_bot_audio.py [audio file] [--minutes 10] [--repeat 3]
+#
+# Without an audio file, a synthetic download in the format YouTube usually delivers as 'bestaudio'
+# (opus in webm, 48 kHz stereo, ~130 kbit/s) is generated. Reported are the wall time and the CPU
+# time of ffmpeg (best of --repeat runs), extrapolated to one hour of audio, and the size on disk.
+
+import os
+import sys
+import time
+import argparse
+import resource
+import subprocess
+from tempfile import TemporaryDirectory
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from transcriber import get_ffmpeg_path, decode_audio_to_buffer
+
+def make_download(file: str, minutes: float) -> None:
+    """ Noise and a tone, encoded like YouTube's audio format 251 """
+    seconds = minutes * 60
+    subprocess.run([get_ffmpeg_path(), '-hide_banner', '-loglevel', 'error', '-y',
+                    '-f', 'lavfi', '-i', f'anoisesrc=d={seconds}:c=pink:r=48000:a=0.3',
+                    '-f', 'lavfi', '-i', f'sine=f=220:d={seconds}:r=48000',
+                    '-filter_complex', '[0][1]amix=inputs=2,pan=stereo|c0=c0|c1=c0',
+                    '-c:a', 'libopus', '-b:a', '128k', file], check=True)
+
+def duration(file: str) -> float:
+    buffer = decode_audio_to_buffer(file, log_callback=lambda message: None)
+    try:
+        return len(buffer.array) / 16000
+    finally:
+        buffer.close()
+
+def measure(step) -> tuple:
+    """ (wall time, CPU time of the child processes) of step() in seconds """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+    step()
+    wall = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return wall, (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+def best(step, repeat: int) -> tuple:
+    runs = [measure(step) for _ in range(repeat)]
+    return min(run[0] for run in runs), min(run[1] for run in runs)
+
+def main():
+    parser = argparse.ArgumentParser(description='mp3 re-encode vs. direct decoding of the downloaded audio')
+    parser.add_argument('audio_file', nargs='?', help='a download of yt-dlp (default: synthetic opus/webm)')
+    parser.add_argument('--minutes', type=float, default=10, help='length of the synthetic download')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        native_file = args.audio_file
+        if native_file is None:
+            native_file = os.path.join(tmp_dir, 'download.webm')
+            make_download(native_file, args.minutes)
+        mp3_file = os.path.join(tmp_dir, 'download.mp3')
+        hours = duration(native_file) / 3600
+
+        def encode_mp3(): # what FFmpegExtractAudio with preferredcodec mp3, preferredquality 192 runs
+            subprocess.run([get_ffmpeg_path(), '-hide_banner', '-loglevel', 'error', '-y', '-i', native_file,
+                            '-vn', '-acodec', 'libmp3lame', '-b:a', '192k', mp3_file], check=True)
+        def decode(file):
+            return lambda: decode_audio_to_buffer(file, log_callback=lambda message: None).close()
+
+        results = {
+            'mp3 re-encode': best(encode_mp3, args.repeat),
+            'decode mp3': best(decode(mp3_file), args.repeat),
+            'decode native': best(decode(native_file), args.repeat),
+        }
+        sizes = {'native': os.path.getsize(native_file), 'mp3': os.path.getsize(mp3_file)}
+
+    print(f'{hours * 60:.1f} min of audio, per hour of audio:')
+    for name, (wall, cpu) in results.items():
+        print(f'  {name:15s} {wall / hours:7.1f} s wall  {cpu / hours:7.1f} s CPU')
+    old = [a + b for a, b in zip(results['mp3 re-encode'], results['decode mp3'])]
+    new = results['decode native']
+    print(f'  before (re-encode + decode mp3): {old[0] / hours:.1f} s wall, {old[1] / hours:.1f} s CPU, '
+          f'{sizes["native"] / hours / 2**20:.0f} + {sizes["mp3"] / hours / 2**20:.0f} MB on disk')
+    print(f'  after (decode native):           {new[0] / hours:.1f} s wall, {new[1] / hours:.1f} s CPU, '
+          f'{sizes["native"] / hours / 2**20:.0f} MB on disk')
+    print(f'  saving: {(old[0] - new[0]) / hours:.1f} s wall, {(old[1] - new[1]) / hours:.1f} s CPU per hour of audio')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# Import-time budget of the entry points (GUI, bot, transcriber), based on python -X importtime
+# usage: python benchmarks/bench_import.py [--modules transcriber telegram_bot noScribe] [--budget-ms 300] [--repeat 3]
+#
+# Every module is imported in a fresh interpreter after the framework it cannot start without
+# (tkinter/customtkinter for the GUI, python-telegram-bot for the bot). Reported is the time the
+# module itself adds on top of that, and the modules that contribute most to it. The check fails
+# (exit code 1) if this time exceeds --budget-ms or if a heavy dependency (torch, faster_whisper, ...)
+# is imported at startup instead of when the first job needs it.
+
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+repo_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+frameworks = {
+    'noScribe': ['tkinter', 'customtkinter', 'PIL.Image'],
+    'telegram_bot': ['telegram', 'telegram.ext'],
+    'transcriber': [],
+}
+
+# must only be imported when a job runs (see transcriber.warm_up())
+heavy_modules = ['torch', 'ctranslate2', 'faster_whisper', 'AdvancedHTMLParser', 'pyannote', 'yt_dlp']
+
+def import_times(module: str) -> tuple:
+    """ (cumulative time of module in ms, {top-level module: cumulative ms} of its imports, imported names) """
+    code = ''.join(f'import {name}; ' for name in frameworks.get(module, [])) + f'import {module}'
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [repo_dir, env.get('PYTHONPATH')]))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=repo_dir, env=env,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'exit code {proc.returncode}')
+    total = None
+    parts = {}
+    names = set()
+    stack = [] # (level, name) of the enclosing imports
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        names.add(name)
+        # -X importtime prints an import after its children, the children have level + 1
+        if level == 0 and name == module:
+            total = int(cumulative) / 1000
+        elif level == 1:
+            stack.append((name, int(cumulative) / 1000))
+        if level == 0:
+            if name == module:
+                parts = dict(stack)
+            stack = []
+    if total is None:
+        raise RuntimeError(f'{module} not found in the import log')
+    return total, parts, names
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time budget of noScribe entry points')
+    parser.add_argument('--modules', nargs='+', default=['transcriber', 'telegram_bot', 'noScribe'])
+    parser.add_argument('--budget-ms', type=float, default=300, help='time a module may add to its framework')
+    parser.add_argument('--repeat', type=int, default=3, help='the median of these runs is reported')
+    parser.add_argument('--top', type=int, default=8, help='number of the slowest imports shown')
+    args = parser.parse_args()
+
+    ok = True
+    for module in args.modules:
+        try:
+            runs = [import_times(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f'{module}: cannot be imported: {e}')
+            ok = False
+            continue
+        total = statistics.median(run[0] for run in runs)
+        parts, names = runs[-1][1], runs[-1][2]
+        heavy = sorted({h for h in heavy_modules for name in names if name == h or name.startswith(h + '.')})
+        over_budget = total > args.budget_ms
+        status = 'OK'
+        if over_budget or heavy:
+            status = 'FAIL'
+            ok = False
+        print(f'{module}: {total:.0f} ms on top of {", ".join(frameworks.get(module)) or "python"} '
+              f'(budget {args.budget_ms:.0f} ms) {status}')
+        for name, ms in sorted(parts.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+            print(f'    {name:32s} {ms:8.1f} ms')
+        if heavy:
+            print(f'    imported at startup: {", ".join(heavy)}')
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
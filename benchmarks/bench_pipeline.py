@@ -0,0 +1,239 @@
+# End-to-end benchmark: run_transcription with synthetic multi-speaker audio
+# usage: python benchmarks/bench_pipeline.py [--minutes 5 30] [--speakers 3] [--model auto|stub|<name>]
+#            [--diarizer auto|stub|pyannote] [--repeat 3] [--output <results file>] [--baseline <results file>]
+#
+# Measures the pipeline around the models (audio conversion, diarization worker, transcript
+# output...), not the models themselves: without real models (or with --model stub /
+# --diarizer stub), a deterministic stand-in for the whisper model and the diarization worker
+# (stub_diarize.py) is used. 'auto' uses the whisper model 'tiny' and pyannote if they are installed.
+# Every configuration is appended as one JSON line (median of the repeats) to the results file.
+# With --baseline, the stage times are compared to the results of an earlier run (e.g. before
+# a change) with the same configuration.
+
+import os
+import sys
+import json
+import time
+import wave
+import random
+import platform
+import argparse
+import importlib.util
+import statistics
+import subprocess
+from types import SimpleNamespace
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+bench_dir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.abspath(os.path.join(bench_dir, '..')))
+import transcriber
+
+SAMPLE_RATE = 16000
+
+# Synthetic audio
+
+def synthetic_audio(file: str, minutes: float, num_speakers: int, seed: int = 0) -> list:
+    """ Writes a wav file with alternating speakers and returns the speaker turns (ms).
+    Every speaker is a harmonic 'voice' with its own pitch, speaking in syllable-like bursts. """
+    rnd = random.Random(seed)
+    np_rnd = np.random.default_rng(seed)
+    pitches = [110 + 150 * i / max(1, num_speakers - 1) for i in range(num_speakers)]
+    total = int(minutes * 60 * SAMPLE_RATE)
+    audio = np.zeros(total, dtype=np.float32)
+    turns = []
+    pos = int(0.5 * SAMPLE_RATE)
+    speaker = 0
+    while pos < total:
+        turn_len = int(rnd.uniform(2, 12) * SAMPLE_RATE)
+        turn_end = min(total, pos + turn_len)
+        turns.append({'start': pos * 1000 // SAMPLE_RATE, 'end': turn_end * 1000 // SAMPLE_RATE, 'label': f'SPEAKER_{speaker:02d}'})
+        syllable_pos = pos
+        while syllable_pos < turn_end:
+            length = min(int(rnd.uniform(0.15, 0.3) * SAMPLE_RATE), turn_end - syllable_pos)
+            t = np.arange(length) / SAMPLE_RATE
+            f0 = pitches[speaker] * rnd.uniform(0.97, 1.03)
+            voice = sum(np.sin(2 * np.pi * f0 * h * t) / h for h in (1, 2, 3))
+            audio[syllable_pos:syllable_pos + length] += 0.3 * voice * np.hanning(length)
+            syllable_pos += length + int(rnd.uniform(0.03, 0.08) * SAMPLE_RATE)
+        pos = turn_end + int(rnd.uniform(0.3, 1.5) * SAMPLE_RATE)
+        speaker = (speaker + rnd.randrange(1, num_speakers)) % num_speakers if num_speakers > 1 else 0
+    audio += np_rnd.normal(0, 0.002, total).astype(np.float32) # noise floor
+    pcm = (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+    with wave.open(file, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(pcm.tobytes())
+    return turns
+
+# Stub whisper model
+
+WORDS = ['the', 'interview', 'research', 'we', 'talked', 'about', 'data', 'and', 'what', 'it', 'means', 'for', 'people']
+
+class StubWhisperModel:
+    """ Deterministic stand-in for faster_whisper.WhisperModel: speech is found by its energy,
+    every speech region becomes segments of at most 10 seconds with 2.5 'words' per second.
+    decode_rtf > 0 simulates the decoding time of a real model (seconds per second of audio). """
+    decode_rtf = 0.0
+
+    def detect_language(self, audio):
+        return 'en', 1.0, [('en', 1.0)]
+
+    def transcribe(self, audio, **kwargs):
+        frame = SAMPLE_RATE // 10
+        energy = np.sqrt(np.mean(audio[:len(audio) // frame * frame].reshape(-1, frame) ** 2, axis=1))
+        voiced = energy > 0.02
+        regions = []
+        i = 0
+        while i < len(voiced):
+            if voiced[i]:
+                j = i
+                while j < len(voiced) and (voiced[j] or (j + 3 < len(voiced) and voiced[j:j + 4].any())):
+                    j += 1
+                regions.append((i / 10, j / 10))
+                i = j
+            else:
+                i += 1
+
+        def segments():
+            word_index = 0
+            for region_start, region_end in regions:
+                seg_start = region_start
+                while seg_start < region_end:
+                    seg_end = min(region_end, seg_start + 10.0)
+                    if self.decode_rtf > 0:
+                        time.sleep((seg_end - seg_start) * self.decode_rtf)
+                    num_words = max(1, int((seg_end - seg_start) * 2.5))
+                    step = (seg_end - seg_start) / num_words
+                    words = []
+                    for k in range(num_words):
+                        words.append(SimpleNamespace(start=seg_start + k * step, end=seg_start + (k + 1) * step,
+                                                     word=' ' + WORDS[word_index % len(WORDS)]))
+                        word_index += 1
+                    yield SimpleNamespace(start=seg_start, end=seg_end, text=''.join(w.word for w in words) + '.', words=words)
+                    seg_start = seg_end
+
+        return segments(), SimpleNamespace(language='en', language_probability=1.0, duration=len(audio) / SAMPLE_RATE)
+
+# Benchmark
+
+def setup(model: str, diarizer: str) -> tuple:
+    """ Configures the transcriber for benchmarking, returns the (model, diarizer) actually used """
+    transcriber.config.update({'stage_cache': False, 'checkpoints': False, 'progress_log': False, 'metrics': False})
+    if model == 'auto':
+        model = 'tiny' if 'tiny' in transcriber.get_whisper_models() else 'stub'
+    if diarizer == 'auto':
+        pyannote_config = os.path.join(transcriber.app_dir, 'pyannote', 'pyannote_config.yaml')
+        try:
+            pyannote_installed = importlib.util.find_spec('pyannote.audio') is not None
+        except ImportError: # not even the pyannote namespace package
+            pyannote_installed = False
+        diarizer = 'pyannote' if pyannote_installed and os.path.exists(pyannote_config) else 'stub'
+    if model == 'stub':
+        transcriber.whisper_model_pool._load = lambda *args, **kwargs: StubWhisperModel()
+        transcriber.resolve_whisper_model = lambda name: 'stub'
+        transcriber.config.update({'whisper_xpu': 'cpu', 'parallel_transcription_workers': 0}) # workers cannot use the stub
+    if diarizer == 'stub':
+        transcriber.config['pyannote_xpu'] = 'cpu'
+        transcriber.diarization_workers['cpu'] = transcriber.DiarizationWorker('cpu', script=os.path.join(bench_dir, 'stub_diarize.py'))
+    return model, diarizer
+
+def run_once(audio_file: str, output_dir: str, model: str, num_speakers: int) -> dict:
+    metrics_file = os.path.join(output_dir, 'metrics.json')
+    transcriber.run_transcription(audio_file, os.path.join(output_dir, 'transcript.html'), 'Auto', model,
+                                  str(num_speakers), log_callback=lambda message: None, resume=False,
+                                  metrics_file=metrics_file)
+    with open(metrics_file, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def median_result(runs: list) -> dict:
+    duration = runs[0]['audio_duration']
+    def median_stage(stages):
+        result = {}
+        for key in ('wall', 'cpu', 'peak_rss_mb'):
+            values = [stage[key] for stage in stages if stage.get(key) is not None]
+            result[key] = round(statistics.median(values), 3) if values else None
+        result['rtf'] = round(result['wall'] / duration, 5)
+        return result
+    stage_names = [name for name in runs[0]['stages'] if all(name in run['stages'] for run in runs)]
+    total = median_stage([run['total'] for run in runs])
+    total['throughput'] = round(duration / total['wall'], 2) # seconds of audio per second
+    return {'total': total, 'stages': {name: median_stage([run['stages'][name] for run in runs]) for name in stage_names}}
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=bench_dir, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def config_key(result: dict) -> tuple:
+    return result['model'], result['diarizer'], result['minutes'], result['speakers']
+
+def compare(result: dict, baseline_file: str, threshold: float) -> bool:
+    """ Prints the stage times relative to the last matching baseline result, returns False on regressions """
+    baseline = None
+    with open(baseline_file, 'r', encoding='utf-8') as file:
+        for line in file:
+            entry = json.loads(line)
+            if config_key(entry) == config_key(result):
+                baseline = entry
+    if baseline is None:
+        print(f'  no baseline for {config_key(result)}')
+        return True
+    ok = True
+    for name, stage in [('total', result['total'])] + list(result['stages'].items()):
+        old = baseline['total'] if name == 'total' else baseline['stages'].get(name)
+        if not old or not old['wall'] or stage['wall'] < 0.05: # too short to compare
+            continue
+        ratio = stage['wall'] / old['wall']
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            ok = False
+        print(f'  {name:20s} {old["wall"]:8.2f}s -> {stage["wall"]:8.2f}s  {ratio:5.2f}x{flag}')
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the noScribe pipeline')
+    parser.add_argument('--minutes', type=float, nargs='+', default=[5, 30], help='length(s) of the synthetic audio')
+    parser.add_argument('--speakers', type=int, default=3)
+    parser.add_argument('--model', default='auto', help="'stub', 'auto' or the name of a whisper model")
+    parser.add_argument('--diarizer', default='auto', choices=['auto', 'stub', 'pyannote'])
+    parser.add_argument('--decode-rtf', type=float, default=0.0, help='simulated decoding time of the stub model')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=os.path.join(bench_dir, 'results', 'pipeline.jsonl'))
+    parser.add_argument('--baseline', help='results file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown factor reported as regression')
+    args = parser.parse_args()
+
+    model, diarizer = setup(args.model, args.diarizer)
+    StubWhisperModel.decode_rtf = args.decode_rtf
+    print(f'model: {model}, diarizer: {diarizer}, threads: {transcriber.number_threads}', flush=True)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    ok = True
+    with TemporaryDirectory(prefix='noScribe-bench-') as tmpdir:
+        for minutes in args.minutes:
+            audio_file = os.path.join(tmpdir, f'synthetic_{minutes}min.wav')
+            synthetic_audio(audio_file, minutes, args.speakers)
+            runs = [run_once(audio_file, tmpdir, model, args.speakers) for _ in range(args.repeat)]
+            result = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'host': platform.node(),
+                      'cpu_count': os.cpu_count(), 'cpu_limit': transcriber.resources.cpu_limit(), 'threads': transcriber.number_threads, 'python': platform.python_version(),
+                      'model': model, 'diarizer': diarizer, 'decode_rtf': args.decode_rtf, 'minutes': minutes,
+                      'speakers': args.speakers, 'repeat': args.repeat, 'audio_duration': runs[0]['audio_duration']}
+            result.update(median_result(runs))
+            print(f'{minutes:6.1f} min  total {result["total"]["wall"]:8.2f}s  RTF {result["total"]["rtf"]:.4f}  '
+                  f'{result["total"]["throughput"]:8.1f}x realtime  peak {result["total"]["peak_rss_mb"]} MB', flush=True)
+            for name, stage in result['stages'].items():
+                print(f'  {name:20s} {stage["wall"]:8.2f}s  cpu {stage["cpu"]:8.2f}s  RTF {stage["rtf"]:.4f}  peak {stage["peak_rss_mb"]} MB')
+            if args.baseline:
+                ok = compare(result, args.baseline, args.threshold) and ok
+            with open(args.output, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(result) + '\n')
+    transcriber.stop_diarization_workers()
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
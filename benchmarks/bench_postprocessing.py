@@ -0,0 +1,215 @@
+# Microbenchmark: post-processing of the transcript at 1k - 200k segments (about 1.5 - 300 hours)
+# usage: python benchmarks/bench_postprocessing.py [--sizes 1000 10000 ...] [--only name ...] [--check]
+#
+# Feeds synthetic segments and diarization turns through speaker assignment, TranscriptWriter
+# (html/txt/vtt), building and parsing the DOM with AdvancedHTMLParser, html_node_to_text,
+# html_to_webvtt and vtt_escape. For every function, the time and the peak memory (tracemalloc,
+# measured in a separate run) are printed per size, together with the scaling exponent
+# (slope of log(time) over log(size): ~1 is linear, ~2 quadratic). With --check, the exit
+# code is 1 if a function scales worse than --max-exponent.
+
+import os
+import sys
+import html
+import time
+import random
+import argparse
+import tracemalloc
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import AdvancedHTMLParser
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import transcriber
+from transcriber import SpeakerAssigner, TranscriptWriter, html_node_to_text, html_to_webvtt, vtt_escape
+
+WORDS = ['the', 'interview', 'research', 'we', 'talked', 'about', 'data', 'and', 'what', 'it', 'means',
+         'for', 'people', '&', '<so>', 'really', 'yes']
+
+def synthetic_segments(count: int, num_speakers: int = 4, seed: int = 0) -> tuple:
+    """ count whisper segments (start_ms, end_ms, text) and the matching diarization turns """
+    rnd = random.Random(seed)
+    segments = []
+    pos = 0
+    for _ in range(count):
+        length = rnd.randint(1000, 8000)
+        text = ' ' + ' '.join(rnd.choice(WORDS) for _ in range(length // 400 + 1)) + '.'
+        segments.append((pos, pos + length, text))
+        pos += length + rnd.randint(0, 1500)
+    diarization = []
+    turn_pos = 0
+    while turn_pos < pos:
+        length = rnd.randint(2000, 15000)
+        start = max(0, turn_pos - rnd.choice([0, 0, 0, 500]))
+        diarization.append({'start': start, 'end': start + length, 'label': f'SPEAKER_{rnd.randrange(num_speakers):02d}'})
+        turn_pos = start + length + rnd.randint(0, 800)
+    return segments, diarization
+
+# Reference implementations (before the optimization), to check that the results are unchanged
+
+def vtt_escape_loop(txt: str) -> str:
+    txt = html.escape(txt)
+    while txt.find('\n\n') > -1:
+        txt = txt.replace('\n\n', '\n')
+    return txt
+
+def html_to_webvtt_concat(parser, media_path: str):
+    vtt = 'WEBVTT '
+    paragraphs = parser.getElementsByTagName('p')
+    vtt += vtt_escape_loop(paragraphs[0].textContent) + '\n\n'
+    vtt += vtt_escape_loop('NOTE\n' + html_node_to_text(paragraphs[1])) + '\n\n'
+    vtt += f'NOTE media: {media_path}\n\n'
+    for i, segment in enumerate(parser.getElementsByTagName('a')):
+        name = segment.attributes.get('name')
+        if name:
+            name_elems = name.split('_', 4)
+            if len(name_elems) > 1 and name_elems[0] == 'ts':
+                start = transcriber.ms_to_webvtt(int(name_elems[1]))
+                end = transcriber.ms_to_webvtt(int(name_elems[2]))
+                txt = vtt_escape_loop(html_node_to_text(segment))
+                vtt += f'{i+1}\n{start} --> {end}\n<v {name_elems[3]}>{txt.lstrip()}\n\n'
+    return vtt
+
+# Benchmarked steps, each gets the prepared data of one size
+
+class Data:
+    def __init__(self, size: int, tmpdir: str):
+        self.size = size
+        self.tmpdir = tmpdir
+        self.segments, self.diarization = synthetic_segments(size)
+        self._speakers = None
+        self._html_file = None
+        self._parser = None
+        rnd = random.Random(size)
+        # text with runs of empty lines, as html_node_to_text produces them for nested paragraphs
+        self.multiline_text = ''.join(text + '\n' * rnd.choice([1, 2, 5, 40]) for _, _, text in self.segments)
+
+    @property
+    def speakers(self) -> list:
+        if self._speakers is None:
+            assigner = SpeakerAssigner(self.diarization)
+            self._speakers = [assigner.find_speaker(start, end) for start, end, _ in self.segments]
+        return self._speakers
+
+    @property
+    def html_file(self) -> str:
+        if self._html_file is None:
+            self._html_file = write_transcript(self, 'html')
+        return self._html_file
+
+    @property
+    def parser(self):
+        if self._parser is None:
+            self._parser = parse_html(self)
+        return self._parser
+
+def assign_speakers(data: Data):
+    assigner = SpeakerAssigner(data.diarization)
+    return [assigner.find_speaker(start, end) for start, end, _ in data.segments]
+
+def write_transcript(data: Data, ext: str) -> str:
+    file = os.path.join(data.tmpdir, f'transcript_{data.size}.{ext}')
+    writer = TranscriptWriter(file, 'Benchmark', 'synthetic.wav', flush_interval=10)
+    speaker = ''
+    for (start, end, text), new_speaker in zip(data.segments, data.speakers):
+        seg_html = html.escape(text)
+        if new_speaker != speaker:
+            writer.new_paragraph()
+            speaker = new_speaker
+            if ext != 'vtt':
+                seg_html = f'{speaker}:{seg_html}'
+        writer.add_segment(start, end, speaker, seg_html)
+    writer.close()
+    return file
+
+def build_dom(data: Data):
+    """ The transcript as DOM, built like noScribe did before the TranscriptWriter """
+    parser = AdvancedHTMLParser.AdvancedHTMLParser()
+    parser.parseStr(transcriber.default_html)
+    main_body = parser.createElement('div')
+    parser.body.appendChild(main_body)
+    paragraph = None
+    speaker = ''
+    for (start, end, text), new_speaker in zip(data.segments, data.speakers):
+        if paragraph is None or new_speaker != speaker:
+            speaker = new_speaker
+            paragraph = parser.createElement('p')
+            main_body.appendChild(paragraph)
+        paragraph.appendChild(parser.createElementFromHTML(f'<a name="ts_{start}_{end}_{speaker}" >{html.escape(text)}</a>'))
+    return parser
+
+def parse_html(data: Data):
+    parser = AdvancedHTMLParser.AdvancedHTMLParser()
+    with open(data.html_file, 'r', encoding='utf-8') as file:
+        parser.parseStr(file.read())
+    return parser
+
+BENCHMARKS = {
+    'assign_speakers': assign_speakers,
+    'writer_html': lambda data: write_transcript(data, 'html'),
+    'writer_txt': lambda data: write_transcript(data, 'txt'),
+    'writer_vtt': lambda data: write_transcript(data, 'vtt'),
+    'build_dom': build_dom,
+    'parse_html': parse_html,
+    'html_node_to_text': lambda data: html_node_to_text(data.parser.body),
+    'html_to_webvtt': lambda data: html_to_webvtt(data.parser, 'synthetic.wav'),
+    'vtt_escape': lambda data: vtt_escape(data.multiline_text),
+}
+
+def check_results(data: Data) -> None:
+    assert vtt_escape(data.multiline_text) == vtt_escape_loop(data.multiline_text), 'vtt_escape differs'
+    assert html_to_webvtt(data.parser, 'x') == html_to_webvtt_concat(data.parser, 'x'), 'html_to_webvtt differs'
+
+def measure(function, data: Data) -> tuple:
+    """ (seconds, peak MB) """
+    started = time.perf_counter()
+    function(data)
+    seconds = time.perf_counter() - started
+    tracemalloc.start()
+    function(data)
+    peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    tracemalloc.stop()
+    return seconds, peak
+
+def scaling_exponent(sizes: list, times: list) -> float:
+    points = [(s, t) for s, t in zip(sizes, times) if t > 0]
+    if len(points) < 2:
+        return float('nan')
+    return float(np.polyfit(np.log([s for s, _ in points]), np.log([t for _, t in points]), 1)[0])
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the transcript post-processing')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000, 50000, 200000])
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='run only these benchmarks')
+    parser.add_argument('--check', action='store_true', help='fail if a function scales worse than --max-exponent')
+    parser.add_argument('--max-exponent', type=float, default=1.3)
+    args = parser.parse_args()
+
+    names = args.only or list(BENCHMARKS)
+    results = {name: [] for name in names}
+    with TemporaryDirectory(prefix='noScribe-bench-') as tmpdir:
+        for size in args.sizes:
+            data = Data(size, tmpdir)
+            if size <= 20000:
+                check_results(data)
+            for name in names:
+                seconds, peak = measure(BENCHMARKS[name], data)
+                results[name].append(seconds)
+                print(f'{name:18s} {size:7d} segments  {seconds:9.3f}s  {seconds / size * 1e6:9.1f} us/segment  peak {peak:8.1f} MB', flush=True)
+            print()
+
+    ok = True
+    print('scaling exponent (1 = linear, 2 = quadratic):')
+    for name in names:
+        exponent = scaling_exponent(args.sizes, results[name])
+        flag = ''
+        if exponent > args.max_exponent:
+            flag = '  SUPERLINEAR'
+            ok = False
+        print(f'  {name:18s} {exponent:5.2f}{flag}')
+    if args.check and not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
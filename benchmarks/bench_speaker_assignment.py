@@ -0,0 +1,63 @@
+# Microbenchmark: speaker assignment (transcriber.SpeakerAssigner) vs. the former linear scan
+# usage: python benchmarks/bench_speaker_assignment.py [hours of audio ...]
+
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from transcriber import SpeakerAssigner
+
+def find_speaker_linear(diarization_data, transcript_start, transcript_end):
+    # The implementation used in run_transcription before the SpeakerAssigner, kept as reference
+    spkr, max_overlap = '', 0.0
+    for segment in diarization_data:
+        overlap_start = max(segment["start"], transcript_start)
+        overlap_end = min(segment["end"], transcript_end)
+        overlap_duration = overlap_end - overlap_start
+        if overlap_duration > max_overlap:
+            max_overlap = overlap_duration
+            spkr = f'S{segment["label"][8:]}'
+    return spkr
+
+def synthetic_data(hours: float, num_speakers: int = 4, seed: int = 0):
+    """ Diarization turns (2-15s, sometimes overlapping) and whisper segments (1-8s) in ms """
+    rnd = random.Random(seed)
+    duration = int(hours * 3600_000)
+    diarization = []
+    pos = 0
+    while pos < duration:
+        length = rnd.randint(2000, 15000)
+        start = max(0, pos - rnd.choice([0, 0, 0, 500, 1500])) # some overlapping speech
+        diarization.append({'start': start, 'end': start + length, 'label': f'SPEAKER_{rnd.randrange(num_speakers):02d}'})
+        pos = start + length + rnd.randint(0, 800)
+    segments = []
+    pos = 0
+    while pos < duration:
+        length = rnd.randint(1000, 8000)
+        segments.append((pos, pos + length))
+        pos += length + rnd.randint(0, 1500)
+    return diarization, segments
+
+def bench(hours: float, skip_linear: bool = False):
+    diarization, segments = synthetic_data(hours)
+
+    t0 = time.perf_counter()
+    assigner = SpeakerAssigner(diarization)
+    fast = [assigner.find_speaker(start, end) for start, end in segments]
+    t_fast = time.perf_counter() - t0
+
+    line = f'{hours:5.1f}h  {len(segments):7d} segments  {len(diarization):7d} turns  sweep: {t_fast:8.3f}s'
+    if not skip_linear:
+        t0 = time.perf_counter()
+        linear = [find_speaker_linear(diarization, start, end) for start, end in segments]
+        t_linear = time.perf_counter() - t0
+        assert fast == linear, 'SpeakerAssigner differs from the linear implementation'
+        line += f'  linear: {t_linear:8.3f}s  speedup: {t_linear / max(t_fast, 1e-9):7.1f}x'
+    print(line, flush=True)
+
+if __name__ == '__main__':
+    hours_list = [float(h) for h in sys.argv[1:]] or [0.5, 1, 2, 4, 8]
+    for hours in hours_list:
+        bench(hours, skip_linear=hours > 8)
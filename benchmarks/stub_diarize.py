@@ -0,0 +1,97 @@
+# Deterministic stand-in for 'diarize.py --worker' (same protocol, see diarize.py), used by
+# bench_pipeline.py when the pyannote models are not available. Speech is found by its energy,
+# speakers are told apart by their pitch (the synthetic voices of bench_pipeline.py only differ in pitch).
+# usage: python benchmarks/stub_diarize.py --worker cpu
+
+import os
+import sys
+import json
+import time
+import numpy as np
+import yaml
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from resources import attach_shared_memory
+
+WINDOW = 0.5 # seconds
+
+def load_audio(job: dict) -> tuple:
+    if 'shm' in job:
+        shm = attach_shared_memory(job['shm'])
+        try:
+            return np.ndarray((job['samples'],), dtype=np.float32, buffer=shm.buf).copy(), job['sample_rate']
+        finally:
+            shm.close()
+    if 'file' in job:
+        return np.fromfile(job['file'], dtype=np.float32, count=job['samples']), job['sample_rate']
+    import wave
+    with wave.open(job['audio'], 'rb') as file:
+        pcm = np.frombuffer(file.readframes(file.getnframes()), dtype=np.int16)
+        return pcm.astype(np.float32) / 32768.0, file.getframerate()
+
+def pitch_of_windows(audio: np.ndarray, sample_rate: int) -> list:
+    """ (start, end, pitch) of the voiced windows """
+    window = int(WINDOW * sample_rate)
+    windows = []
+    total = len(audio) // window
+    for i in range(total):
+        chunk = audio[i * window:(i + 1) * window]
+        if np.sqrt(np.mean(chunk ** 2)) < 0.02:
+            continue
+        spectrum = np.abs(np.fft.rfft(chunk * np.hanning(len(chunk))))
+        freqs = np.fft.rfftfreq(len(chunk), 1 / sample_rate)
+        band = (freqs >= 70) & (freqs <= 400)
+        windows.append((i * WINDOW, (i + 1) * WINDOW, float(freqs[band][np.argmax(spectrum[band])])))
+        if i % 200 == 0:
+            print(f'progress segmentation {int(i / max(total, 1) * 100)}', flush=True)
+    print('progress segmentation 100', flush=True)
+    return windows
+
+def cluster(pitches: np.ndarray, num_speakers: int) -> np.ndarray:
+    """ 1-D k-means, initialized with quantiles (deterministic) """
+    centers = np.quantile(pitches, np.linspace(0, 1, num_speakers + 2)[1:-1])
+    for _ in range(20):
+        labels = np.argmin(np.abs(pitches[:, None] - centers[None, :]), axis=1)
+        centers = np.array([pitches[labels == k].mean() if np.any(labels == k) else centers[k] for k in range(num_speakers)])
+    return np.argmin(np.abs(pitches[:, None] - centers[None, :]), axis=1)
+
+def diarize(job: dict) -> dict:
+    steps = {}
+    t0, c0 = time.perf_counter(), time.process_time()
+    audio, sample_rate = load_audio(job)
+    windows = pitch_of_windows(audio, sample_rate)
+    t1, c1 = time.perf_counter(), time.process_time()
+    steps['segmentation'] = {'wall': t1 - t0, 'cpu': c1 - c0}
+    turns = []
+    if windows:
+        num_speakers = int(job['num_speakers']) if str(job.get('num_speakers')).isdigit() else 2
+        labels = cluster(np.array([w[2] for w in windows]), min(num_speakers, len(windows)))
+        for (start, end, _), label in zip(windows, labels):
+            if turns and turns[-1]['label'] == f'SPEAKER_{label:02d}' and start - turns[-1]['end'] / 1000 <= WINDOW:
+                turns[-1]['end'] = int(end * 1000)
+            else:
+                turns.append({'start': int(start * 1000), 'end': int(end * 1000), 'label': f'SPEAKER_{label:02d}'})
+    print('progress discrete_diarization 100', flush=True)
+    steps['clustering'] = {'wall': time.perf_counter() - t1, 'cpu': time.process_time() - c1}
+    with open(job['output'], 'w') as file:
+        yaml.safe_dump(turns, file)
+    return steps
+
+def run_worker():
+    print('ready', flush=True)
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+            job_cpu = time.process_time()
+            steps = diarize(job)
+            print('metrics ' + json.dumps({'steps': steps, 'worker_cpu': time.process_time() - job_cpu,
+                                           'worker_peak_rss_mb': None}), flush=True)
+            print(f"done {job['output']}", flush=True)
+        except Exception as e:
+            print('error ' + json.dumps(str(e)), flush=True)
+
+if __name__ == '__main__':
+    run_worker()
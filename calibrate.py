@@ -0,0 +1,133 @@
+# noScribe - AI-powered Audio Transcription
+# Copyright (C) 2023 Kai Dröge
+
+# Calibration: finds the fastest number of CPU threads and compute type for each installed whisper model
+# usage: python calibrate.py <audio sample> [--models precise fast] [--device cpu] [--seconds 30]
+#
+# A part of the sample (ideally typical speech) is transcribed with the same decoding options as
+# run_transcription uses. First, the compute types are compared at the configured number of threads,
+# then the thread counts with the fastest compute type. The result is stored per model and device
+# in config.yml ('whisper_calibration') and used by run_transcription from then on
+# (set 'whisper_use_calibration: false' to ignore it).
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import gc
+import time
+import datetime
+import argparse
+
+import resources
+import transcriber
+from transcriber import get_whisper_models, decode_audio_to_buffer, save_calibration, ms_to_str, languages, number_threads
+
+compute_types = {
+    'cpu': ['int8', 'int8_float32', 'float32'],
+    'cuda': ['int8_float16', 'float16', 'int8_float32'],
+}
+
+def supported_compute_types(device: str) -> list:
+    from ctranslate2 import get_supported_compute_types
+    supported = get_supported_compute_types(device)
+    return [compute_type for compute_type in compute_types[device] if compute_type in supported]
+
+def thread_candidates(max_threads: int) -> list:
+    """ Powers of two up to max_threads, plus max_threads itself and the configured default """
+    candidates = {max_threads, min(number_threads, max_threads)}
+    threads = 1
+    while threads < max_threads:
+        candidates.add(threads)
+        threads *= 2
+    return sorted(candidates)
+
+def time_decode(model_path: str, device: str, compute_type: str, cpu_threads: int, audio, language: str, repeat: int) -> tuple:
+    """ (fastest of repeat runs in seconds, language), after a short warm-up run """
+    from faster_whisper import WhisperModel
+    model = WhisperModel(model_path, device=device, cpu_threads=cpu_threads, compute_type=compute_type, local_files_only=True)
+    try:
+        options = {'beam_size': 5, 'word_timestamps': True, 'vad_filter': False}
+        segments, info = model.transcribe(audio[:5 * transcriber.AudioBuffer.sampling_rate], language=language, **options)
+        list(segments)
+        language = language or info.language
+        best = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            segments, _ = model.transcribe(audio, language=language, **options)
+            list(segments) # the decoding runs while the generator is consumed
+            best = min(best, time.perf_counter() - started)
+        return best, language
+    finally:
+        del model
+        gc.collect()
+
+def calibrate_model(model_name: str, model_path: str, device: str, audio, language: str, max_threads: int, repeat: int) -> dict:
+    duration = len(audio) / transcriber.AudioBuffer.sampling_rate
+    results = {}
+    def measure(compute_type, threads):
+        nonlocal language
+        seconds, language = time_decode(model_path, device, compute_type, threads, audio, language, repeat)
+        results[(compute_type, threads)] = seconds
+        print(f'  {model_name:12s} {compute_type:13s} {threads:3d} threads  {seconds:7.2f}s  (real-time factor {seconds / duration:.3f})', flush=True)
+
+    start_threads = min(number_threads, max_threads)
+    for compute_type in supported_compute_types(device):
+        measure(compute_type, start_threads)
+    best_type = min(results, key=results.get)[0]
+    if device == 'cpu':
+        for threads in thread_candidates(max_threads):
+            if (best_type, threads) not in results:
+                measure(best_type, threads)
+    compute_type, cpu_threads = min(results, key=results.get)
+    return {
+        'compute_type': compute_type,
+        'cpu_threads': cpu_threads,
+        'rtf': round(results[(compute_type, cpu_threads)] / duration, 4),
+        'cpu_count': resources.cpu_limit(),
+        'date': datetime.date.today().isoformat(),
+    }
+
+def main():
+    whisper_models = get_whisper_models()
+    parser = argparse.ArgumentParser(description='Find the fastest cpu_threads/compute_type for the whisper models')
+    parser.add_argument('audio_file', help='audio sample, ideally typical speech')
+    parser.add_argument('--models', nargs='+', choices=list(whisper_models), default=list(whisper_models))
+    parser.add_argument('--device', default='cpu', choices=list(compute_types))
+    parser.add_argument('--seconds', type=int, default=30, help='length of the sample that is transcribed')
+    parser.add_argument('--language', default='Auto', choices=list(languages.keys()))
+    parser.add_argument('--max-threads', type=int, default=resources.cpu_limit())
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--dry-run', action='store_true', help='only print the results, do not change config.yml')
+    args = parser.parse_args()
+
+    buffer = decode_audio_to_buffer(args.audio_file, '00:00:00', ms_to_str(args.seconds * 1000))
+    try:
+        audio = buffer.array.copy()
+    finally:
+        buffer.close()
+    language = languages[args.language]
+    language = None if language in ('auto', 'multilingual') else language
+
+    for model_name in args.models:
+        print(f'Calibrating "{model_name}" on {args.device} with {len(audio) / transcriber.AudioBuffer.sampling_rate:.0f}s of audio...', flush=True)
+        calibration = calibrate_model(model_name, whisper_models[model_name], args.device, audio, language,
+                                      args.max_threads, args.repeat)
+        print(f'Fastest: {calibration["compute_type"]}, {calibration["cpu_threads"]} threads '
+              f'(real-time factor {calibration["rtf"]}).', flush=True)
+        if not args.dry_run:
+            save_calibration(model_name, args.device, calibration)
+    if not args.dry_run:
+        print(f'Saved in {transcriber.config_file}.')
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,16 @@
 # ported to MAC by Philipp Schneider (gernophil)
 
 # Diarization with PyAnnote (https://github.com/pyannote/pyannote-audio)
-# usage: python diarize.py <device['cpu', 'mps']> <audio file> <output yaml-file>
+# usage: python diarize.py <device['cpu', 'mps']> <audio file> <output yaml-file> <num speakers|auto>
+#    or: python diarize.py --worker <device['cpu', 'mps']>
+# In worker mode, the pipeline is loaded only once. Jobs are read from stdin, one JSON object per line:
+#     {"audio": "<audio file>", "output": "<output yaml-file>", "num_speakers": "<num speakers|auto>", "threads": <torch threads>}
+# Instead of "audio", a job may reference already decoded audio (16 kHz mono float32) in shared memory:
+#     "shm": "<shared memory name>", "samples": <number of samples>, "sample_rate": 16000
+# or, if it did not fit into shared memory, in a file of raw float32 samples: "file": "<path>" instead of "shm"
+# Progress is reported as 'progress <step> <pct>' lines, every job ends with a line 'done <output yaml-file>'
+# or 'error <message as JSON string>'. Before 'done', a line 'metrics <json>' reports the wall/CPU time of the pipeline steps
+# and the peak memory of the worker.
 
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -25,22 +34,21 @@ from pyannote.audio import Pipeline
 import torch
 from typing import Any, Mapping, Optional, Text
 import sys
+import json
+import time
+import numpy as np
+from resources import attach_shared_memory
 from pathlib import Path
 from tempfile import TemporaryDirectory
     
 app_dir = os.path.abspath(os.path.dirname(__file__))
-os.chdir(app_dir)
 
-device = sys.argv[1]
-audio_file = sys.argv[2]
-segments_yaml = sys.argv[3]
-if sys.argv[4].isdigit():
-    my_num_speakers = int(sys.argv[4])
-else:
-    my_num_speakers = None
+# The clustering has no hook call of its own, it runs before the discrete diarization step
+step_labels = {'discrete_diarization': 'clustering'}
 
 class SimpleProgressHook:
     #Hook to show progress of each internal step
+    #The time of a step is measured from the last call of the previous step to the last call of this step
     def __init__(self, parent, transient: bool = False):
         super().__init__()
         self.parent = parent
@@ -48,6 +56,9 @@ class SimpleProgressHook:
 
     def __enter__(self):
         self.progress = 0
+        self.steps = {}
+        self.last_time = (time.perf_counter(), time.process_time())
+        self.step_start = self.last_time
         return self
 
     def __exit__(self, *args):
@@ -66,15 +77,18 @@ class SimpleProgressHook:
 
         if not hasattr(self, 'step_name') or step_name != self.step_name:
             self.step_name = step_name
+            self.step_start = self.last_time
+        now = (time.perf_counter(), time.process_time())
+        self.steps[step_labels.get(step_name, step_name)] = {'wall': now[0] - self.step_start[0],
+                                                             'cpu': now[1] - self.step_start[1]}
+        self.last_time = now
         
         progress_percent = int(completed/total*100)
         if progress_percent > 100:
             progress_percent = 100
         print(f'progress {step_name} {progress_percent}', flush=True)
-        
-# Start Diarization:
 
-try:     
+def load_pipeline(device: str):
     if platform.system() == 'Windows':
         pipeline = Pipeline.from_pretrained(os.path.join(app_dir, 'pyannote', 'pyannote_config.yaml'))
         pipeline.to(torch.device(device))
@@ -96,8 +110,41 @@ try:
 
         pipeline = Pipeline.from_pretrained(os.path.join(tmpdir.name, 'pyannote_config_macOS.yaml'))
         pipeline.to(torch.device(device))
+        tmpdir.cleanup()
     else:
         raise Exception('Platform not supported yet.')
+    return pipeline
+
+def reset_peak_rss():
+    # Linux only: resets the peak resident memory (VmHWM) of this process
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource # peak of the whole lifetime of the worker
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / (1024 * 1024) if platform.system() == 'Darwin' else maxrss / 1024
+    except ImportError:
+        return None
+
+def diarize(pipeline, audio_file, segments_yaml: str, num_speakers: str) -> dict:
+    # audio_file: path or a pyannote waveform dict {'waveform': (channel, time) tensor, 'sample_rate': int}
+    # returns the wall/CPU time of the pipeline steps
+    if str(num_speakers).isdigit():
+        my_num_speakers = int(num_speakers)
+    else:
+        my_num_speakers = None
 
     with SimpleProgressHook(parent=None) as hook:
         if my_num_speakers is not None:
@@ -114,7 +161,59 @@ try:
             
     with open(segments_yaml, 'w') as filestream:
         yaml.safe_dump(seg_list, filestream)
-
-except Exception as e:
-    print('error ', e, file=sys.stderr)
-    sys.exit(1) # return error code
\ No newline at end of file
+    return hook.steps
+
+def run_worker(device: str):
+    # set by the transcriber according to the CPU limit, must be set before torch runs anything in parallel
+    if os.environ.get('NOSCRIBE_TORCH_INTEROP_THREADS'):
+        torch.set_num_interop_threads(int(os.environ['NOSCRIBE_TORCH_INTEROP_THREADS']))
+    pipeline = load_pipeline(device)
+    print('ready', flush=True)
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            job = json.loads(line)
+            reset_peak_rss()
+            job_cpu = time.process_time()
+            if job.get('threads'):
+                torch.set_num_threads(int(job['threads']))
+            if 'shm' in job:
+                shm = attach_shared_memory(job['shm'])
+                try:
+                    samples = np.ndarray((job['samples'],), dtype=np.float32, buffer=shm.buf)
+                    audio = {'waveform': torch.from_numpy(samples).unsqueeze(0), 'sample_rate': job['sample_rate']}
+                    steps = diarize(pipeline, audio, job['output'], job.get('num_speakers', 'auto'))
+                finally:
+                    audio = samples = None
+                    try:
+                        shm.close()
+                    except BufferError:
+                        pass
+            elif 'file' in job: # the audio did not fit into shared memory
+                samples = np.memmap(job['file'], dtype=np.float32, mode='r+', shape=(job['samples'],))
+                try:
+                    audio = {'waveform': torch.from_numpy(samples).unsqueeze(0), 'sample_rate': job['sample_rate']}
+                    steps = diarize(pipeline, audio, job['output'], job.get('num_speakers', 'auto'))
+                finally:
+                    audio = samples = None
+            else:
+                steps = diarize(pipeline, job['audio'], job['output'], job.get('num_speakers', 'auto'))
+            print('metrics ' + json.dumps({'steps': steps, 'worker_cpu': time.process_time() - job_cpu,
+                                           'worker_peak_rss_mb': peak_rss_mb()}), flush=True)
+            print(f"done {job['output']}", flush=True)
+        except Exception as e:
+            print('error ' + json.dumps(str(e)), flush=True) # one line, even if the message has several
+
+if __name__ == '__main__':
+    os.chdir(app_dir)
+    try:     
+        if sys.argv[1] == '--worker':
+            run_worker(sys.argv[2])
+        else:
+            pipeline = load_pipeline(sys.argv[1])
+            diarize(pipeline, sys.argv[2], sys.argv[3], sys.argv[4])
+    except Exception as e:
+        print('error ', e, file=sys.stderr)
+        sys.exit(1) # return error code
@@ -0,0 +1,126 @@
+# noScribe - AI-powered Audio Transcription
+# Copyright (C) 2023 Kai Dröge
+
+# Persistent job list of the Telegram bot (SQLite in the config directory, which is a docker volume).
+# Every job records its state and the last completed stage with its files, so that after a restart
+# unfinished jobs continue where they stopped: a downloaded video is not downloaded again, and the
+# transcription itself continues from its checkpoint (see TranscriptionCheckpoint in transcriber.py).
+# Several chats can wait for the same job (the same video requested again while it is transcribed),
+# they are listed in job_chats.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import sqlite3
+import threading
+
+# state: queued -> running -> finished | canceled | failed
+# stage (last completed): new -> downloaded -> transcribed -> sent
+unfinished_states = ('queued', 'running')
+
+class JobStore:
+    """ Jobs of the bot in an SQLite database. All methods may be called from any thread. """
+
+    columns = ('id', 'chat_id', 'video_url', 'video_id', 'state', 'stage', 'audio_file', 'transcript_file',
+               'attempts', 'error', 'created', 'updated')
+
+    def __init__(self, db_file: str):
+        os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute('PRAGMA journal_mode=WAL') # a crash never leaves a half-written job
+            self._db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                video_url TEXT NOT NULL,
+                video_id TEXT,
+                state TEXT NOT NULL DEFAULT 'queued',
+                stage TEXT NOT NULL DEFAULT 'new',
+                audio_file TEXT,
+                transcript_file TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL)''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS job_chats (
+                job_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                PRIMARY KEY (job_id, chat_id))''')
+
+    def add(self, chat_id: int, video_url: str) -> int:
+        now = time.time()
+        with self._lock, self._db:
+            cursor = self._db.execute('INSERT INTO jobs (chat_id, video_url, created, updated) VALUES (?, ?, ?, ?)',
+                                      (chat_id, video_url, now, now))
+            self._db.execute('INSERT INTO job_chats (job_id, chat_id) VALUES (?, ?)', (cursor.lastrowid, chat_id))
+            return cursor.lastrowid
+
+    def attach(self, job_id: int, chat_id: int) -> None:
+        """ Another chat waits for the result of the job as well """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR IGNORE INTO job_chats (job_id, chat_id) VALUES (?, ?)', (job_id, chat_id))
+
+    def detach(self, job_id: int, chat_id: int) -> None:
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM job_chats WHERE job_id = ? AND chat_id = ?', (job_id, chat_id))
+
+    def _chats(self, record: dict) -> dict:
+        """ Adds the list of waiting chats to a job record (jobs recorded by older versions: only its own chat) """
+        rows = self._db.execute('SELECT chat_id FROM job_chats WHERE job_id = ? ORDER BY rowid', (record['id'],)).fetchall()
+        record['chat_ids'] = [row[0] for row in rows] or [record['chat_id']]
+        return record
+
+    def update(self, job_id: int, **fields) -> None:
+        """ e.g. update(id, stage='downloaded', audio_file=path) """
+        unknown = set(fields) - set(self.columns)
+        if unknown:
+            raise ValueError(f'Unknown job fields: {", ".join(sorted(unknown))}')
+        fields['updated'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        with self._lock, self._db:
+            self._db.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*fields.values(), job_id))
+
+    def start(self, job_id: int) -> int:
+        """ Marks the job as running, returns the number of times it was started (including this one) """
+        with self._lock, self._db:
+            self._db.execute("UPDATE jobs SET state = 'running', attempts = attempts + 1, updated = ? WHERE id = ?",
+                             (time.time(), job_id))
+            return self._db.execute('SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+
+    def get(self, job_id: int) -> dict:
+        with self._lock:
+            row = self._db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            return self._chats(dict(row)) if row is not None else None
+
+    def unfinished(self) -> list:
+        """ Jobs that were queued or running when the bot stopped, oldest first """
+        with self._lock:
+            rows = self._db.execute(f'SELECT * FROM jobs WHERE state IN ({", ".join("?" * len(unfinished_states))}) ORDER BY id',
+                                    unfinished_states).fetchall()
+            return [self._chats(dict(row)) for row in rows]
+
+    def remove_old(self, max_age_days: float = 30) -> None:
+        """ Forgets finished, canceled and failed jobs after max_age_days """
+        with self._lock, self._db:
+            self._db.execute(f'DELETE FROM jobs WHERE state NOT IN ({", ".join("?" * len(unfinished_states))}) AND updated < ?',
+                             (*unfinished_states, time.time() - max_age_days * 86400))
+            self._db.execute('DELETE FROM job_chats WHERE job_id NOT IN (SELECT id FROM jobs)')
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -37,19 +37,12 @@ from subprocess import run, call, Popen, PIPE, STDOUT
 if platform.system() == 'Windows':
     # import torch.cuda # to check with torch.cuda.is_available()
     from subprocess import STARTUPINFO, STARTF_USESHOWWINDOW
-if platform.system() in ("Windows", "Linux"):
-    from ctranslate2 import get_cuda_device_count
-    import torch
 import re
 if platform.system() == "Darwin": # = MAC
     from subprocess import check_output
     if platform.machine() == "x86_64":
         os.environ['KMP_DUPLICATE_LIB_OK']='True' # prevent OMP: Error #15: Initializing libomp.dylib, but found libiomp5.dylib already initialized.
     # import torch.backends.mps # loading torch modules leads to segmentation fault later
-from faster_whisper.audio import decode_audio
-from faster_whisper.vad import VadOptions, get_speech_timestamps
-import AdvancedHTMLParser
-import html
 from threading import Thread
 import time
 from tempfile import TemporaryDirectory
@@ -67,7 +60,8 @@ import urllib
 import multiprocessing
 import gc
 import traceback
-from transcriber import run_transcription, get_whisper_models as get_transcriber_whisper_models
+from transcriber import run_transcription, CancellationToken, TranscriptionCanceled, warm_up, get_whisper_models as get_transcriber_whisper_models
+import resources
 
 # Pyinstaller fix, used to open multiple instances on Mac
 multiprocessing.freeze_support()
@@ -252,7 +246,7 @@ config['locale'] = app_locale
 if platform.system() == 'Windows':
     number_threads = get_config('threads', cpufeature.CPUFeature["num_physical_cores"])
 elif platform.system() == "Linux":
-    number_threads = get_config('threads', os.cpu_count() if os.cpu_count() is not None else 4)
+    number_threads = get_config('threads', resources.cpu_limit())
 elif platform.system() == "Darwin": # = MAC
     if platform.machine() == "arm64":
         cpu_count = int(check_output(["sysctl", "-n", "hw.perflevel0.logicalcpu_max"]))
@@ -295,81 +289,6 @@ def iter_except(function, exception):
         except exception:
             return
         
-# Helper for text only output
-        
-def html_node_to_text(node: AdvancedHTMLParser.AdvancedTag) -> str:
-    """
-    Recursively get all text from a html node and its children. 
-    """
-    # For text nodes, return their value directly
-    if AdvancedHTMLParser.isTextNode(node): # node.nodeType == node.TEXT_NODE:
-        return html.unescape(node)
-    # For element nodes, recursively process their children
-    elif AdvancedHTMLParser.isTagNode(node):
-        text_parts = []
-        for child in node.childBlocks:
-            text = html_node_to_text(child)
-            if text:
-                text_parts.append(text)
-        # For block-level elements, prepend and append newlines
-        if node.tagName.lower() in ['p', 'div', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br']:
-            if node.tagName.lower() == 'br':
-                return '\n'
-            else:
-                return '\n' + ''.join(text_parts).strip() + '\n'
-        else:
-            return ''.join(text_parts)
-    else:
-        return ''
-
-def html_to_text(parser: AdvancedHTMLParser.AdvancedHTMLParser) -> str:
-    return html_node_to_text(parser.body)
-
-# Helper for WebVTT output
-
-def vtt_escape(txt: str) -> str:
-    txt = html.escape(txt)
-    while txt.find('\n\n') > -1:
-        txt = txt.replace('\n\n', '\n')
-    return txt    
-
-def ms_to_webvtt(milliseconds) -> str:
-    """converts milliseconds to the time stamp of WebVTT (HH:MM:SS.mmm)
-    """
-    # 1 hour = 3600000 milliseconds
-    # 1 minute = 60000 milliseconds
-    # 1 second = 1000 milliseconds
-    hours, milliseconds = divmod(milliseconds, 3600000)
-    minutes, milliseconds = divmod(milliseconds, 60000)
-    seconds, milliseconds = divmod(milliseconds, 1000)
-    return "{:02d}:{:02d}:{:02d}.{:03d}".format(hours, minutes, seconds, milliseconds)
-
-def html_to_webvtt(parser: AdvancedHTMLParser.AdvancedHTMLParser, media_path: str):
-    vtt = 'WEBVTT '
-    paragraphs = parser.getElementsByTagName('p')
-    # The first paragraph contains the title
-    vtt += vtt_escape(paragraphs[0].textContent) + '\n\n'
-    # Next paragraph contains info about the transcript. Add as a note.
-    vtt += vtt_escape('NOTE\n' + html_node_to_text(paragraphs[1])) + '\n\n'
-    # Add media source:
-    vtt += f'NOTE media: {media_path}\n\n'
-
-    #Add all segments as VTT cues
-    segments = parser.getElementsByTagName('a')
-    i = 0
-    for i in range(len(segments)):
-        segment = segments[i]
-        name = segment.attributes['name']
-        if name is not None:
-            name_elems = name.split('_', 4)
-            if len(name_elems) > 1 and name_elems[0] == 'ts':
-                start = ms_to_webvtt(int(name_elems[1]))
-                end = ms_to_webvtt(int(name_elems[2]))
-                spkr = name_elems[3]
-                txt = vtt_escape(html_node_to_text(segment))
-                vtt += f'{i+1}\n{start} --> {end}\n<v {spkr}>{txt.lstrip()}\n\n'
-    return vtt
-    
 class TimeEntry(ctk.CTkEntry): # special Entry box to enter time in the format hh:mm:ss
                                # based on https://stackoverflow.com/questions/63622880/how-to-make-python-automatically-put-colon-in-the-format-of-time-hhmmss
     def __init__(self, master, **kwargs):
@@ -415,6 +334,8 @@ class App(ctk.CTk):
         self.transcript_file = ''
         self.log_file = None
         self.cancel = False # if set to True, transcription will be canceled
+        self.cancel_token = None # CancellationToken of the running transcription
+        self.stage_eta = {} # remaining time of the running stages (see set_progress)
 
         # configure window
         self.title('noScribe - ' + t('app_header'))
@@ -680,22 +601,32 @@ class App(ctk.CTk):
         self.logn('https://github.com/kaixxx/noScribe', link='https://github.com/kaixxx/noScribe#readme')
         self.logn(t('welcome_instructions'))
         
-        # check for new releases
+        # check for new releases (in the background, the window should not wait for the network)
         if get_config('check_for_update', 'True') == 'True':
-            try:
-                latest_release = json.loads(urllib.request.urlopen(
-                    urllib.request.Request('https://api.github.com/repos/kaixxx/noScribe/releases/latest',
-                    headers={'Accept': 'application/vnd.github.v3+json'},),
-                    timeout=2).read())
-                latest_release_version = str(latest_release['tag_name']).lstrip('v')
-                if version_higher(latest_release_version, app_version) == 1:
-                    self.logn(t('new_release', v=latest_release_version), 'highlight')
-                    self.logn(str(latest_release['body'])) # release info
-                    self.log(t('new_release_download'))
-                    self.logn(str(latest_release['html_url']), link=str(latest_release['html_url']))
-                    self.logn()
-            except:
-                pass
+            Thread(target=self.check_for_update, daemon=True).start()
+
+        # import the transcription libraries in the background while the user selects the files
+        if get_config('warm_up', True):
+            self.after(500, warm_up)
+
+    def check_for_update(self):
+        try:
+            latest_release = json.loads(urllib.request.urlopen(
+                urllib.request.Request('https://api.github.com/repos/kaixxx/noScribe/releases/latest',
+                headers={'Accept': 'application/vnd.github.v3+json'},),
+                timeout=2).read())
+            latest_release_version = str(latest_release['tag_name']).lstrip('v')
+            if version_higher(latest_release_version, app_version) == 1:
+                self.after(0, self.show_new_release, latest_release, latest_release_version)
+        except:
+            pass
+
+    def show_new_release(self, latest_release, latest_release_version):
+        self.logn(t('new_release', v=latest_release_version), 'highlight')
+        self.logn(str(latest_release['body'])) # release info
+        self.log(t('new_release_download'))
+        self.logn(str(latest_release['html_url']), link=str(latest_release['html_url']))
+        self.logn()
             
     # Events and Methods
 
@@ -858,31 +789,21 @@ class App(ctk.CTk):
             self.button_transcript_file_name.configure(text=os.path.basename(self.transcript_file))
             config['last_filetype'] = os.path.splitext(self.transcript_file)[1][1:]
             
-    def set_progress(self, step, value):
-        """ Update state of the progress bar """
-        progr = -1
-        if step == 1:
-            progr = value * 0.05 / 100
-        elif step == 2:
-            progr = 0.05 # (step 1)
-            progr = progr + (value * 0.45 / 100)
-        elif step == 3:
-            if self.speaker_detection != 'none':
-                progr = 0.05 + 0.45 # (step 1 + step 2)
-                progr_factor = 0.5
-            else:
-                progr = 0.05 # (step 1)
-                progr_factor = 0.95
-            progr = progr + (value * progr_factor / 100)
-        if progr >= 1:
-            progr = 0.99 # whisper sometimes still needs some time to finish even if the progress is already at 100%. This can be confusing, so we never go above 99%...
-
-        # Update progress_textbox
-        if progr < 0:
+    def set_progress(self, event=None):
+        """ Update state of the progress bar from a transcriber.ProgressEvent (None to hide it) """
+        if event is None:
+            self.stage_eta = {}
             progr_str = ''
         else:
-            progr_str = f'({t("overall_progress")}{round(progr * 100)}%)'
-        self.progress_textbox.configure(state=ctk.NORMAL)        
+            # several stages can run at the same time, show the longest remaining time
+            self.stage_eta[event.stage] = event.eta
+            progr = min(event.progress, 0.99) # writing the transcript still needs some time at 100%
+            progr_str = f'({t("overall_progress")}{round(progr * 100)}%'
+            etas = [eta for eta in self.stage_eta.values() if eta is not None]
+            if etas and max(etas) > 0:
+                progr_str += f', {t("remaining_time")}{ms_to_str(max(etas) * 1000)}'
+            progr_str += ')'
+        self.progress_textbox.configure(state=ctk.NORMAL)
         self.progress_textbox.delete('1.0', tk.END)
         self.progress_textbox.insert(tk.END, progr_str)
         self.progress_textbox.configure(state=ctk.DISABLED)
@@ -896,6 +817,7 @@ class App(ctk.CTk):
         # We put this in a seperate thread so that it does not block the main ui
 
         self.cancel = False
+        self.cancel_token = CancellationToken()
 
         # Show the stop button
         self.start_button.pack_forget() # hide
@@ -933,6 +855,9 @@ class App(ctk.CTk):
                 # Ensure we are running in the main thread for UI updates
                 self.after(0, self.logn, message, tags)
 
+            def progress_callback(event):
+                self.after(0, self.set_progress, event)
+
 
             run_transcription(
                 audio_file=self.audio_file,
@@ -946,7 +871,9 @@ class App(ctk.CTk):
                 timestamps=timestamps,
                 disfluencies=disfluencies,
                 pause_option=pause_option,
-                log_callback=log_callback
+                log_callback=log_callback,
+                cancel=self.cancel_token,
+                progress_callback=progress_callback
             )
 
             # auto open transcript in editor
@@ -956,6 +883,10 @@ class App(ctk.CTk):
                 self.launch_editor(self.transcript_file)
 
 
+        except TranscriptionCanceled:
+            self.logn(t('err_user_cancelation'), 'highlight')
+            return
+
         except Exception as e:
             self.logn(t('err_options'), 'error')
             traceback_str = traceback.format_exc()
@@ -968,7 +899,7 @@ class App(ctk.CTk):
             self.start_button.pack(padx=[20, 0], pady=[20,30], expand=False, fill='x', anchor='sw')
 
             # hide progress
-            self.set_progress(0, 0)
+            self.after(0, self.set_progress, None)
             
     def button_start_event(self):
         wkr = Thread(target=self.transcription_worker)
@@ -986,6 +917,8 @@ class App(ctk.CTk):
             self.logn(t('start_canceling'))
             self.update()
             self.cancel = True
+            if self.cancel_token is not None:
+                self.cancel_token.cancel()
 
     def on_closing(self):
         # (see: https://stackoverflow.com/questions/111155/how-do-i-handle-the-window-close-event-in-tkinter)
@@ -0,0 +1,260 @@
+# noScribe - AI-powered Audio Transcription
+# Copyright (C) 2023 Kai Dröge
+
+# CPU and memory budget of the process. In a container, os.cpu_count() and /proc/meminfo show the
+# whole host; the limits set with docker --cpus/--memory (cgroup v1 or v2) are read here instead.
+# The thread counts for ctranslate2 (whisper), torch (pyannote) and ffmpeg are derived from the
+# CPU limit and divided between stages that run at the same time.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import math
+import platform
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from subprocess import check_output
+
+cgroup_root = '/sys/fs/cgroup'
+
+# cgroup
+
+def _cgroup_paths() -> dict:
+    """ controller -> path of this process in its hierarchy ('' = cgroup v2) """
+    paths = {}
+    try:
+        with open('/proc/self/cgroup', 'r') as file:
+            for line in file:
+                _, controllers, path = line.rstrip('\n').split(':', 2)
+                for controller in controllers.split(','):
+                    paths[controller] = path
+    except (OSError, ValueError):
+        pass
+    return paths
+
+def _cgroup_files(controller: str, filename: str) -> list:
+    """ Existing files of the cgroup of this process and of all its parents (limits of a parent apply as well).
+    Inside a container, the own cgroup is usually mounted as the root, so the root is always included. """
+    paths = _cgroup_paths()
+    if controller:
+        base = os.path.join(cgroup_root, controller)
+        if not os.path.isdir(base) and controller == 'cpu':
+            base = os.path.join(cgroup_root, 'cpu,cpuacct')
+    else:
+        base = cgroup_root if os.path.exists(os.path.join(cgroup_root, 'cgroup.controllers')) else os.path.join(cgroup_root, 'unified')
+    path = paths.get(controller, '/')
+    files = []
+    while True:
+        file = os.path.join(base, path.strip('/'), filename)
+        if os.path.isfile(file) and file not in files:
+            files.append(file)
+        if path in ('', '/'):
+            break
+        path = os.path.dirname(path.rstrip('/'))
+    root_file = os.path.join(base, filename)
+    if os.path.isfile(root_file) and root_file not in files:
+        files.append(root_file)
+    return files
+
+def _read(file: str) -> str:
+    try:
+        with open(file, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+def cgroup_cpu_limit() -> float:
+    """ CPU quota in cores (e.g. 2.5 for docker --cpus 2.5), None if unlimited """
+    limits = []
+    for file in _cgroup_files('', 'cpu.max'): # v2: '<quota> <period>' or 'max <period>'
+        fields = _read(file).split()
+        if len(fields) == 2 and fields[0] != 'max':
+            limits.append(int(fields[0]) / int(fields[1]))
+    for file in _cgroup_files('cpu', 'cpu.cfs_quota_us'): # v1
+        quota = int(_read(file) or -1)
+        period = int(_read(os.path.join(os.path.dirname(file), 'cpu.cfs_period_us')) or 0)
+        if quota > 0 and period > 0:
+            limits.append(quota / period)
+    return min(limits) if limits else None
+
+def cgroup_memory_limit_mb() -> float:
+    """ Memory limit in MB (docker --memory), None if unlimited """
+    limits = []
+    for file in _cgroup_files('', 'memory.max'): # v2
+        value = _read(file)
+        if value.isdigit():
+            limits.append(int(value))
+    for file in _cgroup_files('memory', 'memory.limit_in_bytes'): # v1, 'unlimited' is a huge number
+        value = _read(file)
+        if value.isdigit() and int(value) < 1 << 60:
+            limits.append(int(value))
+    return min(limits) / (1024 * 1024) if limits else None
+
+def cgroup_memory_usage_mb() -> float:
+    """ Memory used by the cgroup without the reclaimable page cache (as shown by docker stats), None if unknown """
+    for files, stat_name in ((_cgroup_files('', 'memory.current'), 'inactive_file'), # v2
+                             (_cgroup_files('memory', 'memory.usage_in_bytes'), 'total_inactive_file')): # v1
+        if files:
+            usage = int(_read(files[0]) or 0)
+            stat = _read(os.path.join(os.path.dirname(files[0]), 'memory.stat'))
+            match = re.search(rf'^{stat_name} (\d+)$', stat, re.MULTILINE)
+            if match:
+                usage -= int(match.group(1))
+            return max(0, usage) / (1024 * 1024)
+    return None
+
+# CPU
+
+def cpu_limit() -> int:
+    """ Number of CPUs this process may use: the CPU affinity (taskset, docker --cpuset-cpus)
+    and the cgroup quota (docker --cpus, rounded up), at least 1 """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError: # Windows, macOS
+        cpus = os.cpu_count() or 4
+    if platform.system() == 'Linux':
+        quota = cgroup_cpu_limit()
+        if quota is not None:
+            cpus = min(cpus, math.ceil(quota))
+    return max(1, cpus)
+
+def split_threads(total: int, shares: dict) -> dict:
+    """ Divides total threads between stages running at the same time, according to their shares
+    (e.g. {'whisper': 0.5, 'diarization': 0.5}). Every stage gets at least one thread. """
+    if len(shares) == 1:
+        return {name: max(1, total) for name in shares}
+    if total <= len(shares):
+        return {name: 1 for name in shares}
+    share_sum = sum(shares.values()) or 1
+    threads = {name: max(1, math.floor(total * share / share_sum)) for name, share in shares.items()}
+    # the threads lost by rounding down go to the stages with the largest share
+    for name in sorted(shares, key=shares.get, reverse=True):
+        if sum(threads.values()) >= total:
+            break
+        threads[name] += 1
+    return threads
+
+def torch_threads(threads: int) -> tuple:
+    """ (intra-op, inter-op) threads for torch: the inter-op pool only runs independent operators
+    in parallel, which pyannote hardly uses, so it gets a small part """
+    return max(1, threads), max(1, min(2, threads // 4))
+
+def ffmpeg_threads(threads: int) -> int:
+    """ Audio decoding profits little from more than a few threads """
+    return max(1, min(4, threads))
+
+def thread_env(threads: int) -> dict:
+    """ Environment variables that limit the OpenMP/BLAS thread pools of a child process """
+    value = str(max(1, threads))
+    return {'OMP_NUM_THREADS': value, 'MKL_NUM_THREADS': value, 'OPENBLAS_NUM_THREADS': value}
+
+# Memory
+
+def system_available_memory_mb() -> float:
+    """ Memory of the machine that is available for new allocations (0 if unknown) """
+    try:
+        if platform.system() == 'Linux':
+            with open('/proc/meminfo', 'r') as file:
+                for line in file:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) / 1024
+        elif platform.system() == 'Windows':
+            import ctypes
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                            ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                            ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                            ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                            ('sullAvailExtendedVirtual', ctypes.c_ulonglong)]
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+            return status.ullAvailPhys / (1024 * 1024)
+        elif platform.system() == 'Darwin':
+            # free + inactive pages
+            vm_stat = check_output(['vm_stat']).decode()
+            page_size = int(re.search(r'page size of (\d+) bytes', vm_stat).group(1))
+            pages = sum(int(m) for m in re.findall(r'Pages (?:free|inactive):\s+(\d+)', vm_stat))
+            return pages * page_size / (1024 * 1024)
+    except Exception:
+        pass
+    return 0
+
+def available_memory_mb() -> float:
+    """ Memory that is available for new allocations, within the cgroup limit if there is one (0 if unknown) """
+    available = system_available_memory_mb()
+    if platform.system() == 'Linux':
+        limit = cgroup_memory_limit_mb()
+        if limit is not None:
+            usage = cgroup_memory_usage_mb() or 0
+            available = min(available, limit - usage) if available > 0 else limit - usage
+    return max(0, available)
+
+def memory_limit_mb() -> float:
+    """ Total memory this process may use (cgroup limit or physical memory), None if unknown """
+    if platform.system() == 'Linux':
+        limit = cgroup_memory_limit_mb()
+        if limit is not None:
+            return limit
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def current_rss_mb(pid: int = None) -> float:
+    """ Resident memory of a process (default: this one) in MB, None if unknown """
+    try:
+        if platform.system() == 'Linux':
+            with open(f'/proc/{pid or "self"}/statm', 'r') as file:
+                return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+        elif platform.system() == 'Windows' and pid is None:
+            import ctypes
+            from ctypes import wintypes
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                            ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                            ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+            ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                     ctypes.byref(counters), counters.cb)
+            return counters.WorkingSetSize / (1024 * 1024)
+        elif pid is None:
+            # macOS: only the peak of the whole process is available (in bytes)
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024)
+    except Exception:
+        pass
+    return None
+
+# Shared memory
+
+def attach_shared_memory(name: str) -> SharedMemory:
+    # Only the creator of the shared memory may unlink it, not a process that just attaches to it
+    try:
+        return SharedMemory(name=name, track=False) # python >= 3.13
+    except TypeError:
+        shm = SharedMemory(name=name)
+        # multiprocessing children share the resource tracker of their parent, no need to unregister there
+        if os.name == 'posix' and multiprocessing.parent_process() is None:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def summary() -> str:
+    limit = memory_limit_mb()
+    return f'{cpu_limit()} CPUs, memory limit {f"{limit:.0f} MB" if limit else "unknown"}, available {available_memory_mb():.0f} MB'
@@ -1,10 +1,18 @@
 # This file will contain the Telegram bot logic.
 import os
+import re
+import asyncio
+import functools
 import logging
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
-import yt_dlp
-from transcriber import run_transcription
+from transcriber import run_transcription, get_config, config_dir, ms_to_str, warm_up, CancellationToken, TranscriptionCanceled, StageCache, \
+    number_threads
+from job_store import JobStore
+import resources
 
 # Setup logging
 logging.basicConfig(
@@ -13,6 +21,107 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Job queue: handlers only enqueue the request and answer right away. bot_workers jobs are processed
+# at the same time (download, then transcription); of these, at most bot_concurrent_transcriptions
+# transcribe at once, so the next download overlaps the running transcription. The blocking work
+# runs in a thread pool, the event loop stays free for other chats.
+# Jobs, their stage and their files are recorded in the config directory (a volume in docker), so that
+# unfinished jobs continue after a restart of the bot.
+# With bot_progressive, the transcription starts while the audio is still downloading.
+# A video is only transcribed once: a request for a video that is already waiting or running joins that
+# job, and finished transcripts are kept in a result cache (bounded by bot_result_cache_mb).
+
+bot_dir = os.path.join(config_dir, 'bot')
+downloads_dir = os.path.join(bot_dir, 'downloads')
+transcripts_dir = os.path.join(bot_dir, 'transcripts')
+job_store = JobStore(os.path.join(bot_dir, 'jobs.sqlite'))
+result_cache = StageCache(os.path.join(bot_dir, 'results'), max_size_mb=float(get_config('bot_result_cache_mb', 100)))
+
+# For the bot, we'll use a default set of parameters
+transcription_options = {
+    'language_name': 'Auto',
+    'whisper_model_name': 'precise', # or 'fast'
+    'speaker_detection': 'auto',
+}
+
+youtube_id_pattern = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)([A-Za-z0-9_-]{11})')
+
+def youtube_video_id(video_url: str) -> str:
+    match = youtube_id_pattern.search(video_url)
+    return match.group(1) if match else None
+
+def video_key(video_url: str) -> str:
+    """ Identifies the result of a request: the YouTube video id (the URL itself if there is none)
+    and the transcription options """
+    return StageCache.make_key(youtube_video_id(video_url) or video_url.strip(), transcription_options)
+
+class Job:
+    """ A transcription requested by a chat, waiting in the queue or running """
+
+    def __init__(self, job_id: int, chat_ids: list, video_url: str, stage: str = 'new', video_id: str = None,
+                 audio_file: str = None, transcript_file: str = None):
+        self.id = job_id
+        self.chat_ids = list(chat_ids) # the requesting chat and the ones that requested the same video later
+        self.video_url = video_url
+        self.key = video_key(video_url)
+        self.stage = stage # last completed stage, see job_store.py
+        self.video_id = video_id
+        self.audio_file = audio_file
+        self.transcript_file = transcript_file
+        self.token = None # CancellationToken, created when the job starts (the timeout counts from then)
+        self.canceled = False
+        self.status_messages = {} # chat id -> id of the message that shows the progress
+
+    @classmethod
+    def from_record(cls, record: dict) -> 'Job':
+        return cls(record['id'], record['chat_ids'], record['video_url'], record['stage'], record['video_id'],
+                   record['audio_file'], record['transcript_file'])
+
+    def attach(self, chat_id: int) -> None:
+        self.chat_ids.append(chat_id)
+        job_store.attach(self.id, chat_id)
+
+    def detach(self, chat_id: int) -> None:
+        self.chat_ids.remove(chat_id)
+        self.status_messages.pop(chat_id, None)
+        job_store.detach(self.id, chat_id)
+
+    def set_stage(self, stage: str, **files) -> None:
+        self.stage = stage
+        for name, value in files.items():
+            setattr(self, name, value)
+        job_store.update(self.id, stage=stage, **files)
+
+    def remove_files(self) -> None:
+        for path in (self.audio_file, self.transcript_file):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def cancel(self) -> None:
+        self.canceled = True
+        if self.token is not None:
+            self.token.cancel()
+
+    def check(self) -> None:
+        """ Raises TranscriptionCanceled if the job was canceled (by the user or the timeout) """
+        if self.token is not None:
+            self.token.check()
+        if self.canceled:
+            raise TranscriptionCanceled('Canceled by the user.')
+
+bot_workers = max(1, int(get_config('bot_workers', 2)))
+bot_concurrent_transcriptions = max(1, int(get_config('bot_concurrent_transcriptions', 1)))
+# the threads are divided between the transcriptions that run at the same time
+transcription_threads = max(1, number_threads // min(bot_workers, bot_concurrent_transcriptions))
+bot_queue_size = int(get_config('bot_queue_size', 20))
+bot_max_attempts = int(get_config('bot_max_attempts', 3))
+waiting_jobs = [] # in the order of the queue
+running_jobs = []
+active_jobs = {} # video_key() -> waiting or running job of this video
+job_queue = None # asyncio.Queue, created in start_workers()
+job_executor = None
+transcription_slots = None
+
 # --- Bot Handlers ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -22,81 +131,401 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text="Hello! I am noScribe Bot. Send me a YouTube link and I will transcribe it for you."
     )
 
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancels the waiting and running transcriptions of this chat (/cancel).
+    Jobs that other chats wait for as well continue, only without this chat."""
+    chat_id = update.effective_chat.id
+    jobs = [job for job in waiting_jobs + running_jobs if chat_id in job.chat_ids and not job.canceled]
+    if not jobs:
+        await context.bot.send_message(chat_id=chat_id, text="There is no running transcription.")
+        return
+    for job in jobs:
+        if len(job.chat_ids) > 1:
+            job.detach(chat_id)
+        else:
+            job.cancel()
+            active_jobs.pop(job.key, None) # a new request for the video starts a new job
+    await context.bot.send_message(chat_id=chat_id, text="Canceling the transcription...")
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles non-command messages, expecting a YouTube URL."""
     message_text = update.message.text
     if "youtube.com/" in message_text or "youtu.be/" in message_text:
-        await transcribe_video(update, context, message_text)
+        await enqueue_video(update, context, message_text)
     else:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Please send me a valid YouTube link."
         )
 
-async def transcribe_video(update: Update, context: ContextTypes.DEFAULT_TYPE, video_url: str):
-    """Downloads, transcribes, and sends the video transcript."""
+async def enqueue_video(update: Update, context: ContextTypes.DEFAULT_TYPE, video_url: str):
+    """Adds the video to the job queue and tells the user its position. A video that was transcribed
+    recently is answered from the result cache, one that is already in the queue joins that job."""
     chat_id = update.effective_chat.id
-    await context.bot.send_message(chat_id=chat_id, text="Request received. Starting process...")
+    key = video_key(video_url)
+
+    cached_file = result_cache.get_file('transcripts', key, 'txt')
+    if cached_file is not None:
+        with open(cached_file, 'rb') as document:
+            await context.bot.send_document(chat_id=chat_id, document=document,
+                                            filename=f'{youtube_video_id(video_url) or "transcript"}.txt')
+        return
+
+    job = active_jobs.get(key)
+    if job is not None:
+        if chat_id not in job.chat_ids:
+            job.attach(chat_id)
+        await context.bot.send_message(chat_id=chat_id, text="This video is already being transcribed. You will receive the transcript as well.")
+        return
+
+    if len(waiting_jobs) >= bot_queue_size:
+        await context.bot.send_message(chat_id=chat_id, text="Sorry, too many videos are waiting right now. Please try again later.")
+        return
+    job = Job(job_store.add(chat_id, video_url), [chat_id], video_url)
+    active_jobs[key] = job
+    waiting_jobs.append(job)
+    job_queue.put_nowait(job)
+    # jobs before this one that are not picked up by a free worker right away
+    position = sum(1 for waiting in waiting_jobs if not waiting.canceled) - (bot_workers - len(running_jobs))
+    if position <= 0:
+        await context.bot.send_message(chat_id=chat_id, text="Request received. Starting process...")
+    else:
+        await context.bot.send_message(chat_id=chat_id, text=f"Request received. You are number {position} in the queue.")
+
+async def job_worker(bot):
+    while True:
+        job = await job_queue.get()
+        waiting_jobs.remove(job)
+        try:
+            if job.canceled:
+                job_store.update(job.id, state='canceled', error='Canceled by the user.')
+            else:
+                running_jobs.append(job)
+                try:
+                    await transcribe_video(bot, job)
+                finally:
+                    running_jobs.remove(job)
+        except Exception as e: # the worker must survive everything
+            logger.error(f"Job failed: {e}", exc_info=True)
+        finally:
+            if active_jobs.get(job.key) is job:
+                del active_jobs[job.key]
+            job_queue.task_done()
+
+def download_audio(job: Job, on_start=None, complete: threading.Event = None) -> tuple:
+    """ Blocking: downloads the audio with yt-dlp, returns (file path, video id).
+    The audio stream is kept as it is (usually opus/webm or aac/m4a): run_transcription decodes
+    any format to 16 kHz PCM itself, a conversion to mp3 would only cost time and quality.
+    For a progressive transcription, on_start(file path, video id) is called as soon as the file
+    is being written, and complete is set once it is written completely. """
+    started = False
+    def check_canceled(status):
+        nonlocal started
+        job.check() # an exception in the hook aborts the download
+        if on_start is not None and not started and status.get('filename'):
+            started = True
+            on_start(status['filename'], status.get('info_dict', {}).get('id', 'video'))
+
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'outtmpl': os.path.join(downloads_dir, f'{job.id}_%(id)s.%(ext)s'),
+        'progress_hooks': [check_canceled],
+    }
+    if on_start is not None:
+        # the transcription reads the file while it grows, so no .part file that is renamed at the end;
+        # a partial file left by an interrupted attempt is downloaded again, not taken as complete
+        ydl_opts.update(nopart=True, overwrites=True)
 
+    import yt_dlp # loaded on first use, the bot starts faster without it
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(job.video_url, download=True)
+        video_id = info.get('id', 'video')
+        downloads = info.get('requested_downloads') or [{}]
+        audio_file = downloads[0].get('filepath') or ydl.prepare_filename(info)
+    if complete is not None:
+        complete.set()
+    return audio_file, video_id
+
+async def notify(bot, job: Job, text: str):
+    """ Sends a message to all chats waiting for the job. A chat that blocked the bot does not stop the job. """
+    for chat_id in list(job.chat_ids):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+        except Exception as e:
+            logger.warning(f"Cannot send a message to chat {chat_id}: {e}")
+
+def retry_delay(error: Exception) -> float:
+    """ Seconds to wait after Telegram's flood control (RetryAfter), None for other errors """
+    delay = getattr(error, 'retry_after', None)
+    if delay is None:
+        return None
+    return delay.total_seconds() if hasattr(delay, 'total_seconds') else float(delay)
+
+class PartialTranscript:
+    """ Shows the text of a running transcription in the chats of a job, before the speakers are known.
+    The text goes into messages of at most max_length characters (Telegram allows 4096): the last one
+    is edited in place while it grows, at most every interval seconds, then a new one is started. """
+
+    max_length = 4000 # some room for characters that count double in Telegram (UTF-16)
+    max_new_messages = 3 # per chat and update, e.g. when a resumed job delivers many segments at once
+
+    def __init__(self, bot, job: Job, interval: float):
+        self.bot = bot
+        self.job = job
+        self.interval = interval
+        self.pages = [] # texts of the messages, the last one still grows
+        self.shown = {} # chat id -> [[message id, text], ...] of the pages sent so far
+        self._lock = threading.Lock()
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+
+    def add(self, segment) -> None:
+        """ segment_callback of run_transcription, called in the transcription thread """
+        text = segment.text.strip()
+        if not text:
+            return
+        with self._lock:
+            if not self.pages or len(self.pages[-1]) + 1 + len(text) > self.max_length:
+                self.pages.append(f'[{ms_to_str(segment.start * 1000)}] {text}'[:self.max_length])
+            else:
+                self.pages[-1] += ' ' + text
+        self._loop.call_soon_threadsafe(self._changed.set)
+
+    async def run(self):
+        """ Sends the new text until the task is canceled. The first text is sent right away. """
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            await self.update()
+            await asyncio.sleep(self.interval)
+
+    async def update(self):
+        with self._lock:
+            pages = list(self.pages)
+        for chat_id in list(self.job.chat_ids):
+            shown = self.shown.setdefault(chat_id, [])
+            new_messages = 0
+            try:
+                for index, text in enumerate(pages):
+                    if index < len(shown):
+                        if shown[index][1] != text: # Telegram refuses an edit without a change
+                            await self.bot.edit_message_text(chat_id=chat_id, message_id=shown[index][0], text=text)
+                            shown[index][1] = text
+                    elif new_messages < self.max_new_messages:
+                        message = await self.bot.send_message(chat_id=chat_id, text=text)
+                        shown.append([message.message_id, text])
+                        new_messages += 1
+            except Exception as e:
+                delay = retry_delay(e)
+                if delay is None:
+                    logger.warning(f"Cannot show the partial transcript in chat {chat_id}: {e}")
+                else: # the rest is sent with the next update
+                    logger.info(f"Telegram flood control, waiting {delay:.0f}s.")
+                    await asyncio.sleep(delay)
+
+def record_download(job: Job, download: asyncio.Future) -> None:
+    """ Done-callback of the download: the stage is recorded as soon as the audio is complete, also while
+    a progressive transcription is still running, so that a restart does not download the video again """
+    if download.cancelled() or download.exception() is not None:
+        return
+    audio_file, video_id = download.result()
+    job.set_stage('downloaded', video_id=video_id, audio_file=audio_file,
+                  transcript_file=os.path.join(transcripts_dir, f'{job.id}_{video_id}.txt'))
+
+async def finish_download(job: Job, download: asyncio.Future):
+    """ Waits for the download, its stage is recorded by record_download """
     try:
-        # 1. Download Audio using yt-dlp
-        await context.bot.send_message(chat_id=chat_id, text="Downloading audio from the video...")
+        await download
+    except Exception:
+        job.check() # aborted by /cancel
+        raise
 
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': 'downloads/%(id)s.%(ext)s',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-        }
+async def wait_for_transcription(job: Job, transcription: asyncio.Future, download: asyncio.Future = None):
+    """ Waits for the transcription and, in progressive mode, for the download that runs at the same time """
+    if download is None:
+        await transcription
+        return
+    # a failed download must not leave a transcript of the first part of the video
+    download_failed = 'The download failed.'
+    download.add_done_callback(lambda future: future.cancelled() or future.exception() is None or
+                               job.token.cancel(download_failed))
+    try:
+        await transcription
+    except Exception:
+        if job.token.reason == download_failed:
+            raise download.exception()
+        job.token.cancel() # stops the download, if it is still running
+        raise
+    await finish_download(job, download)
 
-        # Create directories if they don't exist
-        os.makedirs("downloads", exist_ok=True)
-        os.makedirs("transcripts", exist_ok=True)
+async def transcribe_video(bot, job: Job):
+    """Downloads, transcribes, and sends the video transcript. Stages completed before a restart are skipped."""
+    loop = asyncio.get_running_loop()
+    job.token = CancellationToken(deadline=float(get_config('bot_job_timeout_minutes', 120)) * 60)
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
-            video_id = info.get('id', 'video')
-            downloaded_file_path = f"downloads/{video_id}.mp3"
-            transcript_file_path = f"transcripts/{video_id}.txt"
+    try:
+        attempts = job_store.start(job.id)
+        if attempts > bot_max_attempts: # e.g. a video that crashes the bot every time
+            raise Exception(f"The video could not be processed in {bot_max_attempts} attempts.")
 
+        need_transcript = job.stage in ('new', 'downloaded') or not os.path.exists(job.transcript_file)
+        need_audio = need_transcript and (job.stage == 'new' or not os.path.exists(job.audio_file))
 
-        await context.bot.send_message(chat_id=chat_id, text="Download complete. Starting transcription...")
+        # 1. Download Audio using yt-dlp
+        # Progressive: the transcription starts as soon as the first bytes of the audio are written
+        # (if a transcription slot is free), the download is still running then.
+        download = None
+        download_complete = threading.Event()
+        if need_audio:
+            await notify(bot, job, "Downloading audio from the video...")
+
+            # Create directories if they don't exist
+            os.makedirs(downloads_dir, exist_ok=True)
+            os.makedirs(transcripts_dir, exist_ok=True)
+
+            download_started = asyncio.Event()
+            def start_progressive(audio_file, video_id): # in the download thread
+                job.audio_file, job.video_id = audio_file, video_id
+                job.transcript_file = os.path.join(transcripts_dir, f'{job.id}_{video_id}.txt')
+                loop.call_soon_threadsafe(download_started.set)
+            on_start = start_progressive if get_config('bot_progressive', True) else None
+            download = asyncio.ensure_future(loop.run_in_executor(
+                job_executor, functools.partial(download_audio, job, on_start, download_complete)))
+            # registered first, so the stage is recorded before any waiting code continues
+            download.add_done_callback(functools.partial(record_download, job))
+            if on_start is not None:
+                started = asyncio.ensure_future(download_started.wait())
+                await asyncio.wait([download, started], return_when=asyncio.FIRST_COMPLETED)
+                started.cancel()
+            if on_start is None or download.done():
+                await finish_download(job, download)
+                download = None
+            else:
+                job_store.update(job.id, video_id=job.video_id, audio_file=job.audio_file, transcript_file=job.transcript_file)
 
         # 2. Transcribe using the refactored transcriber
-        def log_to_telegram(message, level='info'):
-            # This function can be used to send progress updates, but for now, we'll just log it.
-            logger.info(f"Transcription log: {message}")
-
-        # For the bot, we'll use a default set of parameters.
-        run_transcription(
-            audio_file=downloaded_file_path,
-            transcript_file=transcript_file_path,
-            language_name='Auto',
-            whisper_model_name='precise', # or 'fast'
-            speaker_detection='auto',
-            log_callback=log_to_telegram
-        )
+        if need_transcript:
+            if transcription_slots.locked():
+                await notify(bot, job, f"{'Download complete. ' if download is None else ''}Waiting for the transcriptions of other users to finish...")
+            async with transcription_slots:
+                job.check()
+                if download is not None and download.done(): # finished (or failed) while waiting for the slot
+                    await finish_download(job, download)
+                    download = None
+                for chat_id in list(job.chat_ids):
+                    try:
+                        status_message = await bot.send_message(chat_id=chat_id, text="Download complete. Starting transcription..." if download is None
+                                                                else "Starting transcription while the audio is still downloading...")
+                        job.status_messages[chat_id] = status_message.message_id
+                    except Exception as e:
+                        logger.warning(f"Cannot send a message to chat {chat_id}: {e}")
+
+                def log_to_telegram(message, level='info'):
+                    # This function can be used to send progress updates, but for now, we'll just log it.
+                    logger.info(f"Transcription log: {message}")
+
+                # Progress is shown by editing the status message (Telegram limits the rate of edits)
+                progress_interval = float(get_config('bot_progress_interval', 15))
+                last_progress = {'time': 0.0, 'text': ''}
+                def progress_to_telegram(event):
+                    if time.monotonic() - last_progress['time'] < progress_interval:
+                        return
+                    text = f"Transcribing... {round(event.progress * 100)}% ({event.stage})"
+                    if event.eta:
+                        text += f", about {ms_to_str(event.eta * 1000)} left for this step"
+                    if text == last_progress['text']:
+                        return
+                    last_progress.update(time=time.monotonic(), text=text)
+                    for chat_id, message_id in list(job.status_messages.items()):
+                        asyncio.run_coroutine_threadsafe(
+                            bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text), loop)
+
+                # The text is shown while it is transcribed, the file with the speakers follows at the end
+                partial = None
+                partial_task = None
+                if get_config('bot_partial_transcripts', True):
+                    partial = PartialTranscript(bot, job, float(get_config('bot_partial_interval', 10)))
+                    partial_task = asyncio.ensure_future(partial.run())
 
-        await context.bot.send_message(chat_id=chat_id, text="Transcription complete. Sending you the file...")
+                # An interrupted transcription continues from its checkpoint, which is identified by the job
+                # (the file of a progressive download is still growing, and is downloaded again after a restart).
+                # Jobs that take longer than bot_job_timeout_minutes are canceled.
+                transcription = loop.run_in_executor(job_executor, functools.partial(
+                    run_transcription,
+                    audio_file=job.audio_file,
+                    transcript_file=job.transcript_file,
+                    **transcription_options,
+                    log_callback=log_to_telegram,
+                    cancel=job.token,
+                    progress_callback=progress_to_telegram,
+                    audio_complete=download_complete.is_set if download is not None else None,
+                    segment_callback=partial.add if partial is not None else None,
+                    checkpoint_id=f'telegram job {job.id}_{job.video_id}',
+                    threads=transcription_threads
+                ))
+                try:
+                    await wait_for_transcription(job, transcription, download)
+                finally:
+                    if partial_task is not None:
+                        partial_task.cancel()
+                if partial is not None:
+                    await partial.update() # the complete text
+            job.set_stage('transcribed')
 
-        # 3. Send the transcript file back to the user
-        with open(transcript_file_path, 'rb') as document:
-            await context.bot.send_document(chat_id=chat_id, document=document)
+        # From now on, new requests for this video are answered from the cache
+        result_cache.put_file('transcripts', job.key, 'txt', job.transcript_file)
+        if active_jobs.get(job.key) is job:
+            del active_jobs[job.key]
+
+        await notify(bot, job, "Transcription complete. Sending you the file...")
+
+        # 3. Send the transcript file back to the users
+        for chat_id in list(job.chat_ids):
+            try:
+                with open(job.transcript_file, 'rb') as document:
+                    await bot.send_document(chat_id=chat_id, document=document, filename=f'{job.video_id}.txt')
+            except Exception as e:
+                logger.warning(f"Cannot send the transcript to chat {chat_id}: {e}")
+        job.set_stage('sent')
+        job_store.update(job.id, state='finished')
 
         # 4. Clean up files
-        os.remove(downloaded_file_path)
-        os.remove(transcript_file_path)
+        job.remove_files()
+
+    except TranscriptionCanceled as e:
+        logger.info(f"Transcription canceled: {e}")
+        job_store.update(job.id, state='canceled', error=str(e))
+        await notify(bot, job, f"The transcription was canceled. {e}")
+        job.remove_files()
 
     except Exception as e:
         logger.error(f"An error occurred: {e}", exc_info=True)
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"Sorry, an error occurred during the process: {e}"
-        )
+        job_store.update(job.id, state='failed', error=str(e))
+        job.remove_files()
+        await notify(bot, job, f"Sorry, an error occurred during the process: {e}")
+
+    finally:
+        job.token.close()
+
+async def start_workers(application):
+    """ Creates the job queue and its workers in the event loop of the application """
+    global job_queue, job_executor, transcription_slots
+    job_queue = asyncio.Queue() # bounded by bot_queue_size in enqueue_video(), recovered jobs are always added
+    # a progressive job downloads and transcribes at the same time
+    job_executor = ThreadPoolExecutor(max_workers=2 * bot_workers, thread_name_prefix='noScribe-bot')
+    transcription_slots = asyncio.Semaphore(bot_concurrent_transcriptions)
+    for _ in range(bot_workers):
+        application.create_task(job_worker(application.bot))
 
+    # Jobs that were waiting or running when the bot stopped
+    job_store.remove_old(float(get_config('bot_job_history_days', 30)))
+    for record in job_store.unfinished():
+        job = Job.from_record(record)
+        active_jobs.setdefault(job.key, job)
+        waiting_jobs.append(job)
+        job_queue.put_nowait(job)
+        logger.info(f"Resuming job {job.id} ({job.video_url}) after '{job.stage}'.")
+        await notify(application.bot, job, "The bot was restarted. Your transcription continues where it stopped...")
 
 def main():
     """Start the bot."""
@@ -106,13 +535,18 @@ def main():
         logger.error("TELEGRAM_BOT_TOKEN environment variable not set!")
         return
 
-    application = ApplicationBuilder().token(token).build()
+    application = ApplicationBuilder().token(token).post_init(start_workers).build()
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
     # Run the bot until the user presses Ctrl-C
+    logger.info(f"Resources: {resources.summary()}, {transcription_threads} threads per transcription")
+    # load the transcription libraries while the bot is already answering
+    if get_config('warm_up', True):
+        warm_up(logger.info)
     logger.info("Bot is running...")
     application.run_polling()
 
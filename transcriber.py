@@ -8,18 +8,13 @@ import appdirs
 from subprocess import Popen, PIPE, STDOUT
 if platform.system() == 'Windows':
     from subprocess import STARTUPINFO, STARTF_USESHOWWINDOW
-from ctranslate2 import get_cuda_device_count
-import torch
 import re
 if platform.system() == "Darwin": # = MAC
     from subprocess import check_output
     if platform.machine() == "x86_64":
         os.environ['KMP_DUPLICATE_LIB_OK']='True'
-from faster_whisper.audio import decode_audio
-from faster_whisper.vad import VadOptions, get_speech_timestamps
-import AdvancedHTMLParser
 import html
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, mkstemp, gettempdir
 import datetime
 from pathlib import Path
 if platform.system() in ("Darwin", "Linux"):
@@ -32,6 +27,31 @@ if platform.system() == 'Windows':
 import logging
 import gc
 import traceback
+import threading
+import time
+import json
+import atexit
+import hashlib
+import shutil
+import itertools
+import contextlib
+import functools
+import importlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import resources
+from resources import available_memory_mb, current_rss_mb, attach_shared_memory
+from typing import TYPE_CHECKING
+
+# torch, ctranslate2, faster_whisper and AdvancedHTMLParser are imported when a job first needs them,
+# so that the GUI and the bot start quickly (see warm_up())
+if TYPE_CHECKING:
+    import AdvancedHTMLParser
+    from faster_whisper.vad import VadOptions
 
 logging.basicConfig()
 logging.getLogger("faster_whisper").setLevel(logging.DEBUG)
@@ -88,7 +108,7 @@ if platform.system() == 'Windows':
     except:
         number_threads = get_config('threads', 4)
 elif platform.system() == "Linux":
-    number_threads = get_config('threads', os.cpu_count() if os.cpu_count() is not None else 4)
+    number_threads = get_config('threads', resources.cpu_limit())
 elif platform.system() == "Darwin": # = MAC
     if platform.machine() == "arm64":
         cpu_count = int(check_output(["sysctl", "-n", "hw.perflevel0.logicalcpu_max"]))
@@ -99,6 +119,42 @@ elif platform.system() == "Darwin": # = MAC
     number_threads = get_config('threads', int(cpu_count * 0.75))
 else:
     raise Exception('Platform not supported yet.')
+# never more than the CPUs available to this process (e.g. the CPU limit of a docker container)
+number_threads = max(1, min(int(number_threads), resources.cpu_limit()))
+
+# Lazily imported dependencies
+
+def get_speech_timestamps(audio: np.ndarray, vad_options: 'VadOptions' = None, **kwargs) -> list:
+    """ faster_whisper.vad.get_speech_timestamps, imported on first use """
+    from faster_whisper.vad import get_speech_timestamps as vad_speech_timestamps
+    return vad_speech_timestamps(audio, vad_options, **kwargs)
+
+@functools.lru_cache(maxsize=None)
+def cuda_available() -> bool:
+    import torch
+    from ctranslate2 import get_cuda_device_count
+    return torch.cuda.is_available() and get_cuda_device_count() > 0
+
+# loading torch in the main process is only needed for the CUDA check (not on macOS, see noScribe.py)
+heavy_modules = ['ctranslate2', 'faster_whisper', 'faster_whisper.vad', 'AdvancedHTMLParser']
+if platform.system() in ('Windows', 'Linux'):
+    heavy_modules.insert(0, 'torch')
+
+def warm_up(log_callback=None) -> threading.Thread:
+    """ Imports the heavy dependencies in a background thread, so that the first job does not wait for them """
+    def run():
+        started = time.perf_counter()
+        for module in heavy_modules:
+            try:
+                importlib.import_module(module)
+            except Exception as e:
+                if log_callback:
+                    log_callback(f'Warm-up: cannot import {module}: {e}')
+        if log_callback:
+            log_callback(f'Warm-up finished in {time.perf_counter() - started:.1f}s.')
+    thread = threading.Thread(target=run, name='noScribe-warm-up', daemon=True)
+    thread.start()
+    return thread
 
 # Helper functions
 def millisec(timeStr: str) -> int:
@@ -117,12 +173,13 @@ def ms_to_str(milliseconds: float, include_ms=False):
         formatted += f'.{int(milliseconds):03d}'
     return formatted
 
-def html_node_to_text(node: AdvancedHTMLParser.AdvancedTag) -> str:
+def html_node_to_text(node: 'AdvancedHTMLParser.AdvancedTag') -> str:
+    import AdvancedHTMLParser
     if AdvancedHTMLParser.isTextNode(node):
-        return html.unescape(node.text)
+        return html.unescape(node)
     elif AdvancedHTMLParser.isTagNode(node):
         text_parts = []
-        for child in node.childNodes:
+        for child in node.childBlocks: # childNodes would only return tags, not the text
             text = html_node_to_text(child)
             if text:
                 text_parts.append(text)
@@ -136,14 +193,12 @@ def html_node_to_text(node: AdvancedHTMLParser.AdvancedTag) -> str:
     else:
         return ''
 
-def html_to_text(parser: AdvancedHTMLParser.AdvancedHTMLParser) -> str:
+def html_to_text(parser: 'AdvancedHTMLParser.AdvancedHTMLParser') -> str:
     return html_node_to_text(parser.body)
 
 def vtt_escape(txt: str) -> str:
-    txt = html.escape(txt)
-    while txt.find('\n\n') > -1:
-        txt = txt.replace('\n\n', '\n')
-    return txt
+    # empty lines would end the cue, runs of newlines are collapsed in one pass
+    return re.sub(r'\n{2,}', '\n', html.escape(txt))
 
 def ms_to_webvtt(milliseconds) -> str:
     hours, milliseconds = divmod(milliseconds, 3600000)
@@ -151,12 +206,11 @@ def ms_to_webvtt(milliseconds) -> str:
     seconds, milliseconds = divmod(milliseconds, 1000)
     return "{:02d}:{:02d}:{:02d}.{:03d}".format(int(hours), int(minutes), int(seconds), int(milliseconds))
 
-def html_to_webvtt(parser: AdvancedHTMLParser.AdvancedHTMLParser, media_path: str):
-    vtt = 'WEBVTT '
+def html_to_webvtt(parser: 'AdvancedHTMLParser.AdvancedHTMLParser', media_path: str):
     paragraphs = parser.getElementsByTagName('p')
-    vtt += vtt_escape(paragraphs[0].textContent) + '\n\n'
-    vtt += vtt_escape('NOTE\n' + html_node_to_text(paragraphs[1])) + '\n\n'
-    vtt += f'NOTE media: {media_path}\n\n'
+    vtt = ['WEBVTT ', vtt_escape(paragraphs[0].textContent), '\n\n',
+           vtt_escape('NOTE\n' + html_node_to_text(paragraphs[1])), '\n\n',
+           f'NOTE media: {media_path}\n\n']
     segments = parser.getElementsByTagName('a')
     for i, segment in enumerate(segments):
         name = segment.attributes.get('name')
@@ -167,8 +221,8 @@ def html_to_webvtt(parser: AdvancedHTMLParser.AdvancedHTMLParser, media_path: st
                 end = ms_to_webvtt(int(name_elems[2]))
                 spkr = name_elems[3]
                 txt = vtt_escape(html_node_to_text(segment))
-                vtt += f'{i+1}\n{start} --> {end}\n<v {spkr}>{txt.lstrip()}\n\n'
-    return vtt
+                vtt.append(f'{i+1}\n{start} --> {end}\n<v {spkr}>{txt.lstrip()}\n\n')
+    return ''.join(vtt)
 
 def get_whisper_models():
     whisper_model_paths = {}
@@ -187,6 +241,1712 @@ def get_whisper_models():
     collect_models(user_models_dir)
     return whisper_model_paths
 
+def auto_batch_size(model_size_mb: float, max_batch_size: int = 16) -> int:
+    """ Batch size for batched inference, based on the available memory. Every item of a batch
+    needs roughly a third of the model size (encoder activations, decoder cache). """
+    available = available_memory_mb()
+    if available <= 0:
+        return 4
+    per_item_mb = max(256, model_size_mb / 3)
+    # keep a quarter of the free memory as reserve
+    return max(1, min(max_batch_size, int(available * 0.75 / per_item_mb)))
+
+# Cancellation
+
+class TranscriptionCanceled(Exception):
+    """ Raised by run_transcription if the job was canceled """
+
+class CancellationToken:
+    """ Cooperative cancellation of a running transcription. cancel() may be called from any
+    thread: run_transcription checks the token between its steps and segments, running
+    subprocesses (ffmpeg, diarization, transcription processes) are stopped by the callbacks
+    registered with on_cancel(). With a deadline (seconds), the job is canceled automatically. """
+
+    def __init__(self, deadline: float = 0):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = ''
+        self._timer = None
+        if deadline > 0:
+            self._timer = threading.Timer(deadline, self.cancel, args=('Deadline exceeded.',))
+            self._timer.daemon = True
+            self._timer.start()
+
+    @property
+    def canceled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = 'Canceled by the user.') -> None:
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.warning(f'Cancellation callback failed: {e}')
+
+    def check(self) -> None:
+        """ Raises TranscriptionCanceled if the job was canceled """
+        if self._event.is_set():
+            raise TranscriptionCanceled(self.reason)
+
+    def on_cancel(self, callback) -> None:
+        """ callback is called once the job is canceled (immediately, if it already is) """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def child(self) -> 'CancellationToken':
+        """ A token that is canceled together with this one, but can also be canceled on its own,
+        e.g. to stop a step that runs in the background when the job fails """
+        child = CancellationToken()
+        self.on_cancel(lambda: child.cancel(self.reason))
+        return child
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+
+def iter_cancelable(iterable, cancel: CancellationToken = None):
+    """ Checks the token before every item """
+    for item in iterable:
+        if cancel is not None:
+            cancel.check()
+        yield item
+
+# Progress
+
+# stage: 'conversion', 'diarization', 'language' or 'transcription'
+# processed, total: seconds of audio (total is None while unknown)
+# rtf: real-time factor of the stage so far (processing time / audio time), eta: remaining seconds of the stage
+# progress: overall progress of the job (0..1)
+ProgressEvent = namedtuple('ProgressEvent', ['stage', 'processed', 'total', 'rtf', 'eta', 'progress'])
+
+class ProgressReporter:
+    """ Collects the progress of the stages of a transcription and passes it to callback as
+    ProgressEvents, at most every min_interval seconds per stage (and always when a stage starts
+    or finishes). Events are also appended to json_log (one JSON object per line). Stages can
+    run at the same time, updates may come from any thread. """
+
+    def __init__(self, callback=None, json_log: str = None, min_interval: float = 0.5):
+        self.callback = callback
+        self.min_interval = min_interval
+        self.total = None
+        self.weights = {}
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._json_log = None
+        if json_log:
+            try:
+                os.makedirs(os.path.dirname(json_log), exist_ok=True)
+                self._json_log = open(json_log, 'a', encoding='utf-8')
+            except OSError as e:
+                logging.warning(f'Cannot write progress log {json_log}: {e}')
+
+    def set_weights(self, weights: dict) -> None:
+        """ Share of the stages in the overall progress """
+        weights_sum = sum(weights.values())
+        self.weights = {stage: weight / weights_sum for stage, weight in weights.items()}
+
+    def _fraction(self, stage: str) -> float:
+        state = self._stages.get(stage)
+        if state is None:
+            return 0.0
+        if state['finished']:
+            return 1.0
+        if not self.total:
+            return 0.0
+        return min(1.0, state['processed'] / self.total)
+
+    def start(self, stage: str, processed: float = 0.0) -> None:
+        with self._lock:
+            self._stages[stage] = {'start_time': time.monotonic(), 'start_processed': processed,
+                                   'processed': processed, 'last_emit': 0.0, 'finished': False}
+        self.update(stage, processed, force=True)
+
+    def finish(self, stage: str) -> None:
+        with self._lock:
+            if stage not in self._stages:
+                self._stages[stage] = {'start_time': time.monotonic(), 'start_processed': 0.0,
+                                       'processed': 0.0, 'last_emit': 0.0, 'finished': False}
+            state = self._stages[stage]
+            if state['finished']:
+                return
+            if self.total:
+                state['processed'] = self.total
+        self.update(stage, state['processed'], force=True, finished=True)
+
+    def update(self, stage: str, processed: float, force: bool = False, finished: bool = False) -> None:
+        with self._lock:
+            state = self._stages.get(stage)
+            if state is None:
+                return
+            state['processed'] = processed
+            state['finished'] = state['finished'] or finished
+            now = time.monotonic()
+            if not force and now - state['last_emit'] < self.min_interval:
+                return
+            state['last_emit'] = now
+            done = processed - state['start_processed']
+            rtf = (now - state['start_time']) / done if done > 0 else None
+            eta = 0.0 if state['finished'] else None
+            if not state['finished'] and rtf is not None and self.total:
+                eta = max(0.0, self.total - processed) * rtf
+            progress = sum(weight * self._fraction(s) for s, weight in self.weights.items())
+            event = ProgressEvent(stage, processed, self.total, rtf, eta, progress)
+            if self._json_log is not None:
+                record = {'time': datetime.datetime.now().isoformat(timespec='milliseconds')}
+                record.update({k: round(v, 3) if isinstance(v, float) else v for k, v in event._asdict().items()})
+                self._json_log.write(json.dumps(record) + '\n')
+                self._json_log.flush()
+        if self.callback is not None:
+            try:
+                self.callback(event)
+            except Exception as e:
+                logging.warning(f'Progress callback failed: {e}')
+
+    def track(self, segments, stage: str = 'transcription'):
+        """ Reports the end of every segment as the processed audio """
+        for segment in segments:
+            self.update(stage, segment.end)
+            yield segment
+
+    def close(self) -> None:
+        if self._json_log is not None:
+            self._json_log.close()
+            self._json_log = None
+
+# Metrics
+
+class JobMetrics:
+    """ Wall time, CPU time (of this process and its finished subprocesses) and peak resident
+    memory per stage of a transcription. Stages may run at the same time or be entered several
+    times, the times are summed up. Memory is sampled every sample_interval seconds in a
+    background thread. The report is written as JSON. """
+
+    def __init__(self, sample_interval: float = 0.2):
+        self.stages = {}
+        self.extra = {}
+        self._active = {}
+        self._lock = threading.Lock()
+        self._start = self.clock()
+        self._peak_rss = None
+        self._stop_sampler = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, args=(sample_interval,), daemon=True)
+        self._sampler.start()
+
+    @staticmethod
+    def clock() -> tuple:
+        times = os.times()
+        return time.perf_counter(), time.process_time() + times.children_user + times.children_system
+
+    def _stage(self, name: str) -> dict:
+        return self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'peak_rss_mb': None})
+
+    def _sample(self) -> None:
+        rss = current_rss_mb()
+        if rss is None:
+            return
+        with self._lock:
+            self._peak_rss = max(self._peak_rss or 0.0, rss)
+            for name in self._active:
+                stage = self._stage(name)
+                stage['peak_rss_mb'] = max(stage['peak_rss_mb'] or 0.0, rss)
+
+    def _sample_loop(self, interval: float) -> None:
+        while not self._stop_sampler.wait(interval):
+            self._sample()
+
+    def start(self, name: str) -> tuple:
+        with self._lock:
+            self._active[name] = self._active.get(name, 0) + 1
+            self._stage(name)
+        self._sample()
+        return self.clock()
+
+    def stop(self, name: str, started: tuple) -> None:
+        self._sample()
+        with self._lock:
+            self.add(name, started)
+            self._active[name] -= 1
+            if self._active[name] <= 0:
+                del self._active[name]
+
+    def add(self, name: str, started: tuple) -> None:
+        """ Adds the time since started (a clock() value) to the stage """
+        wall, cpu = self.clock()
+        stage = self._stage(name)
+        stage['wall'] += wall - started[0]
+        stage['cpu'] += cpu - started[1]
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        started = self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name, started)
+
+    @contextlib.contextmanager
+    def memory(self, *names):
+        """ Attributes the memory to the stages without timing them (their time is added separately) """
+        with self._lock:
+            for name in names:
+                self._active[name] = self._active.get(name, 0) + 1
+                self._stage(name)
+        try:
+            yield
+        finally:
+            self._sample()
+            with self._lock:
+                for name in names:
+                    self._active[name] -= 1
+                    if self._active[name] <= 0:
+                        del self._active[name]
+
+    def timed_iter(self, iterable, name: str):
+        """ Adds the time spent in producing the items (e.g. decoding whisper segments) to the stage """
+        iterator = iter(iterable)
+        while True:
+            started = self.clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, started)
+                return
+            self.add(name, started)
+            yield item
+
+    def report(self) -> dict:
+        wall, cpu = self.clock()
+        self._sample()
+        round_values = lambda d: {k: round(v, 3) if isinstance(v, float) else v for k, v in d.items()}
+        report = dict(self.extra)
+        report['total'] = round_values({'wall': wall - self._start[0], 'cpu': cpu - self._start[1], 'peak_rss_mb': self._peak_rss})
+        report['stages'] = {}
+        for name, stage in self.stages.items():
+            stage = round_values(stage)
+            if 'steps' in stage:
+                stage['steps'] = {step: round_values(values) for step, values in stage['steps'].items()}
+            report['stages'][name] = stage
+        return report
+
+    def summary(self) -> str:
+        return ', '.join(f'{name} {stage["wall"]:.1f}s' for name, stage in self.stages.items())
+
+    def write(self, file: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        with open(file, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def close(self) -> None:
+        self._stop_sampler.set()
+
+# Whisper model pool
+
+class WhisperModelPool:
+    """ Keeps loaded WhisperModel instances alive across transcription jobs.
+    Models are keyed by (model path, device, compute_type). ctranslate2 fixes the number of threads
+    when a model is loaded, so a cached model keeps the cpu_threads of its first load, even if a later
+    job asks for more or fewer (e.g. with or without parallel diarization): reloading would take longer
+    than the difference in speed. A model is loaded outside the pool lock, so that other jobs can use
+    the models that are already loaded meanwhile; a second job asking for the same model waits for
+    this load. The least recently
+    used models are evicted if the estimated memory use exceeds max_memory_mb or if a model
+    has not been used for idle_timeout seconds (0 disables the respective limit).
+    Models currently acquired by a running job are never evicted. """
+
+    def __init__(self, max_memory_mb: int = 0, idle_timeout: float = 0):
+        self.max_memory_mb = max_memory_mb
+        self.idle_timeout = idle_timeout
+        self._entries = OrderedDict() # key -> dict(model, size_mb, last_used, in_use), oldest first
+        self._lock = threading.RLock()
+        self._loading = {} # key -> threading.Event, set when the model is loaded (or the load failed)
+        self._idle_timer = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    @staticmethod
+    def make_key(model_path: str, device: str, compute_type: str) -> tuple:
+        return (os.path.realpath(model_path), device, compute_type)
+
+    @staticmethod
+    def estimate_size_mb(model_path: str) -> float:
+        """ Rough estimate of the memory footprint: the size of the model files on disk """
+        size = 0
+        if os.path.isdir(model_path):
+            for entry in os.scandir(model_path):
+                if entry.is_file():
+                    size += entry.stat().st_size
+        return size / (1024 * 1024)
+
+    def _load(self, model_path: str, device: str, compute_type: str, cpu_threads: int):
+        from faster_whisper import WhisperModel
+        return WhisperModel(model_path, device=device, cpu_threads=cpu_threads, compute_type=compute_type, local_files_only=True)
+
+    def acquire(self, model_path: str, device: str = 'cpu', compute_type: str = 'default', cpu_threads: int = 0, log_callback=None):
+        """ Returns a (possibly cached) model and marks it as in use until release() is called. """
+        key = self.make_key(model_path, device, compute_type)
+        while True:
+            with self._lock:
+                self._evict_idle()
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    if log_callback:
+                        log_callback(f'Reusing loaded whisper model "{os.path.basename(key[0])}" ({entry["cpu_threads"]} threads).')
+                    return self._use(entry)
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            loading.wait() # loaded by another job, or failed there: look again
+
+        try:
+            load_start = time.perf_counter()
+            model = self._load(key[0], device, compute_type, cpu_threads)
+            load_time = time.perf_counter() - load_start
+            with self._lock:
+                self.load_time += load_time
+                entry = {'model': model, 'size_mb': self.estimate_size_mb(key[0]), 'cpu_threads': cpu_threads, 'in_use': 0}
+                self._entries[key] = entry
+                model = self._use(entry)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+        if log_callback:
+            log_callback(f'Whisper model "{os.path.basename(key[0])}" loaded in {load_time:.1f}s.')
+        return model
+
+    def _use(self, entry: dict):
+        entry['in_use'] += 1
+        entry['last_used'] = time.monotonic()
+        self._evict_over_budget()
+        return entry['model']
+
+    def release(self, model) -> None:
+        with self._lock:
+            for entry in self._entries.values():
+                if entry['model'] is model:
+                    entry['in_use'] = max(0, entry['in_use'] - 1)
+                    entry['last_used'] = time.monotonic()
+                    break
+            self._evict_over_budget()
+            self._schedule_idle_eviction()
+
+    def _remove(self, key) -> None:
+        del self._entries[key]
+        self.evictions += 1
+        gc.collect()
+
+    def _evict_over_budget(self) -> None:
+        if self.max_memory_mb <= 0:
+            return
+        for key in list(self._entries.keys()): # oldest first
+            if sum(e['size_mb'] for e in self._entries.values()) <= self.max_memory_mb:
+                break
+            if self._entries[key]['in_use'] == 0:
+                self._remove(key)
+
+    def _evict_idle(self) -> None:
+        if self.idle_timeout <= 0:
+            return
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if entry['in_use'] == 0 and now - entry['last_used'] >= self.idle_timeout:
+                self._remove(key)
+
+    def _schedule_idle_eviction(self) -> None:
+        # Free the memory of idle models even if no further job arrives
+        if self.idle_timeout <= 0:
+            return
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+        self._idle_timer = threading.Timer(self.idle_timeout, self.evict_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def evict_idle(self) -> None:
+        with self._lock:
+            self._evict_idle()
+
+    def clear(self) -> None:
+        """ Drops all models that are not in use """
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry['in_use'] == 0:
+                    self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'load_time': round(self.load_time, 3),
+                'loaded': [os.path.basename(key[0]) for key in self._entries.keys()],
+                'memory_mb': round(sum(e['size_mb'] for e in self._entries.values())),
+            }
+
+whisper_model_pool = WhisperModelPool(
+    # at most half of the memory limit (e.g. of a docker container)
+    max_memory_mb=int(get_config('whisper_pool_max_memory_mb', min(4096, (resources.memory_limit_mb() or 8192) / 2))),
+    idle_timeout=float(get_config('whisper_pool_idle_timeout', 1800))
+)
+
+def resolve_whisper_model(whisper_model_name: str) -> str:
+    """ Maps a model name (as shown in the GUI menu or used by the bot) to its path. """
+    whisper_model_paths = get_whisper_models()
+    if whisper_model_name in whisper_model_paths:
+        return os.path.realpath(whisper_model_paths[whisper_model_name])
+    raise FileNotFoundError(f"The whisper model '{whisper_model_name}' does not exist.")
+
+# Calibration results (see calibrate.py), stored in config.yml under 'whisper_calibration'
+
+def get_calibration(whisper_model_name: str, device: str):
+    """ The fastest {'compute_type', 'cpu_threads', ...} measured for this model on this machine, or None.
+    A calibration from a machine with a different number of CPUs is ignored. """
+    calibration = config.get('whisper_calibration', {}).get(f'{whisper_model_name}/{device}')
+    if not calibration or calibration.get('cpu_count') != resources.cpu_limit():
+        return None
+    return calibration
+
+def save_calibration(whisper_model_name: str, device: str, calibration: dict) -> None:
+    """ Merged into config.yml as it is on disk now, so that other settings changed meanwhile are kept """
+    try:
+        with open(config_file, 'r') as file:
+            file_config = yaml.safe_load(file) or {}
+    except FileNotFoundError:
+        file_config = {}
+    for cfg in (file_config, config):
+        cfg.setdefault('whisper_calibration', {})[f'{whisper_model_name}/{device}'] = calibration
+    with open(config_file, 'w') as file:
+        yaml.safe_dump(file_config, file)
+
+# Transcript output
+
+class TranscriptWriter:
+    """ Writes the transcript (html, txt or vtt) incrementally while the segments come in.
+    The result is the same as building the whole document with AdvancedHTMLParser and
+    exporting it with asHTML(), html_to_text() or html_to_webvtt() at the end, but memory use
+    stays flat and the file on disk is a valid (partial) transcript after every flush.
+    Closing tags (html) are written at every flush and overwritten by the next one. """
+
+    def __init__(self, transcript_file: str, title: str, audio_file: str, flush_interval: float = 10.0):
+        self.transcript_file = transcript_file
+        self.file_ext = os.path.splitext(transcript_file)[1][1:]
+        self.flush_interval = flush_interval
+        self._pending = [] # output not yet written to disk
+        self._last_flush = time.monotonic()
+        self._segment_count = 0
+        self._file = open(transcript_file, 'wb')
+        self._tail_pos = 0 # position of the closing part that is rewritten on every flush
+        info = f"Transcribed with noScribe. Audio: {audio_file}"
+        if self.file_ext == 'html':
+            self._html_head, self._html_tail = self._html_frame()
+            self._write(self._html_head)
+            self._write(f'<div ><p style="font-weight: 600" >{title}</p>'
+                        f'<p ><span style="color: #909090; font-size: 0.8em" >{info}</span></p>')
+        elif self.file_ext == 'txt':
+            # html_to_text() strips every paragraph and the surrounding div, see _txt_add()
+            self._txt_started = False
+            self._txt_div_ws = ''
+            self._write('\n\n') # newlines of the body and the div
+            for text in (title, info):
+                self._txt_open_paragraph()
+                self._txt_add(html.unescape(text))
+                self._txt_close_paragraph()
+        elif self.file_ext == 'vtt':
+            self._write('WEBVTT ' + vtt_escape(title) + '\n\n')
+            self._write(vtt_escape('NOTE\n\n' + html.unescape(info).strip() + '\n') + '\n\n')
+            self._write(f'NOTE media: {audio_file}\n\n')
+        self._paragraph_open = False
+        self.new_paragraph() # active paragraph for writing
+        self.flush()
+
+    @staticmethod
+    def _html_frame() -> tuple:
+        # Let AdvancedHTMLParser serialize the document frame so that the output matches asHTML()
+        import AdvancedHTMLParser
+        d = AdvancedHTMLParser.AdvancedHTMLParser()
+        d.parseStr(default_html)
+        d.body.appendChild(d.createElement('div'))
+        head, tail = d.asHTML().split('<div ></div>')
+        return head, tail
+
+    def _write(self, txt: str) -> None:
+        self._pending.append(txt)
+
+    # txt: emulate the whitespace stripping of html_node_to_text() on the fly
+    def _txt_div_add(self, txt: str) -> None:
+        if not self._txt_started:
+            txt = txt.lstrip()
+        body = txt.rstrip()
+        if body:
+            self._write(self._txt_div_ws + body)
+            self._txt_div_ws = txt[len(body):]
+            self._txt_started = True
+        elif self._txt_started:
+            self._txt_div_ws += txt
+
+    def _txt_open_paragraph(self) -> None:
+        self._txt_div_add('\n')
+        self._txt_para_started = False
+        self._txt_para_ws = ''
+
+    def _txt_add(self, txt: str) -> None:
+        if not self._txt_para_started:
+            txt = txt.lstrip()
+        body = txt.rstrip()
+        if body:
+            self._txt_div_add(self._txt_para_ws + body)
+            self._txt_para_ws = txt[len(body):]
+            self._txt_para_started = True
+        elif self._txt_para_started:
+            self._txt_para_ws += txt
+
+    def _txt_close_paragraph(self) -> None:
+        self._txt_div_add('\n')
+
+    def new_paragraph(self) -> None:
+        if self.file_ext == 'html':
+            self._write('</p><p >' if self._paragraph_open else '<p >')
+        elif self.file_ext == 'txt':
+            if self._paragraph_open:
+                self._txt_close_paragraph()
+            self._txt_open_paragraph()
+        self._paragraph_open = True
+
+    def add_segment(self, start_ms: int, end_ms: int, speaker: str, seg_html: str) -> None:
+        """ seg_html: the html-escaped text of the segment (including a speaker prefix) """
+        self._segment_count += 1
+        if self.file_ext == 'html':
+            self._write(f'<a name="ts_{start_ms}_{end_ms}_{speaker}" >{seg_html}</a>')
+        elif self.file_ext == 'txt':
+            self._txt_add(html.unescape(seg_html))
+        elif self.file_ext == 'vtt':
+            txt = vtt_escape(html.unescape(seg_html))
+            self._write(f'{self._segment_count}\n{ms_to_webvtt(start_ms)} --> {ms_to_webvtt(end_ms)}\n<v {speaker}>{txt.lstrip()}\n\n')
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _closing(self) -> str:
+        if self.file_ext == 'html':
+            return '</p>' + '</div>' + self._html_tail
+        elif self.file_ext == 'txt':
+            return '\n'
+        return ''
+
+    def flush(self) -> None:
+        """ Appends everything written so far plus the closing part, so the file is complete """
+        data = ''.join(self._pending).replace('\n', os.linesep).encode('utf-8')
+        self._pending = []
+        self._file.seek(self._tail_pos)
+        self._file.write(data)
+        self._tail_pos += len(data)
+        self._file.write(self._closing().replace('\n', os.linesep).encode('utf-8'))
+        self._file.truncate()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_flush = time.monotonic()
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+# Audio decoding
+
+def shared_memory_fits(size: int) -> bool:
+    """ Whether size bytes fit into /dev/shm. Docker limits it to 64 MB by default (see --shm-size),
+    and a process that writes beyond the limit is killed with SIGBUS instead of getting an error. """
+    try:
+        stat = os.statvfs('/dev/shm')
+    except (AttributeError, OSError): # Windows and macOS have no size limited /dev/shm
+        return True
+    return stat.f_bavail * stat.f_frsize >= size
+
+class AudioBuffer:
+    """ Decoded audio (16 kHz mono float32, as expected by faster-whisper and pyannote) in shared
+    memory, so that the diarization worker process can read the same samples without a copy
+    or a temporary wav file. If the audio does not fit into /dev/shm, the buffer is a memory mapped
+    file in directory (default: the temp directory), which the workers open by its path instead. """
+
+    sampling_rate = 16000
+
+    def __init__(self, samples: int, name: str = None, file: str = None, directory: str = None):
+        self.owner = name is None and file is None
+        self.shm = None
+        self.file = file
+        if self.owner and shared_memory_fits(samples * 4):
+            self.shm = SharedMemory(create=True, size=max(samples * 4, 1))
+        elif self.owner:
+            handle, self.file = mkstemp(prefix='noScribe-audio-', suffix='.f32', dir=directory or gettempdir())
+            os.close(handle)
+        elif name is not None:
+            self.shm = attach_shared_memory(name)
+        self.samples = samples
+        if self.shm is not None:
+            self.array = np.ndarray((samples,), dtype=np.float32, buffer=self.shm.buf)
+        elif samples > 0:
+            self.array = np.memmap(self.file, dtype=np.float32, mode='w+' if self.owner else 'r+', shape=(samples,))
+        else: # an empty file cannot be mapped
+            self.array = np.zeros(0, dtype=np.float32)
+
+    @classmethod
+    def from_pcm16(cls, pcm, directory: str = None) -> 'AudioBuffer':
+        """ Converts raw signed 16 bit PCM (as produced by ffmpeg -f s16le) """
+        pcm16 = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2)
+        buffer = cls(len(pcm16), directory=directory)
+        np.divide(pcm16, 32768.0, out=buffer.array, casting='unsafe')
+        return buffer
+
+    @property
+    def name(self) -> str:
+        """ of the shared memory, None if the buffer is a file """
+        return self.shm.name if self.shm is not None else None
+
+    def location(self) -> dict:
+        """ Where another process finds the samples: {'shm': name} or {'file': path} """
+        return {'shm': self.shm.name} if self.shm is not None else {'file': self.file}
+
+    @property
+    def duration(self) -> float:
+        """ in seconds """
+        return self.samples / self.sampling_rate
+
+    def close(self) -> None:
+        self.array = None
+        if self.shm is None:
+            if self.owner:
+                with contextlib.suppress(OSError): # Windows: still mapped by a view, removed with the temp directory
+                    os.remove(self.file)
+                self.owner = False
+            return
+        try:
+            self.shm.close()
+        except BufferError:
+            pass # some views are still alive, the mapping is released together with them
+        if self.owner:
+            self.shm.unlink()
+            self.owner = False
+
+def get_ffmpeg_path() -> str:
+    local_ffmpeg_paths = {
+        'Windows': os.path.join(app_dir, 'ffmpeg.exe'),
+        'Darwin': os.path.join(app_dir, 'ffmpeg'),
+        'Linux': os.path.join(app_dir, 'ffmpeg-linux-x86_64')
+    }
+    local_ffmpeg = local_ffmpeg_paths.get(platform.system())
+
+    if local_ffmpeg and os.path.exists(local_ffmpeg):
+        return local_ffmpeg
+    ffmpeg_path_in_path = shutil.which("ffmpeg")
+    if ffmpeg_path_in_path:
+        return ffmpeg_path_in_path
+    raise FileNotFoundError("ffmpeg not found in app directory or system PATH.")
+
+def decode_audio_to_buffer(audio_file: str, start_time: str = '00:00:00', stop_time: str = '', log_callback=print,
+                           cancel: CancellationToken = None, progress_callback=None, threads: int = 0,
+                           directory: str = None) -> AudioBuffer:
+    """ Decodes (a part of) any audio/video file with ffmpeg. The samples are piped
+    directly into memory, no temporary file is written (unless the AudioBuffer does not fit into
+    shared memory, see there). progress_callback receives the number of seconds decoded so far.
+    threads limits the decoder threads of ffmpeg (0 = ffmpeg's default). """
+    end_pos_cmd = f'-to {stop_time}' if stop_time else ''
+    threads_cmd = f'-threads {threads}' if threads else ''
+    arguments = f' -loglevel warning -hwaccel auto -y -ss {start_time} {end_pos_cmd} {threads_cmd} -i "{audio_file}" -ar 16000 -ac 1 -c:a pcm_s16le -f s16le pipe:1'
+    ffmpeg_cmd = f'"{get_ffmpeg_path()}"' + arguments
+
+    if platform.system() in ("Darwin", "Linux"):
+        ffmpeg_cmd = shlex.split(ffmpeg_cmd)
+
+    startupinfo = None
+    if platform.system() == 'Windows':
+        startupinfo = STARTUPINFO()
+        startupinfo.dwFlags |= STARTF_USESHOWWINDOW
+
+    with Popen(ffmpeg_cmd, stdout=PIPE, stderr=PIPE, startupinfo=startupinfo) as ffmpeg_proc:
+        def log_stderr():
+            for line in ffmpeg_proc.stderr:
+                log_callback(f'ffmpeg: {line.decode("utf-8", errors="replace").strip()}')
+        stderr_thread = threading.Thread(target=log_stderr, daemon=True)
+        stderr_thread.start()
+        if cancel is not None:
+            cancel.on_cancel(ffmpeg_proc.kill)
+        try:
+            pcm = bytearray()
+            while True:
+                chunk = ffmpeg_proc.stdout.read(1 << 20)
+                if not chunk:
+                    break
+                pcm += chunk
+                if progress_callback is not None:
+                    progress_callback(len(pcm) / (2 * 16000))
+            ffmpeg_proc.wait()
+            stderr_thread.join()
+        finally:
+            if cancel is not None:
+                cancel.remove_callback(ffmpeg_proc.kill)
+    if cancel is not None:
+        cancel.check()
+    if ffmpeg_proc.returncode != 0:
+        raise Exception(f'ffmpeg conversion failed with code {ffmpeg_proc.returncode}.')
+    return AudioBuffer.from_pcm16(pcm, directory)
+
+class ProgressiveAudio:
+    """ Decodes audio that is still arriving: a file that is being written (e.g. by a download,
+    complete() returns True once it is written completely) or a binary stream such as a pipe.
+    The decoded samples grow while the input grows; wait() blocks until enough of them are there. """
+
+    sampling_rate = AudioBuffer.sampling_rate
+
+    def __init__(self, source, complete=None, start_time: str = '00:00:00', stop_time: str = '', log_callback=print,
+                 cancel: CancellationToken = None, progress_callback=None, end_callback=None, threads: int = 0,
+                 poll_interval: float = 0.5):
+        self.source = source
+        self.complete = complete or (lambda: True)
+        self.cancel = cancel
+        self.progress_callback = progress_callback
+        self.end_callback = end_callback # receives the duration in seconds when the input has ended
+        self.poll_interval = poll_interval
+        self.samples = 0
+        self.ended = False
+        self._array = np.zeros(60 * self.sampling_rate, dtype=np.float32)
+        self._condition = threading.Condition()
+
+        ffmpeg_cmd = [get_ffmpeg_path(), '-loglevel', 'warning', '-y', '-ss', start_time]
+        if stop_time:
+            ffmpeg_cmd += ['-to', stop_time]
+        if threads:
+            ffmpeg_cmd += ['-threads', str(threads)]
+        ffmpeg_cmd += ['-i', 'pipe:0', '-ar', '16000', '-ac', '1', '-c:a', 'pcm_s16le', '-f', 's16le', 'pipe:1']
+        startupinfo = None
+        if platform.system() == 'Windows':
+            startupinfo = STARTUPINFO()
+            startupinfo.dwFlags |= STARTF_USESHOWWINDOW
+        self._proc = Popen(ffmpeg_cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, startupinfo=startupinfo)
+        if cancel is not None:
+            cancel.on_cancel(self._proc.kill)
+
+        def log_stderr():
+            for line in self._proc.stderr:
+                log_callback(f'ffmpeg: {line.decode("utf-8", errors="replace").strip()}')
+        self._threads = [threading.Thread(target=target, daemon=True, name=f'noScribe-progressive-{name}')
+                         for name, target in (('feed', self._feed), ('decode', self._decode), ('log', log_stderr))]
+        for thread in self._threads:
+            thread.start()
+
+    def _feed(self) -> None:
+        """ Copies the input to ffmpeg. A growing file is followed until complete() is True. """
+        try:
+            if isinstance(self.source, str):
+                while not os.path.exists(self.source) and not self.complete():
+                    if self._proc.poll() is not None:
+                        return
+                    time.sleep(self.poll_interval)
+                with open(self.source, 'rb') as file:
+                    while True:
+                        complete = self.complete() # checked before reading, so nothing written after it is missed
+                        block = file.read(1 << 20)
+                        if block:
+                            self._proc.stdin.write(block)
+                        elif complete or self._proc.poll() is not None: # complete, or ffmpeg was killed
+                            break
+                        else:
+                            time.sleep(self.poll_interval)
+            else:
+                for block in iter(lambda: self.source.read(1 << 20), b''):
+                    self._proc.stdin.write(block)
+        except OSError: # ffmpeg has ended (canceled or failed), or the file has disappeared
+            pass
+        finally:
+            try:
+                self._proc.stdin.close()
+            except OSError:
+                pass
+
+    def _decode(self) -> None:
+        pending = b''
+        try:
+            for chunk in iter(lambda: self._proc.stdout.read1(1 << 16), b''):
+                pending += chunk
+                usable = len(pending) // 2 * 2
+                samples = np.frombuffer(pending, dtype=np.int16, count=usable // 2).astype(np.float32) / 32768.0
+                pending = pending[usable:]
+                with self._condition:
+                    if self.samples + len(samples) > len(self._array):
+                        # a new array: views of the old one that were handed out stay valid
+                        array = np.zeros(max(2 * len(self._array), self.samples + len(samples)), dtype=np.float32)
+                        array[:self.samples] = self._array[:self.samples]
+                        self._array = array
+                    self._array[self.samples:self.samples + len(samples)] = samples
+                    self.samples += len(samples)
+                    self._condition.notify_all()
+                if self.progress_callback is not None:
+                    self.progress_callback(self.duration)
+            self._proc.wait()
+        finally:
+            with self._condition:
+                self.ended = True
+                self._condition.notify_all()
+            if self.end_callback is not None and self._proc.returncode == 0:
+                self.end_callback(self.duration)
+
+    @property
+    def duration(self) -> float:
+        """ of the audio decoded so far, in seconds """
+        return self.samples / self.sampling_rate
+
+    def wait(self, samples: int) -> int:
+        """ Waits until at least samples are decoded or the input has ended, returns the number of samples available """
+        with self._condition:
+            while self.samples < samples and not self.ended:
+                self._condition.wait(self.poll_interval)
+                if self.cancel is not None:
+                    self.cancel.check()
+            available = self.samples
+        if self.cancel is not None:
+            self.cancel.check()
+        if self.ended and self._proc.returncode != 0:
+            raise Exception(f'ffmpeg conversion failed with code {self._proc.returncode}.')
+        return available
+
+    def view(self, start: int, end: int) -> np.ndarray:
+        """ Decoded samples, without a copy """
+        with self._condition:
+            return self._array[start:min(end, self.samples)]
+
+    def to_buffer(self, directory: str = None) -> AudioBuffer:
+        """ The complete audio in shared memory (e.g. for the diarization), after the input has ended """
+        self.wait(float('inf'))
+        buffer = AudioBuffer(self.samples, directory=directory)
+        buffer.array[:] = self._array[:self.samples]
+        return buffer
+
+    def close(self) -> None:
+        if self.cancel is not None:
+            self.cancel.remove_callback(self._proc.kill)
+        if self._proc.poll() is None:
+            self._proc.kill()
+        for thread in self._threads:
+            thread.join()
+        self._proc.wait()
+        self._array = None
+
+# Language detection
+
+def detect_language(model, audio: np.ndarray, vad_parameters: 'VadOptions', num_windows: int = 5,
+                    threshold: float = 0.5, sampling_rate: int = 16000, log_callback=print, speech: list = None,
+                    cancel: CancellationToken = None) -> tuple:
+    """ Detects the language from a few speech windows spread over the whole recording instead of
+    processing the entire audio. Each window is taken from the speech (found by the VAD, or given in
+    speech for the whole audio) within a probe range of the recording. Windows with a probability
+    below threshold do not vote (unless no window reaches it). Returns (language, probability) or (None, 0.0). """
+    detection_start = time.perf_counter()
+    window_len = 30 * sampling_rate # whisper looks at 30 seconds at most
+    probe_len = 2 * window_len
+    total = len(audio)
+    if total <= probe_len * num_windows:
+        num_windows = max(1, min(num_windows, total // probe_len))
+    probes = []
+    for i in range(num_windows):
+        probe_start = int((i + 0.5) * total / num_windows - probe_len / 2)
+        probe_start = max(0, min(probe_start, total - probe_len))
+        probes.append((probe_start, min(total, probe_start + probe_len)))
+
+    results = []
+    for probe_start, probe_end in iter_cancelable(probes, cancel):
+        if speech is not None:
+            probe_speech = [{'start': max(ts['start'], probe_start) - probe_start, 'end': min(ts['end'], probe_end) - probe_start}
+                            for ts in speech if ts['end'] > probe_start and ts['start'] < probe_end]
+        else:
+            probe_speech = get_speech_timestamps(audio[probe_start:probe_end], vad_parameters)
+        chunks, length = [], 0
+        for ts in probe_speech:
+            chunk = audio[probe_start + ts['start']:probe_start + min(ts['end'], ts['start'] + window_len - length)]
+            chunks.append(chunk)
+            length += len(chunk)
+            if length >= window_len:
+                break
+        if length < sampling_rate: # less than a second of speech
+            continue
+        language, probability, _ = model.detect_language(np.concatenate(chunks))
+        results.append((language, probability))
+
+    votes = {}
+    for language, probability in results:
+        if probability >= threshold:
+            votes[language] = votes.get(language, 0.0) + probability
+    if not votes: # no confident window, take the best guess
+        for language, probability in results:
+            votes[language] = votes.get(language, 0.0) + probability
+    detection_time = time.perf_counter() - detection_start
+    if not votes:
+        log_callback(f'Language detection: no speech found ({detection_time:.1f}s).')
+        return None, 0.0
+    language = max(votes, key=votes.get)
+    probability = max(p for l, p in results if l == language)
+    log_callback(f'Language detection: {len(results)} of {len(probes)} windows used, '
+                 f'votes {dict((l, round(v, 2)) for l, v in votes.items())} ({detection_time:.1f}s).')
+    return language, probability
+
+# Diarization worker
+
+class DiarizationWorker:
+    """ Long-lived diarize.py process (started with --worker) that loads the pyannote pipeline
+    only once and then processes one job after another. A crashed worker is restarted
+    automatically; after max_jobs jobs (0 = unlimited) it is recycled to release memory.
+    script replaces diarize.py by another program speaking the same protocol (e.g. for benchmarks). """
+
+    def __init__(self, device: str, max_jobs: int = 0, script: str = None):
+        self.device = device
+        self.max_jobs = max_jobs
+        self.script = script
+        self.jobs_done = 0
+        self.proc = None
+        self._lock = threading.Lock()
+
+    def is_running(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def _start(self, log_callback) -> None:
+        python_executable = sys.executable or "python"
+        diarize_script_path = self.script or os.path.join(app_dir, 'diarize.py')
+        startupinfo = None
+        if platform.system() == 'Windows':
+            startupinfo = STARTUPINFO()
+            startupinfo.dwFlags |= STARTF_USESHOWWINDOW
+        # the thread pools of torch are limited to the CPUs of this process, every job sets its own share
+        env = os.environ.copy()
+        env.update(resources.thread_env(number_threads))
+        env['NOSCRIBE_TORCH_INTEROP_THREADS'] = str(resources.torch_threads(number_threads)[1])
+        self.proc = Popen([python_executable, diarize_script_path, '--worker', self.device],
+                          stdin=PIPE, stdout=PIPE, stderr=STDOUT, bufsize=1, encoding='UTF-8',
+                          startupinfo=startupinfo, env=env)
+        self.jobs_done = 0
+        for line in self.proc.stdout:
+            line = line.strip()
+            if line == 'ready':
+                return
+            log_callback(f'diarize: {line}')
+        self.stop()
+        raise Exception('Speaker diarization worker failed to start.')
+
+    def stop(self) -> None:
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except Exception:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def kill(self) -> None:
+        """ Stops the worker immediately, e.g. to cancel a running job (safe to call from any thread) """
+        proc = self.proc
+        if proc is not None:
+            proc.kill()
+
+    def _run_job(self, job: dict, log_callback, progress_callback=None, metrics_callback=None) -> bool:
+        """ Returns False if the worker died while processing the job """
+        self.proc.stdin.write(json.dumps(job) + '\n')
+        self.proc.stdin.flush()
+        for line in self.proc.stdout:
+            line = line.strip()
+            if line.startswith('done '):
+                return True
+            elif line.startswith('error '):
+                raise Exception(f'Speaker diarization failed: {diarization_error(line[6:])}')
+            elif line.startswith('metrics '):
+                if metrics_callback is not None:
+                    try:
+                        metrics_callback(json.loads(line[8:]))
+                    except ValueError:
+                        pass
+                continue
+            elif line.startswith('progress ') and progress_callback is not None:
+                try:
+                    step, percent = line[9:].rsplit(' ', 1)
+                    if step in diarization_steps:
+                        progress_callback(diarization_progress(step, float(percent)))
+                    continue
+                except ValueError:
+                    pass
+            log_callback(f'diarize: {line}')
+        return False
+
+    def run(self, audio, output_file: str, num_speakers: str, log_callback=print, threads: int = 0,
+            cancel: CancellationToken = None, progress_callback=None, metrics_callback=None) -> list:
+        """ audio is either an AudioBuffer (passed to the worker via shared memory or its file) or the path of an audio file.
+        If the job is canceled, the worker is killed (and restarted with the next job).
+        progress_callback receives the estimated progress of the diarization (0..1), metrics_callback
+        the timing of the pipeline steps and the peak memory of the worker (dict). """
+        job = {'output': output_file, 'num_speakers': num_speakers, 'threads': threads}
+        if isinstance(audio, AudioBuffer):
+            job.update(audio.location(), samples=audio.samples, sample_rate=audio.sampling_rate)
+        else:
+            job['audio'] = audio
+        with self._lock:
+            if cancel is not None:
+                cancel.check()
+                cancel.on_cancel(self.kill)
+            try:
+                self._run_with_retry(job, log_callback, cancel, progress_callback, metrics_callback)
+            except Exception:
+                if cancel is not None:
+                    cancel.check() # killed while starting
+                raise
+            finally:
+                if cancel is not None:
+                    cancel.remove_callback(self.kill)
+        with open(output_file, 'r') as file:
+            return yaml.safe_load(file)
+
+    def _run_with_retry(self, job: dict, log_callback, cancel: CancellationToken = None, progress_callback=None,
+                        metrics_callback=None) -> None:
+        for attempt in range(2): # retry once with a fresh worker after a crash
+            try:
+                if not self.is_running():
+                    if attempt > 0 or self.proc is not None:
+                        log_callback('Restarting speaker diarization worker...')
+                    self.stop()
+                    self._start(log_callback)
+                if self._run_job(job, log_callback, progress_callback, metrics_callback):
+                    break
+            except (BrokenPipeError, OSError):
+                pass
+            returncode = self.proc.wait() if self.proc is not None else None
+            self.proc = None
+            if cancel is not None:
+                cancel.check()
+            log_callback(f'Speaker diarization worker exited with code {returncode}.')
+        else:
+            raise Exception('Speaker diarization failed: worker crashed.')
+        self.jobs_done += 1
+        if self.max_jobs > 0 and self.jobs_done >= self.max_jobs:
+            self.stop()
+
+# Share of the steps of the pyannote pipeline in the processing time (start, end), the
+# embeddings take most of the time
+diarization_steps = {
+    'segmentation': (0.0, 0.3),
+    'speaker_counting': (0.3, 0.3),
+    'embeddings': (0.3, 0.95),
+    'discrete_diarization': (0.95, 1.0),
+}
+
+def diarization_progress(step: str, percent: float) -> float:
+    """ Overall progress of the diarization (0..1) from a 'progress <step> <pct>' line of diarize.py """
+    start, end = diarization_steps[step]
+    return start + (end - start) * min(max(percent, 0.0), 100.0) / 100
+
+def diarization_error(message: str) -> str:
+    """ The message of an 'error <message>' line of diarize.py: a JSON string, so that it fits on one line
+    (plain text from an older diarize.py) """
+    try:
+        message = json.loads(message)
+    except ValueError:
+        return message
+    return message if isinstance(message, str) else str(message)
+
+diarization_workers = {}
+diarization_workers_lock = threading.Lock()
+
+def get_diarization_worker(device: str) -> DiarizationWorker:
+    with diarization_workers_lock:
+        if device not in diarization_workers:
+            diarization_workers[device] = DiarizationWorker(device, max_jobs=int(get_config('diarize_worker_max_jobs', 20)))
+        return diarization_workers[device]
+
+def stop_diarization_workers() -> None:
+    with diarization_workers_lock:
+        for worker in diarization_workers.values():
+            worker.stop()
+
+atexit.register(stop_diarization_workers)
+
+
+
+# Checkpoints
+
+# Segments as stored in checkpoints (same attributes as the segments/words of faster-whisper)
+TranscriptSegment = namedtuple('TranscriptSegment', ['start', 'end', 'text', 'words'])
+TranscriptWord = namedtuple('TranscriptWord', ['start', 'end', 'word'])
+
+def segment_to_json(segment: TranscriptSegment) -> str:
+    words = [[w.start, w.end, w.word] for w in segment.words] if segment.words else []
+    return json.dumps([segment.start, segment.end, segment.text, words])
+
+def segment_from_json(line: str) -> TranscriptSegment:
+    start, end, text, words = json.loads(line)
+    return TranscriptSegment(start, end, text, [TranscriptWord(*w) for w in words])
+
+def save_pcm16(audio: AudioBuffer, file: str) -> None:
+    """ Saves the audio as 16 bit PCM (the resolution delivered by ffmpeg) to save space """
+    tmp_file = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp'
+    pcm = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.int16, shape=(audio.samples,))
+    chunk_len = 10 * 60 * audio.sampling_rate
+    for pos in range(0, audio.samples, chunk_len):
+        pcm[pos:pos + chunk_len] = np.round(audio.array[pos:pos + chunk_len] * 32768.0).clip(-32768, 32767)
+    pcm.flush()
+    del pcm
+    os.replace(tmp_file, file)
+
+def load_pcm16(file: str, directory: str = None):
+    """ Loads audio saved with save_pcm16 into a new AudioBuffer, None if it does not exist """
+    try:
+        pcm = np.load(file, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    audio = AudioBuffer(len(pcm), directory=directory)
+    chunk_len = 10 * 60 * audio.sampling_rate
+    for pos in range(0, audio.samples, chunk_len):
+        np.divide(pcm[pos:pos + chunk_len], 32768.0, out=audio.array[pos:pos + chunk_len], casting='unsafe')
+    del pcm
+    return audio
+
+checkpoints_dir = os.path.join(config_dir, 'checkpoints')
+
+class TranscriptionCheckpoint:
+    """ Saves the state of a running transcription (converted audio, diarization, detected
+    language and all segments emitted so far) in the user config directory, so that an
+    interrupted job can be resumed from the last completed segment. The checkpoint is
+    identified by a hash of the input file and all options that influence the segments,
+    and removed after the job finished successfully. """
+
+    def __init__(self, options: dict, sync_interval: float = 30.0):
+        self.options_hash = hashlib.sha1(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
+        self.dir = os.path.join(checkpoints_dir, self.options_hash)
+        self.sync_interval = sync_interval
+        self.meta = {}
+        self._segments_file = None
+        self._last_sync = time.monotonic()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def _save_meta(self) -> None:
+        tmp_file = self._path('checkpoint.yml.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as file:
+            yaml.safe_dump(self.meta, file)
+        os.replace(tmp_file, self._path('checkpoint.yml'))
+
+    def load(self) -> bool:
+        """ Loads an existing checkpoint, returns False if there is none """
+        try:
+            with open(self._path('checkpoint.yml'), 'r', encoding='utf-8') as file:
+                self.meta = yaml.safe_load(file) or {}
+        except (OSError, yaml.YAMLError):
+            return False
+        return self.meta.get('options_hash') == self.options_hash
+
+    def start(self) -> None:
+        """ Starts a new checkpoint, discarding old data """
+        self.remove()
+        os.makedirs(self.dir, exist_ok=True)
+        self.meta = {'options_hash': self.options_hash, 'created': datetime.datetime.now().isoformat()}
+        self._save_meta()
+        self.remove_expired()
+
+    @staticmethod
+    def remove_expired(max_age_days: float = 7) -> None:
+        if not os.path.isdir(checkpoints_dir):
+            return
+        for entry in os.scandir(checkpoints_dir):
+            if entry.is_dir() and time.time() - entry.stat().st_mtime > max_age_days * 86400:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def save_audio(self, audio: AudioBuffer, cached_file: str = None) -> None:
+        """ Saves the converted audio. If it is in the stage cache already (cached_file), only the path is
+        saved, if the cache evicts it before the job is resumed, the audio is converted again. """
+        if cached_file is not None:
+            self.meta['audio_file'] = cached_file
+            self._save_meta()
+        else:
+            save_pcm16(audio, self._path('audio.npy'))
+
+    def load_audio(self, directory: str = None):
+        return load_pcm16(self.meta.get('audio_file') or self._path('audio.npy'), directory)
+
+    def save_diarization(self, diarization: list) -> None:
+        self.meta['diarization'] = diarization
+        self._save_meta()
+
+    def load_diarization(self):
+        return self.meta.get('diarization')
+
+    def save_language(self, language: str) -> None:
+        self.meta['language'] = language
+        self._save_meta()
+
+    def load_language(self):
+        return self.meta.get('language')
+
+    def add_segment(self, segment: TranscriptSegment) -> None:
+        if self._segments_file is None:
+            self._segments_file = open(self._path('segments.jsonl'), 'a', encoding='utf-8')
+        self._segments_file.write(segment_to_json(segment) + '\n')
+        self._segments_file.flush()
+        if time.monotonic() - self._last_sync >= self.sync_interval:
+            os.fsync(self._segments_file.fileno())
+            self._last_sync = time.monotonic()
+
+    def load_segments(self) -> list:
+        segments = []
+        try:
+            with open(self._path('segments.jsonl'), 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        segments.append(segment_from_json(line))
+                    except ValueError:
+                        break # incomplete last line
+        except OSError:
+            pass
+        # rewrite the file to drop an incomplete last line
+        with open(self._path('segments.jsonl'), 'w', encoding='utf-8') as file:
+            for segment in segments:
+                file.write(segment_to_json(segment) + '\n')
+        return segments
+
+    def close(self) -> None:
+        if self._segments_file is not None:
+            self._segments_file.close()
+            self._segments_file = None
+
+    def remove(self) -> None:
+        self.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def offset_segments(segments, offset: float, checkpoint: TranscriptionCheckpoint = None):
+    """ Shifts whisper segments (transcribed from a later part of the audio) by offset seconds
+    and records them in the checkpoint """
+    for segment in segments:
+        words = [TranscriptWord(w.start + offset, w.end + offset, w.word) for w in segment.words] if segment.words else []
+        segment = TranscriptSegment(segment.start + offset, segment.end + offset, segment.text, words)
+        if checkpoint is not None:
+            checkpoint.add_segment(segment)
+        yield segment
+
+def tap_segments(segments, callback):
+    """ Passes every segment to callback on its way through """
+    for segment in segments:
+        callback(segment)
+        yield segment
+
+def spool_segments(segments, file: str):
+    """ Writes every segment to file (one JSON line each) on its way through """
+    with open(file, 'w', encoding='utf-8') as spool:
+        for segment in segments:
+            spool.write(segment_to_json(segment) + '\n')
+            yield segment
+
+def read_segments(file: str):
+    """ The segments written by spool_segments, one at a time """
+    with open(file, 'r', encoding='utf-8') as spool:
+        for line in spool:
+            yield segment_from_json(line)
+
+# Stage cache
+
+stage_cache_dir = os.path.join(appdirs.user_cache_dir('noScribe'), 'stages')
+
+class StageCache:
+    """ Content-addressed disk cache for the results of the single stages of a transcription
+    (converted audio, VAD timestamps, diarization, language, whisper segments). Every entry is
+    identified by a hash of its inputs: the content of the audio file and the options that
+    influence this stage. Changing e.g. the number of speakers only re-runs the diarization.
+    The least recently used entries are removed if the cache grows beyond max_size_mb. """
+
+    def __init__(self, cache_dir: str = stage_cache_dir, max_size_mb: float = 2048):
+        self.dir = cache_dir
+        self.max_size = max_size_mb * 1024 * 1024
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def _path(self, stage: str, key: str, ext: str) -> str:
+        return os.path.join(self.dir, stage, f'{key}.{ext}')
+
+    def _get(self, stage: str, key: str, ext: str):
+        """ Returns the path of an existing entry and marks it as recently used """
+        path = self._path(stage, key, ext)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def _put(self, stage: str, key: str, ext: str, write) -> None:
+        """ Writes an entry atomically with write(tmp_file), then evicts old entries """
+        path = self._path(stage, key, ext)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_file = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            write(tmp_file)
+            os.replace(tmp_file, path)
+        except OSError as e:
+            logging.warning(f'Stage cache: cannot write {path}: {e}')
+            return
+        self.evict()
+
+    def file_hash(self, file: str) -> str:
+        """ Hash of the content of file. Remembered for the same path, size and modification time,
+        so unchanged files are only read once. """
+        stat = os.stat(file)
+        stat_key = self.make_key(os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+        path = self._get('files', stat_key, 'txt')
+        if path is not None:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read().strip()
+        sha = hashlib.sha1()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(block)
+        content_hash = sha.hexdigest()
+        def write(tmp_file):
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(content_hash)
+        self._put('files', stat_key, 'txt', write)
+        return content_hash
+
+    def get_json(self, stage: str, key: str):
+        path = self._get(stage, key, 'json')
+        if path is None:
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put_json(self, stage: str, key: str, data) -> None:
+        def write(tmp_file):
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+        self._put(stage, key, 'json', write)
+
+    def get_audio(self, key: str, directory: str = None):
+        path = self._get('audio', key, 'npy')
+        return load_pcm16(path, directory) if path is not None else None
+
+    def put_audio(self, key: str, audio: AudioBuffer) -> None:
+        self._put('audio', key, 'npy', lambda tmp_file: save_pcm16(audio, tmp_file))
+
+    def get_segments(self, key: str):
+        """ Segments stored with put_file('segments', key, 'jsonl', <file written by spool_segments>) """
+        path = self._get('segments', key, 'jsonl')
+        if path is None:
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return [segment_from_json(line) for line in f]
+        except (OSError, ValueError):
+            return None
+
+    def get_file(self, stage: str, key: str, ext: str):
+        """ Path of a cached file (e.g. a finished transcript), None if it is not in the cache """
+        return self._get(stage, key, ext)
+
+    def put_file(self, stage: str, key: str, ext: str, file: str) -> None:
+        self._put(stage, key, ext, lambda tmp_file: shutil.copyfile(file, tmp_file))
+
+    def evict(self) -> None:
+        """ Removes the least recently used entries until the cache fits into max_size """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            entries = []
+            for stage_dir in os.scandir(self.dir):
+                if stage_dir.is_dir():
+                    for entry in os.scandir(stage_dir.path):
+                        if entry.is_file() and not entry.name.endswith('.tmp'):
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+# Parallel transcription
+
+def split_at_silence(audio: np.ndarray, vad_parameters: 'VadOptions', chunk_len: int, min_chunk_len: int = 0,
+                     speech: list = None) -> list:
+    """ Cuts the audio into chunks of about chunk_len samples. Cuts are placed in the middle of
+    the pauses between the speech found by the VAD (or given in speech), so no word is split.
+    Returns a list of (start, end) sample positions covering the whole audio. """
+    if speech is None:
+        speech = get_speech_timestamps(audio, vad_parameters)
+    chunks = []
+    chunk_start = 0
+    for speech_before, speech_after in zip(speech, speech[1:]):
+        cut = (speech_before['end'] + speech_after['start']) // 2
+        if cut - chunk_start >= chunk_len:
+            chunks.append((chunk_start, cut))
+            chunk_start = cut
+    if chunks and len(audio) - chunk_start < min_chunk_len:
+        chunks[-1] = (chunks[-1][0], len(audio)) # avoid a tiny last chunk
+    else:
+        chunks.append((chunk_start, len(audio)))
+    return chunks
+
+transcription_worker_cancel = None # in a worker process of TranscriptionWorkerPool: set when the job is canceled
+
+def init_transcription_worker(cancel_event) -> None:
+    global transcription_worker_cancel
+    transcription_worker_cancel = cancel_event
+
+def transcribe_chunk(location: dict, samples: int, chunk_start: int, chunk_end: int, model_args: dict, transcribe_args: dict) -> list:
+    """ Runs in a worker process: transcribes one chunk of the shared audio buffer (see AudioBuffer.location)
+    and returns the segments with absolute timestamps (seconds from the start of the buffer). The model stays
+    in the whisper model pool of the process for the next chunk or job. Stops after the current segment
+    if the job is canceled. """
+    audio = AudioBuffer(samples, name=location.get('shm'), file=location.get('file'))
+    model = whisper_model_pool.acquire(**model_args)
+    try:
+        offset = chunk_start / audio.sampling_rate
+        segments, info = model.transcribe(audio.array[chunk_start:chunk_end], **transcribe_args)
+        chunk_segments = []
+        for segment in offset_segments(segments, offset):
+            if transcription_worker_cancel is not None and transcription_worker_cancel.is_set():
+                break
+            chunk_segments.append(segment)
+        return chunk_segments
+    finally:
+        whisper_model_pool.release(model)
+        audio.close()
+
+class TranscriptionWorkerPool:
+    """ Worker processes for transcribe_parallel. They are kept alive between jobs, so that every
+    process loads the whisper model only once (into its own WhisperModelPool, where it is released
+    after whisper_pool_idle_timeout like in the main process). One job at a time uses the pool. """
+
+    def __init__(self, workers: int):
+        context = multiprocessing.get_context('spawn')
+        self.workers = workers
+        self.cancel_event = context.Event()
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                            initializer=init_transcription_worker, initargs=(self.cancel_event,))
+        self.broken = False
+        self.lock = threading.Lock() # held by the job that uses the pool
+
+    def stop(self) -> None:
+        self.cancel_event.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+transcription_worker_pool = None
+transcription_worker_pool_lock = threading.Lock()
+
+def get_transcription_worker_pool(workers: int) -> TranscriptionWorkerPool:
+    """ The pool of worker processes, replaced if the number of workers changed or a process crashed """
+    global transcription_worker_pool
+    with transcription_worker_pool_lock:
+        pool = transcription_worker_pool
+        if pool is None or pool.workers != workers or pool.broken:
+            if pool is not None:
+                pool.stop()
+            transcription_worker_pool = TranscriptionWorkerPool(workers)
+        return transcription_worker_pool
+
+def stop_transcription_worker_pool() -> None:
+    global transcription_worker_pool
+    with transcription_worker_pool_lock:
+        if transcription_worker_pool is not None:
+            transcription_worker_pool.stop()
+            transcription_worker_pool = None
+
+atexit.register(stop_transcription_worker_pool)
+
+def transcribe_parallel(audio: AudioBuffer, start_sample: int, workers: int, model_args: dict, transcribe_args: dict,
+                        chunk_seconds: float, log_callback=print, speech: list = None, cancel: CancellationToken = None):
+    """ Transcribes audio[start_sample:] in the pool of worker processes, one chunk per task.
+    Yields the segments in chronological order as soon as all preceding chunks are done.
+    speech are the VAD timestamps of the whole audio, if already known. If the job is
+    canceled, waiting chunks are dropped and the running ones stop after their current segment. """
+    vad_parameters = transcribe_args['vad_parameters']
+    if speech is not None:
+        speech = [{'start': ts['start'] - start_sample, 'end': ts['end'] - start_sample}
+                  for ts in speech if ts['start'] >= start_sample]
+    chunks = split_at_silence(audio.array[start_sample:], vad_parameters, int(chunk_seconds * audio.sampling_rate),
+                              min_chunk_len=int(chunk_seconds * audio.sampling_rate / 4), speech=speech)
+    chunks = [(start_sample + chunk_start, start_sample + chunk_end) for chunk_start, chunk_end in chunks]
+    pool = get_transcription_worker_pool(workers)
+    log_callback(f'Parallel transcription: {len(chunks)} chunks, {min(workers, len(chunks))} processes with {model_args["cpu_threads"]} threads each.')
+    with pool.lock:
+        pool.cancel_event.clear()
+        def cancel_chunks():
+            pool.cancel_event.set()
+            for future in futures:
+                future.cancel()
+        futures = [pool.executor.submit(transcribe_chunk, audio.location(), audio.samples, chunk_start, chunk_end, model_args, transcribe_args)
+                   for chunk_start, chunk_end in chunks]
+        if cancel is not None:
+            cancel.on_cancel(cancel_chunks)
+        emitted_end = 0.0
+        try:
+            for future in futures:
+                try:
+                    chunk_segments = future.result()
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        pool.broken = True # a worker crashed, the next job starts new processes
+                    if cancel is not None:
+                        cancel.check()
+                    raise
+                if cancel is not None:
+                    cancel.check() # the chunk may have stopped early
+                # The chunks are cut in pauses, but whisper's timestamps can reach into the neighbouring chunk:
+                # a segment that mostly lies in the part the previous chunk already covered is a duplicate.
+                seam = emitted_end
+                for segment in chunk_segments:
+                    overlap = seam - segment.start
+                    if overlap > 0 and overlap >= (segment.end - segment.start) / 2:
+                        continue
+                    emitted_end = max(emitted_end, segment.end)
+                    yield segment
+        finally:
+            if cancel is not None:
+                cancel.remove_callback(cancel_chunks)
+            # e.g. the transcription failed: do not leave the remaining chunks running for the next job
+            cancel_chunks()
+            for future in futures:
+                with contextlib.suppress(Exception):
+                    future.exception()
+
+# Progressive transcription
+
+def transcribe_progressive(stream: ProgressiveAudio, model, transcribe_args: dict, chunk_seconds: float,
+                           log_callback=print, cancel: CancellationToken = None, start: float = 0.0, previous: list = None):
+    """ Transcribes the audio while it is still decoded (see ProgressiveAudio). As soon as a chunk of
+    about chunk_seconds is followed by a pause (placed like in split_at_silence), it is transcribed,
+    conditioned on the text of the previous chunk. Once the input has ended, the rest is transcribed
+    at once. Yields the segments with absolute timestamps. A resumed transcription starts at start
+    (in seconds), conditioned on the previous segments. """
+    sampling_rate = stream.sampling_rate
+    chunk_len = int(chunk_seconds * sampling_rate)
+    vad_parameters = transcribe_args['vad_parameters']
+    position = int(start * sampling_rate) # samples before this are transcribed
+    wanted = chunk_len
+    previous = list(previous or [])[-10:]
+    while True:
+        available = stream.wait(position + wanted)
+        ended = stream.ended
+        window = stream.view(position, available)
+        if ended:
+            chunks = [(0, len(window))] if len(window) >= sampling_rate else []
+        else:
+            # the last chunk ends with the audio decoded so far, maybe in the middle of a word
+            chunks = split_at_silence(window, vad_parameters, chunk_len)[:-1]
+            if not chunks and len(window) >= 3 * chunk_len: # no pause at all, e.g. music
+                chunks = [(0, chunk_len)]
+        if not chunks and not ended:
+            wanted += chunk_len // 2
+            continue
+        for chunk_start, chunk_end in chunks:
+            if cancel is not None:
+                cancel.check()
+            log_callback(f'Progressive transcription: {ms_to_str((position + chunk_start) / sampling_rate * 1000)} - '
+                         f'{ms_to_str((position + chunk_end) / sampling_rate * 1000)}'
+                         f'{"" if ended else f" (decoded so far: {ms_to_str(stream.duration * 1000)})"}')
+            segments, info = model.transcribe(window[chunk_start:chunk_end], **transcribe_args,
+                                              initial_prompt=''.join(segment.text for segment in previous[-10:]) or None)
+            for segment in offset_segments(segments, (position + chunk_start) / sampling_rate):
+                previous.append(segment)
+                del previous[:-10]
+                yield segment
+        if ended:
+            return
+        position += chunks[-1][1]
+        wanted = chunk_len
+
+# Speaker assignment
+
+class SpeakerAssigner:
+    """ Assigns the speakers found by the diarization to transcript segments (or words).
+    The speaker with the largest overlap wins. Instead of scanning all diarization turns for
+    every segment, a sweep line moves over the time-sorted turns and only keeps the turns that
+    are currently active, so a whole transcript is processed in linear time. Queries are
+    expected in chronological order (as whisper produces them); going back in time restarts
+    the sweep. """
+
+    def __init__(self, diarization: list):
+        turns = sorted(diarization, key=lambda turn: turn['start'])
+        self.starts = [turn['start'] for turn in turns]
+        self.ends = [turn['end'] for turn in turns]
+        self.labels = [f'S{turn["label"][8:]}' for turn in turns]
+        self._reset()
+
+    def _reset(self) -> None:
+        self._next = 0 # next turn to enter the sweep
+        self._active = [] # indices of turns that may overlap the current query, in start order
+        self._last_start = float('-inf')
+
+    def _advance(self, start, end) -> list:
+        if start < self._last_start:
+            self._reset()
+        self._last_start = start
+        while self._next < len(self.starts) and self.starts[self._next] < end:
+            self._active.append(self._next)
+            self._next += 1
+        # turns that ended before 'start' cannot overlap this or any later query
+        if any(self.ends[i] <= start for i in self._active):
+            self._active = [i for i in self._active if self.ends[i] > start]
+        return self._active
+
+    def find_speaker(self, start, end) -> str:
+        """ Returns the speaker with the largest overlap with [start, end] (in ms), or '' """
+        spkr, max_overlap = '', 0.0
+        for i in self._advance(start, end):
+            overlap = min(self.ends[i], end) - max(self.starts[i], start)
+            if overlap > max_overlap:
+                max_overlap = overlap
+                spkr = self.labels[i]
+        return spkr
+
+    def find_speaker_for_words(self, words) -> str:
+        """ Word level assignment: sums up the overlap of every word (with start/end in seconds,
+        as produced by whisper with word_timestamps=True) per speaker. """
+        overlaps = {}
+        for word in words:
+            word_start = round(word.start * 1000.0)
+            word_end = round(word.end * 1000.0)
+            for i in self._advance(word_start, word_end):
+                overlap = min(self.ends[i], word_end) - max(self.starts[i], word_start)
+                if overlap > 0:
+                    overlaps[self.labels[i]] = overlaps.get(self.labels[i], 0) + overlap
+        if not overlaps:
+            return ''
+        return max(overlaps, key=overlaps.get)
 
 # Main function
 def run_transcription(
@@ -201,11 +1961,44 @@ def run_transcription(
     timestamps: bool = False,
     disfluencies: bool = True,
     pause_option: str = '1sec+',
-    log_callback=print
+    log_callback=print,
+    resume: bool = True,
+    cancel: CancellationToken = None,
+    progress_callback=None,
+    metrics_file: str = None,
+    audio_complete=None,
+    segment_callback=None,
+    checkpoint_id: str = None,
+    threads: int = None
 ):
+    """ If resume is True and an earlier run with the same audio and options was interrupted,
+    the transcription continues from its checkpoint. cancel.cancel() (from another thread) stops
+    the job and raises TranscriptionCanceled; the checkpoint is kept, so it can be resumed later.
+    progress_callback receives ProgressEvents (possibly from other threads). Timing and memory of the
+    stages are written as JSON to metrics_file (default: a new file in the metrics directory).
+    If audio_complete is given, audio_file is still being written (e.g. downloaded) and is transcribed
+    progressively while it grows; audio_complete() returns True once the file is complete.
+    segment_callback receives every TranscriptSegment as soon as whisper has produced it (before the
+    speakers are assigned), e.g. to show a preliminary transcript. checkpoint_id identifies the audio
+    in the checkpoint instead of the size and modification time of audio_file (e.g. the id of a
+    download); a progressive transcription is only checkpointed with it. threads limits the CPU threads of
+    this transcription (default: the threads setting), callers that run several at once pass their share. """
     proc_start_time = datetime.datetime.now()
+    if cancel is None:
+        cancel = CancellationToken()
+    progress = None
+    metrics = JobMetrics()
+    metrics.extra.update({'audio_file': audio_file, 'transcript_file': transcript_file, 'started': proc_start_time.isoformat(),
+                          'model': whisper_model_name, 'language': language_name, 'speaker_detection': speaker_detection,
+                          'status': 'error', 'cpu_limit': resources.cpu_limit(), 'memory_limit_mb': resources.memory_limit_mb()})
     tmpdir = TemporaryDirectory(prefix='noScribe-')
-    tmp_audio_file = os.path.join(tmpdir.name, 'tmp_audio.wav')
+    audio = None
+    stream = None
+    writer = None
+    checkpoint = None
+    model = None
+    diarization_executor = None
+    diarization_cancel = None
 
     try:
         if not audio_file:
@@ -222,15 +2015,12 @@ def run_transcription(
         whisper_compute_type = get_config('whisper_compute_type', 'default')
         timestamp_interval = get_config('timestamp_interval', 60_000)
         timestamp_color = get_config('timestamp_color', '#78909C')
+        thread_budget = max(1, min(int(threads), number_threads)) if threads else number_threads
 
         start = millisec(start_time) if start_time and start_time != '00:00:00' else 0
         stop = millisec(stop_time) if stop_time else 0
 
-        whisper_model_paths = get_whisper_models()
-        if whisper_model_name in whisper_model_paths:
-            whisper_model = whisper_model_paths[whisper_model_name]
-        else:
-            raise FileNotFoundError(f"The whisper model '{whisper_model_name}' does not exist.")
+        whisper_model = resolve_whisper_model(whisper_model_name)
 
         pause = ['none', '1sec+', '2sec+', '3sec+'].index(pause_option)
         pause_marker = get_config('pause_seconds_marker', '.')
@@ -244,114 +2034,235 @@ def run_transcription(
         pyannote_xpu = 'cpu'
         whisper_xpu = 'cpu'
         if platform.system() in ('Windows', 'Linux'):
-            cuda_available = torch.cuda.is_available() and get_cuda_device_count() > 0
-            pyannote_xpu = get_config('pyannote_xpu', 'cuda' if cuda_available else 'cpu')
-            whisper_xpu = get_config('whisper_xpu', 'cuda' if cuda_available else 'cpu')
+            pyannote_xpu = get_config('pyannote_xpu', 'cuda' if cuda_available() else 'cpu')
+            whisper_xpu = get_config('whisper_xpu', 'cuda' if cuda_available() else 'cpu')
 
 
-        # 1) Convert Audio
-        log_callback("Starting audio conversion...")
-        end_pos_cmd = f'-to {stop_time}' if stop > 0 else ''
-        arguments = f' -loglevel warning -hwaccel auto -y -ss {start_time} {end_pos_cmd} -i "{audio_file}" -ar 16000 -ac 1 -c:a pcm_s16le "{tmp_audio_file}"'
-
-        ffmpeg_path = ""
-        local_ffmpeg_paths = {
-            'Windows': os.path.join(app_dir, 'ffmpeg.exe'),
-            'Darwin': os.path.join(app_dir, 'ffmpeg'),
-            'Linux': os.path.join(app_dir, 'ffmpeg-linux-x86_64')
-        }
-        local_ffmpeg = local_ffmpeg_paths.get(platform.system())
-
-        if local_ffmpeg and os.path.exists(local_ffmpeg):
-            ffmpeg_path = local_ffmpeg
+        # Progress events, also logged as JSON lines (config dir/log)
+        progress_log = None
+        if get_config('progress_log', True):
+            progress_log = os.path.join(config_dir, 'log', f'{Path(my_transcript_file).stem}_progress.jsonl')
+        progress = ProgressReporter(progress_callback, progress_log, min_interval=float(get_config('progress_interval', 0.5)))
+        if stop > 0:
+            progress.total = (stop - start) / 1000
+        if speaker_detection != 'none':
+            progress.set_weights({'conversion': 0.05, 'diarization': 0.45, 'transcription': 0.5})
         else:
-            import shutil
-            ffmpeg_path_in_path = shutil.which("ffmpeg")
-            if ffmpeg_path_in_path:
-                ffmpeg_path = ffmpeg_path_in_path
-            else:
-                raise FileNotFoundError("ffmpeg not found in app directory or system PATH.")
+            progress.set_weights({'conversion': 0.05, 'transcription': 0.95})
 
-        ffmpeg_cmd = f'"{ffmpeg_path}"' + arguments
+        # A growing file can neither be identified by its size nor by its content,
+        # so progressive transcriptions are not cached and only checkpointed with a checkpoint_id
+        progressive = audio_complete is not None
+        # a progressive transcription decodes the audio with ffmpeg while whisper transcribes it
+        decoder_threads = 0
+        if progressive:
+            decoder_threads = resources.split_threads(thread_budget, {'decoding': 0.25, 'whisper': 0.75})['decoding']
+            decoder_threads = resources.ffmpeg_threads(decoder_threads)
 
-        if platform.system() in ("Darwin", "Linux"):
-            ffmpeg_cmd = shlex.split(ffmpeg_cmd)
+        calibration = get_calibration(whisper_model_name, whisper_xpu) if get_config('whisper_use_calibration', True) else None
+        if calibration is not None:
+            whisper_compute_type = calibration['compute_type']
 
-        startupinfo = None
-        if platform.system() == 'Windows':
-            startupinfo = STARTUPINFO()
-            startupinfo.dwFlags |= STARTF_USESHOWWINDOW
+        vad_threshold = float(get_config('voice_activity_detection_threshold', '0.5'))
+        from faster_whisper.vad import VadOptions
+        vad_parameters = VadOptions(min_silence_duration_ms=1000, threshold=vad_threshold, speech_pad_ms=400)
 
-        with Popen(ffmpeg_cmd, stdout=PIPE, stderr=STDOUT, bufsize=1, universal_newlines=True, encoding='utf-8', startupinfo=startupinfo) as ffmpeg_proc:
-            for line in ffmpeg_proc.stdout:
-                log_callback(f'ffmpeg: {line.strip()}')
-        if ffmpeg_proc.returncode != 0:
-            raise Exception(f'ffmpeg conversion failed with code {ffmpeg_proc.returncode}.')
-        log_callback("Audio conversion finished.")
+        # Long recordings can be split into chunks that are transcribed in several processes
+        parallel_workers = int(get_config('parallel_transcription_workers', 0))
+        parallel_chunk_seconds = float(get_config('parallel_transcription_chunk_minutes', 5)) * 60
+        # the configured mode, so that a job is not continued with segments from another mode. A job falls back to
+        # sequential transcription for a short rest of the audio and while it is downloaded, in both runs alike.
+        if parallel_workers > 1 and whisper_xpu == 'cpu':
+            configured_mode = f'parallel {parallel_chunk_seconds}'
+        else:
+            configured_mode = 'batched' if get_config('whisper_batched', False) else 'sequential'
 
-        # 2) Speaker identification
-        diarization = []
-        if speaker_detection != 'none':
-            log_callback("Starting speaker identification...")
-            diarize_output = os.path.join(tmpdir.name, 'diarize_out.yaml')
+        # Checkpoint: continue an interrupted job with the same input and options
+        resumed = False
+        if get_config('checkpoints', True) and (checkpoint_id is not None or not progressive):
+            if checkpoint_id is not None:
+                audio_identity = {'checkpoint_id': checkpoint_id}
+            else:
+                audio_stat = os.stat(audio_file)
+                audio_identity = {'audio_file': os.path.abspath(audio_file), 'size': audio_stat.st_size,
+                                  'mtime': audio_stat.st_mtime_ns}
+            checkpoint = TranscriptionCheckpoint({
+                **audio_identity,
+                'start': start, 'stop': stop, 'language': language_name, 'model': whisper_model,
+                'speaker_detection': speaker_detection, 'disfluencies': bool(disfluencies),
+                'compute_type': whisper_compute_type, 'vad': vars(vad_parameters), 'mode': configured_mode,
+            }, sync_interval=float(get_config('checkpoint_interval', 30)))
+            resumed = resume and checkpoint.load()
+            if not resumed:
+                checkpoint.start()
 
-            python_executable = sys.executable or "python"
-            diarize_script_path = os.path.join(app_dir, 'diarize.py')
-            diarize_cmd = f'"{python_executable}" "{diarize_script_path}" {pyannote_xpu} "{tmp_audio_file}" "{diarize_output}" {speaker_detection}'
+        # Stage cache: results of earlier runs with the same audio content and stage options
+        stage_cache = None
+        audio_key = None
+        if get_config('stage_cache', True) and not progressive:
+            stage_cache = StageCache(max_size_mb=float(get_config('stage_cache_max_size_mb', 2048)))
+            audio_key = StageCache.make_key(stage_cache.file_hash(audio_file), start, stop)
 
-            diarize_env = os.environ.copy()
+        # 1) Convert Audio
+        # Decoded only once into shared memory, used by language detection, transcription and diarization
+        if resumed and not progressive: # a progressive transcription decodes the file again while it is downloaded
+            audio = checkpoint.load_audio(tmpdir.name)
+        if audio is None and stage_cache is not None:
+            audio = stage_cache.get_audio(audio_key, tmpdir.name)
+            if audio is not None:
+                log_callback("Converted audio loaded from cache.")
+                if checkpoint is not None:
+                    checkpoint.save_audio(audio, stage_cache.get_file('audio', audio_key, 'npy'))
+        if progressive:
+            log_callback("Starting progressive audio conversion, the transcription starts before the audio is complete...")
+            progress.start('conversion')
+            conversion_started = metrics.start('conversion')
+            def conversion_finished(duration):
+                metrics.stop('conversion', conversion_started)
+                progress.total = duration
+                metrics.extra['audio_duration'] = round(duration, 3)
+                progress.finish('conversion')
+                log_callback(f"Audio conversion finished ({ms_to_str(duration * 1000)}).")
+            stream = ProgressiveAudio(audio_file, audio_complete, start_time, stop_time if stop > 0 else '', log_callback, cancel,
+                                      lambda seconds: progress.update('conversion', seconds), conversion_finished,
+                                      threads=decoder_threads)
+        elif audio is None:
+            log_callback("Starting audio conversion...")
+            progress.start('conversion')
+            with metrics.stage('conversion'):
+                audio = decode_audio_to_buffer(audio_file, start_time, stop_time if stop > 0 else '', log_callback, cancel,
+                                               lambda seconds: progress.update('conversion', seconds),
+                                               threads=resources.ffmpeg_threads(thread_budget), directory=tmpdir.name)
+            log_callback(f"Audio conversion finished ({ms_to_str(audio.duration * 1000)}).")
+            if stage_cache is not None:
+                stage_cache.put_audio(audio_key, audio)
+            if checkpoint is not None:
+                checkpoint.save_audio(audio, stage_cache.get_file('audio', audio_key, 'npy') if stage_cache is not None else None)
 
-            if platform.system() in ('Darwin', 'Linux'):
-                diarize_cmd = shlex.split(diarize_cmd)
+        if not progressive:
+            progress.total = audio.duration
+            metrics.extra['audio_duration'] = round(audio.duration, 3)
+            progress.finish('conversion')
 
-            with Popen(diarize_cmd, stdout=PIPE, stderr=STDOUT, encoding='UTF-8', startupinfo=startupinfo, env=diarize_env) as pyannote_proc:
-                for line in pyannote_proc.stdout:
-                    log_callback(f'diarize: {line.strip()}')
+        saved_segments = checkpoint.load_segments() if resumed else []
+        resume_offset = saved_segments[-1].end if saved_segments else 0.0
+        if resumed:
+            log_callback(f"Resuming the interrupted transcription at {ms_to_str(resume_offset * 1000)}.")
 
-            if pyannote_proc.returncode != 0:
-                raise Exception(f"Speaker diarization failed with code {pyannote_proc.returncode}.")
+        # 2) Speaker identification
+        # In parallel mode, pyannote runs in the diarization worker while faster-whisper transcribes.
+        # Both share the CPU budget if they run on the CPU.
+        diarization = []
+        diarization_future = None
+        diarization_key = StageCache.make_key(audio_key, speaker_detection) if stage_cache is not None else None
+        speaker_detection_needed = False
+        if speaker_detection == 'none':
+            pass
+        elif resumed and checkpoint.load_diarization() is not None:
+            diarization = checkpoint.load_diarization()
+            log_callback("Speaker identification loaded from checkpoint.")
+        elif stage_cache is not None and stage_cache.get_json('diarization', diarization_key) is not None:
+            diarization = stage_cache.get_json('diarization', diarization_key)
+            log_callback("Speaker identification loaded from cache.")
+            if checkpoint is not None:
+                checkpoint.save_diarization(diarization)
+        else:
+            speaker_detection_needed = True
+        if speaker_detection != 'none' and not speaker_detection_needed:
+            progress.finish('diarization')
+        # progressive: the speakers are identified after the transcription, in the complete audio
+        parallel_diarization = speaker_detection_needed and get_config('parallel_diarization', True) and not progressive
+        whisper_threads = max(1, thread_budget - decoder_threads)
+        diarize_threads = thread_budget
+        if parallel_diarization and pyannote_xpu == 'cpu' and whisper_xpu == 'cpu':
+            diarize_share = min(max(float(get_config('diarization_thread_share', 0.5)), 0.0), 1.0)
+            threads = resources.split_threads(thread_budget, {'diarization': diarize_share, 'whisper': 1 - diarize_share})
+            diarize_threads, whisper_threads = threads['diarization'], threads['whisper']
+        if calibration is not None:
+            # more threads than measured as fastest do not help, fewer may be all that is left next to the diarization
+            whisper_threads = min(whisper_threads, int(calibration['cpu_threads']))
+            log_callback(f"Using the calibrated settings: compute type {whisper_compute_type}, {whisper_threads} threads.")
+        metrics.extra.update({'compute_type': whisper_compute_type, 'threads': thread_budget, 'whisper_threads': whisper_threads})
 
-            with open(diarize_output, 'r') as file:
-                diarization = yaml.safe_load(file)
-            log_callback("Speaker identification finished.")
+        def start_diarization():
+            nonlocal diarization, diarization_future, diarization_executor, diarization_cancel
+            diarize_output = os.path.join(tmpdir.name, 'diarize_out.yaml')
+            diarization_worker = get_diarization_worker(pyannote_xpu)
+            diarization_progress_callback = lambda fraction: progress.update('diarization', fraction * audio.duration)
+            progress.start('diarization')
+            # the worker reports the time of the pipeline steps, its CPU time and memory
+            diarization_started = metrics.start('diarization')
+            diarization_metrics_callback = lambda worker_metrics: metrics.stages['diarization'].update(worker_metrics)
+            if parallel_diarization:
+                log_callback(f"Starting speaker identification in parallel (threads: diarization {diarize_threads}, transcription {whisper_threads})...")
+                diarization_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='noScribe-diarize')
+                diarization_cancel = cancel.child() # stopped on its own if the transcription fails
+                diarization_future = diarization_executor.submit(diarization_worker.run, audio, diarize_output,
+                                                                 speaker_detection, log_callback, diarize_threads, diarization_cancel,
+                                                                 diarization_progress_callback, diarization_metrics_callback)
+                diarization_future.add_done_callback(lambda future: metrics.stop('diarization', diarization_started))
+            else:
+                log_callback("Starting speaker identification...")
+                try:
+                    diarization = diarization_worker.run(audio, diarize_output, speaker_detection, log_callback, diarize_threads,
+                                                         cancel, diarization_progress_callback, diarization_metrics_callback)
+                finally:
+                    metrics.stop('diarization', diarization_started)
+                progress.finish('diarization')
+                log_callback("Speaker identification finished.")
+                if checkpoint is not None:
+                    checkpoint.save_diarization(diarization)
+                if stage_cache is not None:
+                    stage_cache.put_json('diarization', diarization_key, diarization)
 
-        # Helper for diarization
-        def find_speaker(diarization_data, transcript_start, transcript_end):
-            spkr, max_overlap = '', 0.0
-            for segment in diarization_data:
-                overlap_start = max(segment["start"], transcript_start)
-                overlap_end = min(segment["end"], transcript_end)
-                overlap_duration = overlap_end - overlap_start
-                if overlap_duration > max_overlap:
-                    max_overlap = overlap_duration
-                    spkr = f'S{segment["label"][8:]}'
-            return spkr
+        if speaker_detection_needed and not progressive:
+            start_diarization()
 
         # 3) Transcribe with faster-whisper
+        cancel.check()
         log_callback("Starting transcription...")
-        from faster_whisper import WhisperModel
-
-        model = WhisperModel(whisper_model, device=whisper_xpu, cpu_threads=number_threads, compute_type=whisper_compute_type, local_files_only=True)
+        use_parallel = not progressive and parallel_workers > 1 and whisper_xpu == 'cpu' and \
+            audio.duration - resume_offset > 2 * parallel_chunk_seconds
+        whisper_batched = get_config('whisper_batched', False) and not use_parallel and not progressive
 
         whisper_lang = languages.get(language_name)
 
-        vad_threshold = float(get_config('voice_activity_detection_threshold', '0.5'))
-        vad_parameters = VadOptions(min_silence_duration_ms=1000, threshold=vad_threshold, speech_pad_ms=400)
+        vad_key = StageCache.make_key(audio_key, vars(vad_parameters)) if stage_cache is not None else None
+        speech_timestamps = stage_cache.get_json('vad', vad_key) if stage_cache is not None else None
 
-        if language_name == 'Auto':
-            # Need to decode audio for language detection
-            sampling_rate = model.feature_extractor.sampling_rate
-            audio = decode_audio(tmp_audio_file, sampling_rate=sampling_rate)
-            lang_info = model.detect_language(audio, vad_filter=True, vad_parameters=vad_parameters)
-            if lang_info and lang_info[0]:
-                 whisper_lang = lang_info[0][0]
-                 log_callback(f"Detected language: {whisper_lang} with probability {lang_info[0][1]}")
+        language_windows = int(get_config('language_detection_windows', 5))
+        language_threshold = float(get_config('language_detection_threshold', 0.5))
+        language_key = StageCache.make_key(audio_key, whisper_model, vars(vad_parameters), language_windows,
+                                           language_threshold) if stage_cache is not None else None
+        if language_name == 'Auto' and resumed and checkpoint.load_language():
+            whisper_lang = checkpoint.load_language()
+            log_callback(f"Language from checkpoint: {whisper_lang}")
+        elif language_name == 'Auto' and stage_cache is not None and stage_cache.get_json('language', language_key):
+            whisper_lang = stage_cache.get_json('language', language_key)
+            log_callback(f"Language from cache: {whisper_lang}")
+        elif language_name == 'Auto':
+            progress.start('language')
+            with metrics.stage('model_load'):
+                model = whisper_model_pool.acquire(whisper_model, device=whisper_xpu, compute_type=whisper_compute_type,
+                                                   cpu_threads=whisper_threads, log_callback=log_callback)
+            with metrics.stage('language_detection'):
+                if progressive: # from the first minute, the transcription should not wait for more
+                    language_audio = stream.view(0, stream.wait(60 * stream.sampling_rate))
+                else:
+                    language_audio = audio.array
+                whisper_lang, lang_probability = detect_language(
+                    model, language_audio, vad_parameters, num_windows=language_windows, threshold=language_threshold,
+                    log_callback=log_callback, speech=speech_timestamps, cancel=cancel)
+            if whisper_lang:
+                 log_callback(f"Detected language: {whisper_lang} with probability {lang_probability}")
+                 if stage_cache is not None:
+                     stage_cache.put_json('language', language_key, whisper_lang)
             else:
                  whisper_lang = "en" # Default to english if detection fails
                  log_callback("Language detection failed, defaulting to English.")
-            del audio
-            gc.collect()
-
+            if checkpoint is not None:
+                checkpoint.save_language(whisper_lang)
+            progress.finish('language')
 
         prompt = ""
         if disfluencies:
@@ -362,85 +2273,230 @@ def run_transcription(
             except FileNotFoundError:
                 log_callback("prompt.yml not found, continuing without prompt.")
 
-        segments, info = model.transcribe(
-            tmp_audio_file, language=whisper_lang, beam_size=5, word_timestamps=True,
-            hotwords=prompt, vad_filter=True, vad_parameters=vad_parameters
-        )
+        # Batched inference decodes every speech chunk as a single 30 s window, so longer speech without a
+        # pause must be split by the VAD (faster-whisper only does this itself if vad_parameters is not a VadOptions)
+        whisper_vad_parameters = vad_parameters
+        if whisper_batched:
+            whisper_vad_parameters = VadOptions(**{**vars(vad_parameters), 'max_speech_duration_s': 30})
 
-        # Prepare output document
-        d = AdvancedHTMLParser.AdvancedHTMLParser()
-        d.parseStr(default_html)
-        main_body = d.createElement('div')
-        d.body.appendChild(main_body)
-
-        # Header
-        p = d.createElement('p')
-        p.setStyle('font-weight', '600')
-        p.appendText(Path(audio_file).stem)
-        main_body.appendChild(p)
-        p = d.createElement('p')
-        s = d.createElement('span')
-        s.setStyle('color', '#909090'); s.setStyle('font-size', '0.8em')
-        s.appendText(f"Transcribed with noScribe. Audio: {audio_file}")
-        p.appendChild(s)
-        main_body.appendChild(p)
-
-        # Active paragraph for writing
-        p = d.createElement('p')
-        main_body.appendChild(p)
-
-        speaker = ''
-        log_callback("Processing segments...")
-        full_text = ""
-        for segment in segments:
-            start_ms = round(segment.start * 1000.0)
-            end_ms = round(segment.end * 1000.0)
-            orig_audio_start = start + start_ms
-            orig_audio_end = start + end_ms
-
-            seg_text = segment.text
-            seg_html = html.escape(seg_text)
-
-            if speaker_detection != 'none':
-                new_speaker = find_speaker(diarization, start_ms, end_ms)
-                if speaker != new_speaker and new_speaker != '':
-                    p = d.createElement('p')
-                    main_body.appendChild(p)
-                    speaker = new_speaker
-                    if file_ext != 'vtt':
-                        speaker_prefix = f'{speaker}:'
-                        seg_text = f'{speaker_prefix}{seg_text}'
-                        seg_html = f'{html.escape(speaker_prefix)}{seg_html}'
-                        full_text += f"\n\n{speaker_prefix}"
-
-            # Append segment text
-            a_html = f'<a name="ts_{orig_audio_start}_{orig_audio_end}_{speaker}" >{seg_html}</a>'
-            a = d.createElementFromHTML(a_html)
-            p.appendChild(a)
-            full_text += seg_text
+        # the whisper segments of an earlier run with the same audio and options
+        if use_parallel:
+            transcription_mode = f'parallel {parallel_chunk_seconds}'
+        else:
+            transcription_mode = 'batched' if whisper_batched else 'sequential'
+        segments_key = StageCache.make_key(audio_key, whisper_model, whisper_compute_type, whisper_lang, prompt,
+                                           vars(whisper_vad_parameters), transcription_mode) if stage_cache is not None else None
+        cached_segments = stage_cache.get_segments(segments_key) if stage_cache is not None else None
+        if not use_parallel and cached_segments is None and model is None:
+            with metrics.stage('model_load'):
+                model = whisper_model_pool.acquire(whisper_model, device=whisper_xpu, compute_type=whisper_compute_type,
+                                                   cpu_threads=whisper_threads, log_callback=log_callback)
+        cancel.check()
+        # faster-whisper runs the VAD when transcribe() is called, the segments are decoded while iterating
+        decoding_started = metrics.start('decoding')
 
-        log_callback("\nTranscription finished.")
+        # when resuming, only the rest of the audio is transcribed (conditioned on the text so far)
+        resume_sample = int(resume_offset * AudioBuffer.sampling_rate)
+        segments_offset = resume_offset
+        if cached_segments is not None:
+            log_callback("Transcription loaded from cache.")
+        elif progressive:
+            transcribe_args = {'language': whisper_lang, 'beam_size': 5, 'word_timestamps': True, 'hotwords': prompt,
+                               'vad_filter': True, 'vad_parameters': vad_parameters}
+            new_segments = transcribe_progressive(stream, model, transcribe_args,
+                                                  float(get_config('progressive_chunk_seconds', 30)), log_callback, cancel,
+                                                  start=resume_offset, previous=saved_segments)
+            segments_offset = 0.0 # timestamps are already absolute
+        elif use_parallel:
+            if speech_timestamps is None:
+                speech_timestamps = get_speech_timestamps(audio.array, vad_parameters)
+                if stage_cache is not None:
+                    stage_cache.put_json('vad', vad_key, speech_timestamps)
+            transcribe_args = {'language': whisper_lang, 'beam_size': 5, 'word_timestamps': True, 'hotwords': prompt,
+                               'vad_filter': True, 'vad_parameters': vad_parameters}
+            model_args = {'model_path': whisper_model, 'device': whisper_xpu, 'compute_type': whisper_compute_type,
+                          'cpu_threads': max(1, whisper_threads // parallel_workers)}
+            new_segments = transcribe_parallel(audio, resume_sample, parallel_workers, model_args, transcribe_args,
+                                               parallel_chunk_seconds, log_callback, speech=speech_timestamps, cancel=cancel)
+            segments_offset = 0.0 # timestamps are already absolute
+        elif audio.samples - resume_sample >= audio.sampling_rate and whisper_batched:
+            # batched inference: speech chunks found by the VAD are decoded in batches (higher throughput,
+            # but without conditioning on the previous text)
+            from faster_whisper import BatchedInferencePipeline
+            batch_size = get_config('whisper_batch_size', 'auto')
+            if batch_size == 'auto':
+                batch_size = auto_batch_size(WhisperModelPool.estimate_size_mb(whisper_model))
+            log_callback(f"Batched transcription with batch size {batch_size}.")
+            new_segments, info = BatchedInferencePipeline(model).transcribe(
+                audio.array[resume_sample:], language=whisper_lang, beam_size=5, word_timestamps=True,
+                hotwords=prompt, vad_filter=True, vad_parameters=whisper_vad_parameters, batch_size=int(batch_size),
+                initial_prompt=''.join(segment.text for segment in saved_segments[-10:]) or None
+            )
+        elif audio.samples - resume_sample >= audio.sampling_rate:
+            new_segments, info = model.transcribe(
+                audio.array[resume_sample:], language=whisper_lang, beam_size=5, word_timestamps=True,
+                hotwords=prompt, vad_filter=True, vad_parameters=vad_parameters,
+                initial_prompt=''.join(segment.text for segment in saved_segments[-10:]) or None
+            )
+        else:
+            new_segments = []
+        metrics.stop('decoding', decoding_started)
+        if cached_segments is not None:
+            segments = cached_segments
+        else:
+            segments = itertools.chain(saved_segments, offset_segments(new_segments, segments_offset, checkpoint))
+        segments = metrics.timed_iter(segments, 'decoding')
+        # checked between segments, whisper stops after the segment it is working on
+        segments = iter_cancelable(segments, cancel)
+        progress.start('transcription', 0.0 if cached_segments is not None else resume_offset)
+        segments = progress.track(segments, 'transcription')
+        if segment_callback is not None:
+            segments = tap_segments(segments, segment_callback)
+
+        def collect_diarization():
+            nonlocal diarization, diarization_future
+            diarization = diarization_future.result()
+            diarization_future = None
+            progress.finish('diarization')
+            log_callback("Speaker identification finished.")
+            if checkpoint is not None:
+                checkpoint.save_diarization(diarization)
+            if stage_cache is not None:
+                stage_cache.put_json('diarization', diarization_key, diarization)
 
-        # Save final output
-        output_content = ""
-        if file_ext == 'html':
-            output_content = d.asHTML()
-        elif file_ext == 'txt':
-            output_content = html_to_text(d)
-        elif file_ext == 'vtt':
-            output_content = html_to_webvtt(d, audio_file)
+        def export(segments, assign_speakers: bool) -> None:
+            """ Writes the transcript while the segments come in, with the speakers if assign_speakers """
+            nonlocal writer
+            export_started = metrics.clock()
+            writer = TranscriptWriter(my_transcript_file, Path(audio_file).stem, audio_file,
+                                      flush_interval=float(get_config('transcript_flush_interval', 10)))
+            metrics.add('export', export_started)
+            speaker = ''
+            speaker_assigner = SpeakerAssigner(diarization) if assign_speakers else None
+            for segment in segments:
+                export_started = metrics.clock()
+                start_ms = round(segment.start * 1000.0)
+                end_ms = round(segment.end * 1000.0)
+                orig_audio_start = start + start_ms
+                orig_audio_end = start + end_ms
 
-        with open(my_transcript_file, 'w', encoding="utf-8") as f:
-            f.write(output_content)
+                seg_html = html.escape(segment.text)
+
+                if speaker_assigner is not None:
+                    if word_level_speakers and segment.words:
+                        new_speaker = speaker_assigner.find_speaker_for_words(segment.words)
+                    else:
+                        new_speaker = speaker_assigner.find_speaker(start_ms, end_ms)
+                    if speaker != new_speaker and new_speaker != '':
+                        writer.new_paragraph()
+                        speaker = new_speaker
+                        if file_ext != 'vtt':
+                            seg_html = f'{html.escape(speaker)}:{seg_html}'
+
+                writer.add_segment(orig_audio_start, orig_audio_end, speaker, seg_html)
+                metrics.add('export', export_started)
+
+            export_started = metrics.clock()
+            writer.close()
+            metrics.add('export', export_started)
+
+        # The segments are also spooled to a file (for the stage cache and a second pass), not kept in memory.
+        # While the speakers are still being identified (in parallel, or after the transcription in progressive
+        # mode), the transcript is written without them and rewritten from the spool once they are known.
+        segments_file = os.path.join(tmpdir.name, 'segments.jsonl')
+        if cached_segments is None:
+            segments = spool_segments(segments, segments_file)
+        if diarization_future is not None and diarization_future.done():
+            collect_diarization()
+        speakers_pending = diarization_future is not None or (progressive and speaker_detection_needed)
+        word_level_speakers = get_config('speaker_assignment', 'segment') == 'word'
+        log_callback("Processing segments...")
+        with metrics.memory('decoding', 'export'):
+            export(segments, speaker_detection != 'none' and not speakers_pending)
+        if progressive and speaker_detection_needed:
+            # the speakers can only be identified in the complete audio
+            progress.finish('transcription')
+            audio = stream.to_buffer(tmpdir.name)
+            start_diarization()
+        if diarization_future is not None:
+            progress.finish('transcription')
+            log_callback("Transcription finished, waiting for speaker identification...")
+            collect_diarization()
+        if speakers_pending:
+            log_callback("Adding the speakers to the transcript...")
+            with metrics.memory('export'):
+                export(cached_segments if cached_segments is not None else read_segments(segments_file), True)
+        progress.finish('transcription')
+        log_callback("\nTranscription finished.")
+        if stage_cache is not None and cached_segments is None:
+            stage_cache.put_file('segments', segments_key, 'jsonl', segments_file)
+        if checkpoint is not None:
+            checkpoint.remove()
 
         proc_time = datetime.datetime.now() - proc_start_time
-        log_callback(f'Transcription time: {proc_time}')
+        log_callback(f'Transcription time: {proc_time} ({metrics.summary()})')
+        log_callback(f'Whisper model pool: {whisper_model_pool.stats()}')
+        metrics.extra['status'] = 'finished'
         return my_transcript_file
 
+    except TranscriptionCanceled as e:
+        metrics.extra['status'] = 'canceled'
+        log_callback(f"Transcription canceled: {e}")
+        raise
     except Exception as e:
+        if cancel.canceled:
+            # e.g. a subprocess that was killed by the cancellation
+            metrics.extra['status'] = 'canceled'
+            log_callback(f"Transcription canceled: {cancel.reason}")
+            raise TranscriptionCanceled(cancel.reason) from e
         traceback_str = traceback.format_exc()
         log_callback(f"An error occurred: {e}\n{traceback_str}")
         raise
     finally:
+        if model is not None:
+            whisper_model_pool.release(model)
+        if diarization_executor is not None:
+            if diarization_future is not None and not diarization_future.done():
+                # the transcription failed: do not wait for pyannote to process the whole recording
+                diarization_cancel.cancel('The transcription failed.')
+            diarization_executor.shutdown(wait=True)
+        if writer is not None:
+            writer.close()
+        if checkpoint is not None:
+            checkpoint.close()
+        if audio is not None:
+            audio.close()
+        if stream is not None:
+            stream.close()
+        if progress is not None:
+            progress.close()
+        metrics.close()
+        if metrics_file is None and get_config('metrics', True):
+            metrics_dir = get_config('metrics_dir', os.path.join(config_dir, 'metrics'))
+            metrics_file = os.path.join(metrics_dir, f'{Path(transcript_file or "transcript").stem}_{proc_start_time:%Y%m%d-%H%M%S}.json')
+        if metrics_file:
+            try:
+                metrics.write(metrics_file)
+            except OSError as e:
+                log_callback(f'Cannot write the metrics report: {e}')
         tmpdir.cleanup()
         log_callback("Process complete.")
+
+if __name__ == '__main__':
+    # Batch entry point, e.g.: python transcriber.py interview.mp3 interview.html --language German
+    import argparse
+    parser = argparse.ArgumentParser(description='noScribe transcription without GUI')
+    parser.add_argument('audio_file')
+    parser.add_argument('transcript_file', help='output file (.html, .txt or .vtt)')
+    parser.add_argument('--language', default='Auto', choices=list(languages.keys()))
+    parser.add_argument('--model', default='precise', help='name of the whisper model')
+    parser.add_argument('--speakers', default='auto', help="'none', 'auto' or the number of speakers")
+    parser.add_argument('--start', default='00:00:00')
+    parser.add_argument('--stop', default='')
+    parser.add_argument('--no-disfluencies', action='store_true')
+    parser.add_argument('--no-resume', action='store_true', help='start from scratch even if a checkpoint exists')
+    parser.add_argument('--metrics', help='write the timing and memory report (JSON) to this file')
+    args = parser.parse_args()
+    run_transcription(args.audio_file, args.transcript_file, args.language, args.model, args.speakers,
+                      start_time=args.start, stop_time=args.stop, disfluencies=not args.no_disfluencies,
+                      resume=not args.no_resume, metrics_file=args.metrics)